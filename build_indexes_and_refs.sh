@@ -2,8 +2,8 @@
 
 # Create indexes and refs for a single set of Harmonie forecast files.
 # This should eventually be triggered when the last file of a forecast has been
-# uploaded to PDS to the S3 bucket. And it should probably be rewritten in
-# python too.
+# uploaded to PDS to the S3 bucket. The indexing and building of refs is done
+# in python by `zarr_creator.indexing`, this script only parses the arguments.
 #
 # Usage: ./build_indexes_and_refs.sh <analysis_time>
 #   analysis_time: analysis time in ISO 8601 format (YYYY-MM-DDTHH:MM:SS)
@@ -18,24 +18,17 @@
 #   /mnt/harmonie-data-from-pds/ml/fc2025030200+000CONTROL__dmi_pl
 #   ...
 #   /mnt/harmonie-data-from-pds/ml/fc2025030200+012CONTROL__dmi_sf
-#   /,nt/harmonie-data-from-pds/ml/fc2025030200+012CONTROL__dmi_pl
+#   /mnt/harmonie-data-from-pds/ml/fc2025030200+012CONTROL__dmi_pl
 #
-# With the refs written as:
+# With the refs written as below, only for the level types of the GRIB messages
+# used in `DATA_COLLECTION` (see `zarr_creator.selection.required_messages`,
+# run `python -m zarr_creator.indexing --index-all-messages` to index all):
 # refs/
-# └── control/2025-03-02T0000Z.jsons
-#     ├── adiabaticCondensation.json
-#     ├── cloudTop.json
+# └── CONTROL__dmi/2025-03-02T0000Z.jsons
 #     ├── entireAtmosphere.json
-#     ├── freeConvection.json
 #     ├── heightAboveGround.json
 #     ├── heightAboveSea.json
-#     ├── hybrid.json
-#     ├── isobaricInhPa.json
-#     ├── isothermal.json
-#     ├── isothermZero.json
-#     ├── neutralBuoyancy.json
-#     ├── nominalTop.json
-#     └── surface.json
+#     └── isobaricInhPa.json
 #
 # i.e. the "sf" and "pl" files are indexed and ref'ed into a single output directory
 
@@ -75,79 +68,18 @@ if [[ ! $ANALYSIS_TIME =~ Z$ ]]; then
     exit 1
 fi
 
-# there are two types of files, ending with _sf and _pl, we need to index both
-# files are stored as the following example:
-# fc2025030206+042CONTROL__dmi_pl, i.e. the format is
-# fc<analysis_time>+<forecast_hour><member_id>_<type>
-
-# use `date` to format the analysis time to the format used in the file names
-ANALYSIS_TIME_STR=$(date -d "$ANALYSIS_TIME" +%Y%m%d%H)
-# use a normalized minute-resolution refs directory name everywhere
-ANALYSIS_REFS_DIR=$(date -d "$ANALYSIS_TIME" -u +"%Y-%m-%dT%H%MZ")
-
-# check that the necessary GRIB files exist
-# the files don't always arrive in order, so we need to check all of them
-forecast_hours=()
-for hour in $(seq 0 "$MAX_HOUR"); do
-    forecast_hours+=("$(printf "%03d" "$hour")")
-done
-
-for type in sf pl; do
-    for hour in "${forecast_hours[@]}"; do
-        if [ ! -f "$SRC_GRIB_ROOT_PATH/fc${ANALYSIS_TIME_STR}+${hour}${MEMBER_ID}_${type}" ]; then
-            echo "File $SRC_GRIB_ROOT_PATH/fc${ANALYSIS_TIME_STR}+${hour}${MEMBER_ID}_${type} does not exist"
-            exit 1
-        fi
-    done
-done
-
+# all "sf" and "pl" files for forecast hours 000..MAX_HOUR are indexed in one
+# pool of worker processes (one per CPU) and the refs for the level types used
+# are built in the same python process
+indexing_args=(--t_analysis "$ANALYSIS_TIME" --max-hour "$MAX_HOUR")
 if [ "$COPY_GRIB_BEFORE_INDEXING" -eq 1 ]; then
     echo "Using temporary root $SRC_GRIB_TEMP_PATH and copying GRIB files before indexing"
-    mkdir -p "$SRC_GRIB_TEMP_PATH"
+    indexing_args+=(--temp-path "$SRC_GRIB_TEMP_PATH")
 else
     echo "No temporary root provided, will index GRIB files directly from $SRC_GRIB_ROOT_PATH"
 fi
 
-for type in sf pl; do
-    SRC_PATH=""
-    source_files=()
-    for hour in "${forecast_hours[@]}"; do
-        source_files+=("$SRC_GRIB_ROOT_PATH/fc${ANALYSIS_TIME_STR}+${hour}${MEMBER_ID}_${type}")
-    done
-
-    if [ "$COPY_GRIB_BEFORE_INDEXING" -eq 1 ]; then
-        echo "Copying from $SRC_GRIB_ROOT_PATH to $SRC_GRIB_TEMP_PATH"
-        rsync -av --progress "${source_files[@]}" "$SRC_GRIB_TEMP_PATH"
-        # check exist code and exit if not 0
-        if [ $? -ne 0 ]; then
-            echo "Failed to copy files"
-            exit 1
-        fi
-        SRC_PATH=$SRC_GRIB_TEMP_PATH
-    else
-        SRC_PATH=$SRC_GRIB_ROOT_PATH
-    fi
-
-    echo "Indexing $type files"
-    # we can't just call the `gribscan-index` command line tool here because we
-    # need to set the local GRIB2 defininitions path and that is only possible
-    # with the eccodes python packge with the call
-    # `eccodes.codes_set_definitions_path(...)`. Unfortunately using the
-    # `ECCODES_DEFINITION_PATH` doesn't work with the python package, and so we
-    # must wrap the `gribscan-index` call.`
-    index_inputs=()
-    for hour in "${forecast_hours[@]}"; do
-        index_inputs+=("$SRC_PATH/fc${ANALYSIS_TIME_STR}+${hour}${MEMBER_ID}_${type}")
-    done
-    uv run python -m zarr_creator.build_indexes "${index_inputs[@]}" -n 2
+indexing_args+=(--index-cache-path "$INDEX_CACHE_PATH")
 
-    echo "Building refs for $type files"
-    index_files=()
-    for hour in "${forecast_hours[@]}"; do
-        index_files+=("$SRC_PATH/fc${ANALYSIS_TIME_STR}+${hour}${MEMBER_ID}_${type}.index")
-    done
-    uv run gribscan-build "${index_files[@]}" \
-        -o ${REFS_ROOT_PATH}/${MEMBER_ID}/${ANALYSIS_REFS_DIR}.jsons\
-        --prefix "$SRC_PATH"/ \
-        -m harmonie
-done
+SRC_GRIB_ROOT_PATH="$SRC_GRIB_ROOT_PATH" REFS_ROOT_PATH="$REFS_ROOT_PATH" MEMBER_ID="$MEMBER_ID" \
+    uv run python -m zarr_creator.indexing "${indexing_args[@]}"
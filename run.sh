@@ -8,6 +8,7 @@ source "${SCRIPT_DIR}/script_defaults.sh"
 echo "SRC_GRIB_ROOT_PATH: ${SRC_GRIB_ROOT_PATH}"
 echo "REFS_ROOT_PATH: ${REFS_ROOT_PATH}"
 echo "SRC_GRIB_TEMP_PATH: ${SRC_GRIB_TEMP_PATH:-not set}"
+echo "GRIB_BLOCK_CACHE_PATH: ${GRIB_BLOCK_CACHE_PATH:-not set}"
 
 while true; do
     # find the nearest three hour interval to the current time, e.g. 00:00,
@@ -54,8 +55,10 @@ while true; do
     if [ -d "$refs_path" ]; then
         echo "Running zarr conversion for analysis time $analysis_time"
 
+        # retries resume from where the previous attempt stopped, rather than
+        # converting the whole forecast again
         while true; do
-            uv run python -m zarr_creator --t_analysis "$analysis_time"
+            uv run python -m zarr_creator --t_analysis "$analysis_time" --resume
             # check if the script was successful with the exit code
             if [ $? -eq 0 ]; then
                 # delete temporary storage if it was used
@@ -7,8 +7,16 @@
 : "${REFS_ROOT_PATH:=/home/ec2-user/nwp-forecast-zarr-creator/refs}"
 : "${MEMBER_ID:=CONTROL__dmi}"
 : "${MAX_HOUR:=36}"
+# GRIB index files are kept here so that unchanged GRIB files aren't indexed
+# again when building the refs is retried
+: "${INDEX_CACHE_PATH:=${REFS_ROOT_PATH}/index-cache}"
 
 # SRC_GRIB_TEMP_PATH is intentionally not set here.
 # If SRC_GRIB_TEMP_PATH is set (env var or second arg to build script), GRIB
 # files are copied before indexing. If unset, scripts index directly from
 # SRC_GRIB_ROOT_PATH.
+#
+# GRIB_BLOCK_CACHE_PATH is also not set here. If it is set (and
+# SRC_GRIB_TEMP_PATH isn't) GRIB files are indexed directly from
+# SRC_GRIB_ROOT_PATH and only the byte ranges read during the zarr conversion
+# are cached in GRIB_BLOCK_CACHE_PATH.
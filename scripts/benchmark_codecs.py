@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark the codec profiles in `zarr_creator.config.CODEC_PROFILES` on an
+existing output zarr dataset.
+
+For every variable (or those selected with `--variables`) and codec profile the
+data is encoded into an in-memory zarr store, and the compression ratio
+(uncompressed bytes / stored bytes), the encoding throughput (uncompressed
+MB/s) and the maximum absolute error after decoding are reported. This makes it
+possible to pick a profile for each variable in
+`config.VARIABLE_CODEC_PROFILES` by trading off storage size against encoding
+cost and precision.
+
+Usage:
+
+    uv run python scripts/benchmark_codecs.py --zarr-path /tmp/dini-recent/single_levels.zarr
+"""
+
+import argparse
+import time
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from zarr_creator.config import CODEC_PROFILES
+from zarr_creator.encoding import codec_encoding
+
+
+def benchmark_variable(da: xr.DataArray, profile: dict) -> dict:
+    """
+    Encode `da` (already loaded into memory) with the codec `profile` and
+    return the compression ratio, encoding throughput and maximum error.
+    """
+    encoding = codec_encoding(profile, dtype=da.dtype)
+    ds = da.to_dataset()
+    ds[da.name].encoding = encoding
+
+    store = zarr.MemoryStore()
+    t_start = time.perf_counter()
+    ds.to_zarr(store, mode="w", consolidated=False)
+    duration = time.perf_counter() - t_start
+
+    stored_nbytes = sum(
+        len(v)
+        for k, v in store.items()
+        if k.startswith(f"{da.name}/") and not k.split("/")[-1].startswith(".")
+    )
+    da_decoded = xr.open_zarr(store, consolidated=False)[da.name].load()
+    max_abs_error = float(np.nanmax(np.abs(da_decoded.values - da.values)))
+
+    return dict(
+        ratio=da.nbytes / stored_nbytes,
+        throughput=da.nbytes / duration / 1e6,
+        max_abs_error=max_abs_error,
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark codec profiles on an output zarr dataset."
+    )
+    parser.add_argument(
+        "--zarr-path",
+        required=True,
+        help="Path or URL of the zarr dataset to benchmark with.",
+    )
+    parser.add_argument(
+        "--variables",
+        nargs="+",
+        default=None,
+        help="Variables to benchmark (default: all data variables).",
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=list(CODEC_PROFILES),
+        help="Codec profiles to benchmark (default: all profiles).",
+    )
+    parser.add_argument(
+        "--n-times",
+        type=int,
+        default=2,
+        help="Number of timesteps of each variable to encode.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ds = xr.open_zarr(args.zarr_path)
+    if "time" in ds.dims:
+        ds = ds.isel(time=slice(0, args.n_times))
+
+    var_names = args.variables or [v for v in ds.data_vars if ds[v].ndim > 0]
+
+    print(
+        f"{'variable':<20} {'profile':<12} {'ratio':>8} {'MB/s':>10} "
+        f"{'max abs error':>14}"
+    )
+    for var_name in var_names:
+        da = ds[var_name].load()
+        da.encoding = {}
+        for profile_name in args.profiles:
+            result = benchmark_variable(da, CODEC_PROFILES[profile_name])
+            print(
+                f"{var_name:<20} {profile_name:<12} {result['ratio']:>8.2f} "
+                f"{result['throughput']:>10.1f} {result['max_abs_error']:>14.3g}"
+            )
+
+
+if __name__ == "__main__":
+    main()
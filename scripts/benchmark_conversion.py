@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Benchmark the end-to-end conversion on synthetic DINI-shaped GRIB files, so
+that changes to the conversion can be checked for performance regressions
+without access to the DMI data.
+
+GRIB2 files with the same grid (Lambert conformal, 1906 x 1606 points at 2 km,
+scaled with `--grid-scale`), file layout (`sf` and `pl` files named like
+`indexing.GRIB_FILENAME_FORMAT`) and messages (those selected by
+`selection.required_messages`) as the DINI forecasts are generated with
+eccodes for `--n-hours` lead times. The stages of the conversion are then
+timed separately:
+
+- `index_files`: indexing the GRIB files with gribscan
+- `build_refs`: building the gribscan refs from the indexes
+- `read_level_type_data`: opening the refs of each level type
+- `build_parts`: assembling the parts (as in `zarr_creator.__main__.cli`)
+- `write_output_zarrs`: writing each part, to a local store (`local`) and to
+  a local S3 stand-in run with moto (`s3`)
+
+The timings (with peak RSS, bytes read and written, see
+`zarr_creator.instrumentation`) are written as a run report to
+`--output-path`. With `--baseline` the wall time of each stage is compared to
+an earlier report.
+
+Usage:
+
+    uv run python scripts/benchmark_conversion.py --n-hours 3 --grid-scale 0.25
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from zarr_creator import write_zarr
+from zarr_creator.config import OUTPUT_CHUNKING
+from zarr_creator.grib_definitions import set_local_eccodes_definitions_path
+from zarr_creator.indexing import (
+    GRIB_FILE_TYPES,
+    build_refs,
+    grib_filepath,
+    index_files,
+)
+from zarr_creator.instrumentation import run_report, stage
+from zarr_creator.parts import add_provenance_attrs, build_parts
+from zarr_creator.read_source import LevelTypeDataReader, read_level_type_data
+from zarr_creator.rechunk import resolve_chunks
+from zarr_creator.scheduler import dask_scheduler
+from zarr_creator.selection import required_messages
+
+SHORT_NAME_DEF_PATH = (
+    Path(__file__).parent.parent
+    / "zarr_creator/eccodes_definitions/grib2/localConcepts/ekmi/shortName.def"
+)
+MEMBER_ID = "CONTROL__dmi"
+MEMBER = "control"
+T_ANALYSIS = datetime.datetime(2025, 1, 1, 0, tzinfo=datetime.timezone.utc)
+
+# the DINI grid (see `read_source.DINI_CRS_WKT`)
+DINI_GRID = dict(
+    Nx=1906,
+    Ny=1606,
+    DxInMetres=2000,
+    DyInMetres=2000,
+    latitudeOfFirstGridPointInDegrees=39.671,
+    longitudeOfFirstGridPointInDegrees=334.578,
+    LaDInDegrees=55.5,
+    LoVInDegrees=352.0,
+    Latin1InDegrees=55.5,
+    Latin2InDegrees=55.5,
+)
+EARTH_RADIUS = 6371229
+# the levels of the messages for which `required_messages` selects all levels
+DEFAULT_LEVEL = 0
+# variables that (also) have accumulated messages in the DINI `sf` files
+ACCUMULATED_VARIABLES = ["swavr", "lwavr"]
+# level types in the `pl` files, all others are in the `sf` files
+PL_LEVEL_TYPES = ["isobaricInhPa"]
+# range of the synthetic values of each variable, so that they compress
+# roughly like real data
+VALUE_RANGES = dict(
+    t=(220.0, 310.0),
+    tw=(220.0, 300.0),
+    r=(0.0, 100.0),
+    u=(-30.0, 30.0),
+    v=(-30.0, 30.0),
+    z=(0.0, 160000.0),
+    pres=(95000.0, 104000.0),
+    hcc=(0.0, 1.0),
+    lcc=(0.0, 1.0),
+    mcc=(0.0, 1.0),
+    lsm=(0.0, 1.0),
+    vis=(0.0, 50000.0),
+    mld=(0.0, 3000.0),
+    cape=(0.0, 2000.0),
+    swavr=(0.0, 800.0),
+    lwavr=(-150.0, 0.0),
+)
+BUCKET_NAME = write_zarr.BUCKET_NAME
+
+
+def read_parameter_keys(fp: Path = SHORT_NAME_DEF_PATH) -> dict:
+    """
+    Read the GRIB keys identifying each parameter (e.g. `discipline`,
+    `parameterCategory` and `parameterNumber`) from the local eccodes
+    shortName definitions, keyed by shortName. Only the first definition of
+    each shortName is used.
+    """
+    keys = {}
+    for short_name, body in re.findall(r"'(\w+)'\s*=\s*\{([^}]*)\}", fp.read_text()):
+        if short_name in keys:
+            continue
+        keys[short_name] = {
+            key: int(value)
+            for key, value in re.findall(r"(\w+)\s*=\s*(-?\d+)\s*;", body)
+            if key != "editionNumber"
+        }
+    return keys
+
+
+def synthetic_values(short_name: str, level, hour: int, shape: tuple) -> np.ndarray:
+    """
+    Smooth synthetic field for a variable, level and lead time, with the
+    values within the range of the variable in `VALUE_RANGES`.
+    """
+    vmin, vmax = VALUE_RANGES.get(short_name, (0.0, 1.0))
+    ny, nx = shape
+    y, x = np.meshgrid(
+        np.linspace(0, 2 * np.pi, ny), np.linspace(0, 2 * np.pi, nx), indexing="ij"
+    )
+    phase = 0.1 * hour + 0.001 * float(level)
+    values = 0.5 + 0.25 * np.sin(3 * x + phase) + 0.25 * np.cos(2 * y - phase)
+    return vmin + (vmax - vmin) * values
+
+
+def _encode_message(
+    eccodes, sample, parameter_keys, grid, message, hour, shape
+) -> bytes:
+    level_type, short_name, level, step_type = message
+    h = eccodes.codes_clone(sample)
+    for key, value in grid.items():
+        eccodes.codes_set(h, key, value)
+    # the local concepts are selected by the centre, so these are set first
+    parameter = dict(parameter_keys[short_name])
+    for key in ["centre", "subCentre", "tablesVersion"]:
+        if key in parameter:
+            eccodes.codes_set(h, key, parameter.pop(key))
+    for key, value in parameter.items():
+        eccodes.codes_set(h, key, value)
+    eccodes.codes_set(h, "typeOfLevel", level_type)
+    eccodes.codes_set(h, "level", int(level))
+    eccodes.codes_set(h, "stepUnits", "h")
+
+    values = synthetic_values(short_name, level, hour, shape)
+    if step_type == "accum":
+        # accumulated since the analysis time
+        eccodes.codes_set(h, "productDefinitionTemplateNumber", 8)
+        eccodes.codes_set(h, "typeOfStatisticalProcessing", 1)
+        eccodes.codes_set(h, "startStep", 0)
+        eccodes.codes_set(h, "endStep", hour)
+        values = values * hour * 3600
+    else:
+        eccodes.codes_set(h, "forecastTime", hour)
+    eccodes.codes_set_values(h, values.ravel())
+
+    message_bytes = eccodes.codes_get_message(h)
+    eccodes.codes_release(h)
+    return message_bytes
+
+
+def grib_messages(file_type: str) -> list:
+    """
+    The messages in each synthetic GRIB file of type `file_type`, as tuples
+    `(level_type, short_name, level, step_type)`.
+    """
+    messages = []
+    for level_type, by_short_name in required_messages().items():
+        if (level_type in PL_LEVEL_TYPES) != (file_type == "pl"):
+            continue
+        for short_name, levels in by_short_name.items():
+            step_types = ["instant"]
+            if short_name in ACCUMULATED_VARIABLES:
+                step_types.append("accum")
+            for level in sorted(levels or [DEFAULT_LEVEL]):
+                for step_type in step_types:
+                    messages.append((level_type, short_name, level, step_type))
+    return messages
+
+
+def generate_grib_files(grib_path: Path, n_hours: int, grid_scale: float = 1.0) -> list:
+    """
+    Generate the synthetic `sf` and `pl` GRIB files for lead times
+    `0..n_hours - 1` in `grib_path`, returning their paths.
+    """
+    import eccodes
+
+    set_local_eccodes_definitions_path()
+    grib_path.mkdir(parents=True, exist_ok=True)
+
+    grid = dict(DINI_GRID)
+    grid["Nx"] = int(round(DINI_GRID["Nx"] * grid_scale))
+    grid["Ny"] = int(round(DINI_GRID["Ny"] * grid_scale))
+    grid["DxInMetres"] = int(round(DINI_GRID["DxInMetres"] / grid_scale))
+    grid["DyInMetres"] = int(round(DINI_GRID["DyInMetres"] / grid_scale))
+    shape = (grid["Ny"], grid["Nx"])
+
+    parameter_keys = read_parameter_keys()
+    sample = eccodes.codes_grib_new_from_samples("GRIB2")
+    eccodes.codes_set(sample, "gridDefinitionTemplateNumber", 30)
+    eccodes.codes_set(sample, "shapeOfTheEarth", 1)
+    eccodes.codes_set(sample, "scaleFactorOfRadiusOfSphericalEarth", 0)
+    eccodes.codes_set(sample, "scaledValueOfRadiusOfSphericalEarth", EARTH_RADIUS)
+    eccodes.codes_set(sample, "jScansPositively", 1)
+    eccodes.codes_set(sample, "dataDate", int(f"{T_ANALYSIS:%Y%m%d}"))
+    eccodes.codes_set(sample, "dataTime", int(f"{T_ANALYSIS:%H%M}"))
+    eccodes.codes_set(sample, "packingType", "grid_simple")
+    eccodes.codes_set(sample, "bitsPerValue", 16)
+
+    filepaths = []
+    for hour in range(n_hours):
+        for file_type in GRIB_FILE_TYPES:
+            fp = grib_filepath(
+                t_analysis=T_ANALYSIS,
+                hour=hour,
+                file_type=file_type,
+                member_id=MEMBER_ID,
+                root_path=grib_path,
+            )
+            with open(fp, "wb") as f:
+                for message in grib_messages(file_type):
+                    f.write(
+                        _encode_message(
+                            eccodes, sample, parameter_keys, grid, message, hour, shape
+                        )
+                    )
+            filepaths.append(fp)
+
+    eccodes.codes_release(sample)
+    return filepaths
+
+
+def _start_s3_stand_in():
+    from moto.server import ThreadedMotoServer
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    write_zarr.S3_ENDPOINT_URL = f"http://{host}:{port}"
+
+    import fsspec
+
+    fs = fsspec.filesystem("s3", **write_zarr.s3_storage_options())
+    fs.mkdir(BUCKET_NAME)
+    return server
+
+
+def run_benchmark(args):
+    work_path = Path(args.work_path)
+    grib_path = work_path / "grib"
+    refs_path = work_path / "refs"
+
+    with stage("generate_grib", n_hours=args.n_hours):
+        grib_files = generate_grib_files(
+            grib_path, n_hours=args.n_hours, grid_scale=args.grid_scale
+        )
+
+    with stage("index_files"):
+        index_paths = index_files(
+            grib_files,
+            n_workers=args.n_workers,
+            cache_path=work_path / "index-cache",
+            selection=required_messages(),
+        )
+
+    with stage("build_refs"):
+        # as in `indexing.build_members_indexes_and_refs`, the refs are built
+        # one file type at a time
+        for file_type in GRIB_FILE_TYPES:
+            build_refs(
+                [
+                    idx
+                    for fp, idx in zip(grib_files, index_paths)
+                    if str(fp).endswith(f"_{file_type}")
+                ],
+                refs_path=refs_path,
+                prefix=str(grib_path) + "/",
+            )
+
+    for fp_refs in sorted(refs_path.glob("*.json")):
+        with stage("read_level_type_data", level_type=fp_refs.stem):
+            read_level_type_data(
+                t_analysis=T_ANALYSIS,
+                level_type=fp_refs.stem,
+                refs_path=refs_path,
+                block_cache_path=None,
+            )
+
+    with stage("build_parts"):
+        parts = build_parts(
+            T_ANALYSIS, LevelTypeDataReader(), member_id=MEMBER_ID, refs_path=refs_path
+        )
+
+    server = None
+    if "s3" in args.targets:
+        server = _start_s3_stand_in()
+    try:
+        with dask_scheduler(n_workers=args.n_workers):
+            for target in args.targets:
+                for part_id, ds_part in parts.items():
+                    add_provenance_attrs(ds_part)
+                    with stage("write_output_zarrs", target=target, dataset=part_id):
+                        write_zarr.write_output_zarrs(
+                            ds=ds_part,
+                            dataset_id=part_id,
+                            rechunk_to=resolve_chunks(
+                                ds_part, OUTPUT_CHUNKING[part_id]
+                            ),
+                            member=MEMBER,
+                            t_analysis=T_ANALYSIS,
+                            skip_s3_bucket_upload=target == "local",
+                            local_copy_path=work_path / "output" / target,
+                            rechunk_method=args.rechunk_method,
+                        )
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def _stage_key(record: dict) -> str:
+    labels = ",".join(f"{k}={v}" for k, v in record["labels"].items())
+    return f"{record['stage']}[{labels}]" if labels else record["stage"]
+
+
+def print_summary(report: dict, baseline: dict = None):
+    baseline_times = {}
+    if baseline is not None:
+        baseline_times = {_stage_key(s): s["wall_time_s"] for s in baseline["stages"]}
+
+    print(f"{'stage':<60} {'time [s]':>10} {'peak RSS [MB]':>14} {'vs baseline':>12}")
+    for record in report["stages"]:
+        key = _stage_key(record)
+        ratio = ""
+        if baseline_times.get(key):
+            ratio = f"{record['wall_time_s'] / baseline_times[key]:.2f}x"
+        print(
+            f"{key:<60} {record['wall_time_s']:>10.2f} "
+            f"{(record['peak_rss_bytes'] or 0) / 1e6:>14.0f} {ratio:>12}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the conversion on synthetic DINI-shaped GRIB files."
+    )
+    parser.add_argument(
+        "--n-hours",
+        type=int,
+        default=3,
+        help="Number of lead times to generate GRIB files for.",
+    )
+    parser.add_argument(
+        "--grid-scale",
+        type=float,
+        default=1.0,
+        help="Scale factor for the number of grid points along x and y "
+        "(the grid spacing is scaled so the domain stays the same).",
+    )
+    parser.add_argument(
+        "--targets",
+        nargs="+",
+        choices=["local", "s3"],
+        default=["local", "s3"],
+        help="Stores to benchmark `write_output_zarrs` against, `s3` uses a "
+        "local S3 stand-in (requires moto).",
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for indexing and dask workers.",
+    )
+    parser.add_argument(
+        "--rechunk-method",
+        default="auto",
+        choices=["auto", "memory", "rechunker"],
+        help="Rechunk method passed to `write_output_zarrs`.",
+    )
+    parser.add_argument(
+        "--work-path",
+        default=None,
+        help="Directory for the GRIB files, refs and outputs (default: a "
+        "temporary directory that is removed afterwards).",
+    )
+    parser.add_argument(
+        "--output-path",
+        default="benchmark-reports",
+        help="Directory to write the benchmark report to.",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Earlier benchmark report to compare the stage wall times to.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    baseline = None
+    if args.baseline is not None:
+        baseline = json.loads(Path(args.baseline).read_text())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.work_path is None:
+            args.work_path = tmpdir
+        with run_report(
+            T_ANALYSIS,
+            report_path=args.output_path,
+            prometheus_textfile=None,
+            n_hours=args.n_hours,
+            grid_scale=args.grid_scale,
+            targets=args.targets,
+        ) as report:
+            run_benchmark(args)
+
+    print_summary(report.to_dict(), baseline=baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Shared fixtures of the zarr_creator tests.
+
+`synthetic_refs` writes refs in the layout of the gribscan refs (one `.json`
+reference file per level type) for all the variables and levels used in
+`DATA_COLLECTION`. The chunks they point to are stored uncompressed in one
+file per level type (standing in for the GRIB files), so that the conversion
+can be run end to end without GRIB files, eccodes or gribscan. `run_cli`
+runs the conversion of the command line interface on them. `s3_bucket` starts
+a local moto S3 server with the output bucket.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import urllib.request
+import zlib
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from zarr_creator.config import DATA_COLLECTION
+from zarr_creator.transforms import DERIVED_VARIABLES
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 0, tzinfo=datetime.timezone.utc)
+# the grid sizes divide the `OUTPUT_CHUNKING` of all parts
+N_Y, N_X = 4, 6
+
+
+def level_type_variables(data_collection: dict = DATA_COLLECTION) -> dict:
+    """Levels of each variable read for each level type (`None` for no level)."""
+    by_level_type = {}
+    for part_details in data_collection.values():
+        for level_details in part_details:
+            variables = by_level_type.setdefault(level_details["level_type"], {})
+            names = {
+                name: levels
+                for name, levels in level_details.get("variables", {}).items()
+                if not callable(levels)
+            }
+            names.update(level_details.get("inputs", {}))
+            for name, levels in level_details.get("derived_variables", {}).items():
+                for var_name in DERIVED_VARIABLES[name]["inputs"]:
+                    names[var_name] = levels
+            for name, levels in names.items():
+                if levels is not None or variables.get(name) is not None:
+                    levels = sorted(set(levels or []) | set(variables.get(name) or []))
+                variables[name] = levels
+    return by_level_type
+
+
+def synthetic_level_type_dataset(
+    level_type: str, variables: dict, t_analysis: datetime.datetime, n_times: int
+) -> xr.Dataset:
+    """Build the dataset gribscan gives a level type, with random values."""
+    rng = np.random.default_rng(zlib.crc32(level_type.encode()))
+    levels = sorted({lev for lv in variables.values() if lv for lev in lv})
+    x = 2500.0 * np.arange(N_X)
+    y = 2500.0 * np.arange(N_Y)
+    lon, lat = np.meshgrid(10.0 + 0.1 * np.arange(N_X), 55.0 + 0.1 * np.arange(N_Y))
+    t0 = np.datetime64(t_analysis.replace(tzinfo=None), "ns")
+    coords = {
+        "time": t0 + np.arange(n_times) * np.timedelta64(1, "h"),
+        "y": y,
+        "x": x,
+        "lat": (("y", "x"), lat, {"units": "degrees_north"}),
+        "lon": (("y", "x"), lon, {"units": "degrees_east"}),
+    }
+    if levels:
+        coords["level"] = levels
+
+    data_vars = {}
+    for name, var_levels in variables.items():
+        if var_levels is None:
+            dims, shape = ("time", "y", "x"), (n_times, N_Y, N_X)
+        else:
+            dims, shape = ("time", "level", "y", "x"), (n_times, len(levels), N_Y, N_X)
+        data_vars[name] = (
+            dims,
+            rng.uniform(0.1, 1.0, size=shape).astype("f4"),
+            {"units": "1", "long_name": name},
+        )
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def write_refs(ds: xr.Dataset, fp_refs, fp_data):
+    """
+    Write `ds` as a reference file `fp_refs`, with the (uncompressed) chunks
+    of each variable stored one after another in `fp_data`.
+    """
+    fp_store = fp_data.with_suffix(".zarr")
+    chunks = {"time": 1, "level": 1}
+    encoding = {
+        v: dict(
+            compressor=None,
+            chunks=tuple(chunks.get(d, ds.sizes[d]) for d in ds[v].dims),
+        )
+        for v in ds.variables
+        if ds[v].ndim > 0
+    }
+    ds.to_zarr(fp_store, mode="w", encoding=encoding, consolidated=True)
+
+    refs = {}
+    offset = 0
+    with open(fp_data, "wb") as fh:
+        for dirpath, _, filenames in sorted(os.walk(fp_store)):
+            for filename in sorted(filenames):
+                fp = os.path.join(dirpath, filename)
+                key = os.path.relpath(fp, fp_store)
+                with open(fp, "rb") as fh_chunk:
+                    content = fh_chunk.read()
+                if filename.startswith("."):
+                    refs[key] = content.decode()
+                else:
+                    refs[key] = [str(fp_data), offset, len(content)]
+                    fh.write(content)
+                    offset += len(content)
+    shutil.rmtree(fp_store)
+    fp_refs.write_text(json.dumps(dict(version=1, refs=refs)))
+
+
+def run_cli(tmp_path, monkeypatch, *argv, local_copy_dir="dini-recent"):
+    """
+    Run the conversion of `T_ANALYSIS` (see `__main__._run`) with the local
+    copies written to `tmp_path / local_copy_dir`, which is returned.
+    """
+    import zarr_creator.__main__ as cli_main
+
+    local_copy_root = tmp_path / local_copy_dir
+    monkeypatch.setattr(cli_main, "LOCAL_COPY_STORAGE_PATH", local_copy_root)
+    args = cli_main._setup_argparse().parse_args(
+        [
+            "--t_analysis",
+            T_ANALYSIS.isoformat(),
+            "--skip-s3-bucket-upload",
+            "--n-workers",
+            "1",
+            "--grid-geometry-cache-path",
+            str(tmp_path / "grid-geometry"),
+            *argv,
+        ]
+    )
+    cli_main._run(args)
+    return local_copy_root
+
+
+@pytest.fixture
+def synthetic_refs(tmp_path, monkeypatch):
+    """
+    Writer of synthetic refs for a member under a temporary `REFS_ROOT_PATH`,
+    returning the refs directory of the forecast.
+    """
+    from zarr_creator.read_source import refs_path_for
+
+    refs_root_path = tmp_path / "refs"
+    monkeypatch.setenv("REFS_ROOT_PATH", str(refs_root_path))
+
+    def _write(member_id="CONTROL__dmi", t_analysis=T_ANALYSIS, n_times=3):
+        refs_path = refs_path_for(t_analysis=t_analysis, member_id=member_id)
+        refs_path.mkdir(parents=True, exist_ok=True)
+        for level_type, variables in level_type_variables().items():
+            ds = synthetic_level_type_dataset(
+                level_type, variables, t_analysis=t_analysis, n_times=n_times
+            )
+            write_refs(
+                ds,
+                fp_refs=refs_path / f"{level_type}.json",
+                fp_data=refs_path / f"{level_type}.grib",
+            )
+        return refs_path
+
+    return _write
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """
+    Local moto S3 server with an empty output bucket, which the writer uses
+    (through `write_zarr.S3_ENDPOINT_URL`), returning its storage options.
+    """
+    import fsspec
+
+    from zarr_creator import write_zarr
+
+    moto_server = pytest.importorskip("moto.server")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        monkeypatch.setattr(write_zarr, "S3_ENDPOINT_URL", f"http://{host}:{port}")
+        storage_options = write_zarr.s3_storage_options()
+        # the moto servers of all tests share their state, and may have had
+        # the same port (so filesystem instances would be reused)
+        urllib.request.urlopen(
+            urllib.request.Request(
+                f"http://{host}:{port}/moto-api/reset", method="POST"
+            )
+        )
+        fsspec.get_filesystem_class("s3").clear_instance_cache()
+        fsspec.filesystem("s3", **storage_options).mkdir(write_zarr.BUCKET_NAME)
+        yield storage_options
+    finally:
+        server.stop()
@@ -0,0 +1,120 @@
+"""Tests for zarr_creator.aggregate.
+
+Verifies that the stores published to a local S3 stand-in are aggregated
+along `analysis_time` and `lead_time` (with missing lead times read as NaN),
+that updating the aggregate only reads the metadata of new stores, and that
+the aggregate only keeps the most recent stores.
+"""
+
+import datetime
+import json
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+from zarr_creator import aggregate
+from zarr_creator.aggregate import open_aggregate, update_aggregate
+from zarr_creator.write_zarr import write_output_zarrs
+
+T0 = datetime.datetime(2025, 2, 17, 0, tzinfo=datetime.timezone.utc)
+
+
+def _publish(t_analysis, n_times, local_copy_path):
+    """Publish a `single_levels` store with `t2m` equal to the hour of day."""
+    times = [
+        np.datetime64(t_analysis.replace(tzinfo=None), "ns") + np.timedelta64(h, "h")
+        for h in range(n_times)
+    ]
+    ds = xr.Dataset(
+        {
+            "t2m": (
+                ("time", "y", "x"),
+                np.full((n_times, 3, 4), t_analysis.hour, dtype="f4"),
+            ),
+            "lsm": (("y", "x"), np.ones((3, 4), dtype="f4")),
+        },
+        coords={"time": times, "y": np.arange(3), "x": np.arange(4)},
+    )
+    write_output_zarrs(
+        ds=ds,
+        dataset_id="single_levels",
+        rechunk_to=dict(time=1, y=3, x=2),
+        member="control",
+        t_analysis=t_analysis,
+        local_copy_path=local_copy_path,
+    )
+
+
+def test_update_aggregate(tmp_path, monkeypatch, s3_bucket):
+    """Published stores are aggregated and only new ones are read on update."""
+    read_urls = []
+    read_zmetadata = aggregate._read_zmetadata
+
+    def _counting_read_zmetadata(url, storage_options=None):
+        read_urls.append(url)
+        return read_zmetadata(url, storage_options=storage_options)
+
+    monkeypatch.setattr(aggregate, "_read_zmetadata", _counting_read_zmetadata)
+
+    _publish(T0, n_times=3, local_copy_path=tmp_path / "00")
+    _publish(T0 + datetime.timedelta(hours=3), 2, tmp_path / "03")
+    assert update_aggregate("control", "single_levels") == 2
+
+    read_urls.clear()
+    _publish(T0 + datetime.timedelta(hours=6), 3, tmp_path / "06")
+    assert update_aggregate("control", "single_levels") == 3
+    # the template store and the new store
+    assert len(read_urls) == 2
+    assert read_urls[-1].endswith("2025-02-17T060000Z/single_levels.zarr")
+
+    ds = open_aggregate(storage_options=s3_bucket)
+    assert ds["t2m"].dims == ("analysis_time", "lead_time", "y", "x")
+    assert ds["lsm"].dims == ("y", "x")
+    np.testing.assert_array_equal(
+        ds["analysis_time"].values,
+        np.array(
+            ["2025-02-17T00", "2025-02-17T03", "2025-02-17T06"],
+            dtype="datetime64[ns]",
+        ),
+    )
+    np.testing.assert_array_equal(
+        ds["lead_time"].values, np.array([0, 1, 2], dtype="timedelta64[h]")
+    )
+    np.testing.assert_array_equal(
+        ds["t2m"].mean(["y", "x"]).values,
+        [[0, 0, 0], [3, 3, np.nan], [6, 6, 6]],
+    )
+
+
+def test_aggregate_size_bounded(tmp_path, s3_bucket):
+    """Aggregates keep the most recent stores, so they stop growing."""
+    fs = fsspec.filesystem("s3", **s3_bucket)
+    url = aggregate.aggregate_url("control", "single_levels")
+
+    n_stores, n_refs = [], []
+    for i in range(5):
+        _publish(T0 + datetime.timedelta(hours=3 * i), 2, tmp_path / f"{i:02d}")
+        n_stores.append(update_aggregate("control", "single_levels", max_stores=3))
+        n_refs.append(len(json.loads(fs.cat_file(url))["refs"]))
+    assert n_stores == [1, 2, 3, 3, 3]
+    assert n_refs[0] < n_refs[1] < n_refs[2] == n_refs[3] == n_refs[4]
+
+    assert (
+        update_aggregate(
+            "control", "single_levels", retention=datetime.timedelta(hours=3)
+        )
+        == 2
+    )
+    ds = open_aggregate(storage_options=s3_bucket)
+    np.testing.assert_array_equal(
+        ds["analysis_time"].values,
+        np.array(["2025-02-17T09", "2025-02-17T12"], dtype="datetime64[ns]"),
+    )
+    np.testing.assert_array_equal(ds["t2m"].mean(["y", "x"]).values, [[9, 9], [12, 12]])
+    # the template store (which the arrays without `time` are read from) was
+    # replaced by the latest store when the first store was dropped
+    assert ds.attrs[aggregate.TEMPLATE_ATTR].endswith(
+        "2025-02-17T090000Z/single_levels.zarr"
+    )
+    np.testing.assert_array_equal(ds["lsm"].values, 1)
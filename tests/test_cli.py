@@ -0,0 +1,103 @@
+"""Tests for the zarr_creator command line interface (`python -m zarr_creator`).
+
+Verifies that a run converts the synthetic refs of several members into the
+local copies of the output stores, with the station index written for every
+member, also with a memory budget, that the parts written concurrently
+are complete and published, and that the GRIB block cache is deleted after
+the conversion.
+"""
+
+import json
+import threading
+
+import pytest
+import xarray as xr
+
+from zarr_creator import read_source, write_zarr
+from zarr_creator.config import DATA_COLLECTION
+from zarr_creator.publish import read_publish_marker
+from zarr_creator.write_zarr import local_copy_path_for
+
+from .conftest import run_cli
+
+MEMBER_IDS = ["CONTROL__dmi", "MBR001__dmi"]
+
+
+@pytest.mark.parametrize("memory_limit", [None, "4GB"])
+def test_station_index_written_for_all_members(
+    tmp_path, monkeypatch, synthetic_refs, memory_limit
+):
+    """The station index is written next to the stores of every member."""
+    if memory_limit is not None:
+        pytest.importorskip("distributed")
+    for member_id in MEMBER_IDS:
+        synthetic_refs(member_id=member_id)
+    fp_stations = tmp_path / "stations.csv"
+    fp_stations.write_text("name,lat,lon\nodense,55.21,10.38\n")
+
+    argv = ["--members", *MEMBER_IDS, "--stations", str(fp_stations)]
+    if memory_limit is not None:
+        argv += ["--memory-limit", memory_limit]
+    local_copy_root = run_cli(tmp_path, monkeypatch, *argv)
+
+    for member in ["control", "mbr001"]:
+        fp_local = local_copy_path_for(local_copy_root, member)
+        station_index = json.loads((fp_local / "stations.json").read_text())
+        assert [s["name"] for s in station_index["stations"]] == ["odense"]
+        ds = xr.open_zarr(fp_local / "single_levels.zarr")
+        assert ds.sizes["time"] == 3
+
+
+def test_concurrent_parts_written_and_published(tmp_path, monkeypatch, synthetic_refs):
+    """All parts are written at the same time and each is complete and published."""
+    synthetic_refs()
+    sequential_root = run_cli(tmp_path, monkeypatch, local_copy_dir="sequential")
+
+    # every part waits for the others before writing, so that the test fails
+    # (with a broken barrier) unless all parts are written at the same time
+    barrier = threading.Barrier(len(DATA_COLLECTION), timeout=60)
+    write_or_resume = write_zarr._write_or_resume
+
+    def _write_together(*args, **kwargs):
+        barrier.wait()
+        return write_or_resume(*args, **kwargs)
+
+    monkeypatch.setattr(write_zarr, "_write_or_resume", _write_together)
+    local_copy_root = run_cli(tmp_path, monkeypatch, "--concurrent-parts")
+
+    fp_local = local_copy_path_for(local_copy_root, "control")
+    fp_sequential = local_copy_path_for(sequential_root, "control")
+    for part_id in DATA_COLLECTION:
+        fp_store = fp_local / f"{part_id}.zarr"
+        assert read_publish_marker(str(fp_store)) is not None
+        xr.testing.assert_identical(
+            xr.open_zarr(fp_store).drop_attrs(deep=False),
+            xr.open_zarr(fp_sequential / f"{part_id}.zarr").drop_attrs(deep=False),
+        )
+    # no staging directories are left behind
+    assert sorted(p.name for p in fp_local.iterdir()) == sorted(
+        f"{part_id}.zarr" for part_id in DATA_COLLECTION
+    )
+
+
+def test_block_cache_deleted_after_conversion(tmp_path, monkeypatch, synthetic_refs):
+    """The conversion reads through the block cache and deletes it when done."""
+    synthetic_refs()
+    fp_cache = tmp_path / "block-cache"
+    monkeypatch.setattr(read_source, "GRIB_BLOCK_CACHE_PATH", str(fp_cache))
+
+    cached_files = []
+    clear_block_cache = read_source.clear_block_cache
+
+    def _clear_block_cache(*args, **kwargs):
+        cached_files.extend(p for p in fp_cache.rglob("*") if p.is_file())
+        clear_block_cache(*args, **kwargs)
+
+    monkeypatch.setattr(read_source, "clear_block_cache", _clear_block_cache)
+    local_copy_root = run_cli(tmp_path, monkeypatch)
+
+    assert cached_files
+    assert not fp_cache.exists()
+    fp_local = local_copy_path_for(local_copy_root, "control")
+    for part_id in DATA_COLLECTION:
+        assert read_publish_marker(str(fp_local / f"{part_id}.zarr")) is not None
@@ -0,0 +1,162 @@
+"""Tests for zarr_creator.daemon.
+
+Verifies parsing of GRIB filenames, that forecasts are only converted once all
+their files exist and have settled, that failed conversions are retried, and
+that a forecast is converted to the same output as with the CLI.
+"""
+
+import datetime
+import json
+
+import pytest
+import xarray as xr
+
+pytest.importorskip("gribscan")
+pytest.importorskip("eccodes")
+
+from zarr_creator import __main__ as cli_main  # noqa: E402
+from zarr_creator import daemon  # noqa: E402
+from zarr_creator.instrumentation import run_report_path  # noqa: E402
+from zarr_creator.scheduler import dask_scheduler  # noqa: E402
+
+from .conftest import T_ANALYSIS as T_REFS  # noqa: E402
+from .conftest import run_cli  # noqa: E402
+
+T_ANALYSIS = datetime.datetime(2025, 3, 2, 6, tzinfo=datetime.timezone.utc)
+NOW = T_ANALYSIS + datetime.timedelta(hours=3)
+
+
+def _write_forecast(root_path, max_hour, member_id="CONTROL__dmi", nbytes=10):
+    """Write empty stand-in GRIB files for all hours of a forecast."""
+    for hour in range(max_hour + 1):
+        for file_type in ["sf", "pl"]:
+            fn = f"fc{T_ANALYSIS:%Y%m%d%H}+{hour:03d}{member_id}_{file_type}"
+            (root_path / fn).write_bytes(b"\0" * nbytes)
+
+
+def test_parse_grib_filename():
+    """GRIB filenames are parsed and other files are ignored."""
+    assert daemon.parse_grib_filename("fc2025030206+042CONTROL__dmi_pl") == (
+        T_ANALYSIS,
+        "CONTROL__dmi",
+        42,
+        "pl",
+    )
+    assert daemon.parse_grib_filename("fc2025030206+042CONTROL__dmi_pl.index") is None
+    assert daemon.parse_grib_filename("fc2025030206+042CONTROL__dmi_ml") is None
+
+
+def test_tracker_waits_for_complete_and_settled_files(tmp_path):
+    """A forecast is ready once all files exist and are unchanged between scans."""
+    tracker = daemon.ForecastTracker(max_hour=2)
+    _write_forecast(tmp_path, max_hour=1)
+    assert tracker.ready_forecasts(daemon.scan_grib_files(tmp_path), NOW) == []
+
+    _write_forecast(tmp_path, max_hour=2)
+    assert tracker.ready_forecasts(daemon.scan_grib_files(tmp_path), NOW) == []
+
+    # a file still being written changes size between scans
+    _write_forecast(tmp_path, max_hour=2, nbytes=20)
+    assert tracker.ready_forecasts(daemon.scan_grib_files(tmp_path), NOW) == []
+
+    key = (T_ANALYSIS, "CONTROL__dmi")
+    assert tracker.ready_forecasts(daemon.scan_grib_files(tmp_path), NOW) == [key]
+
+    tracker.mark_done(key)
+    assert tracker.ready_forecasts(daemon.scan_grib_files(tmp_path), NOW) == []
+
+
+def test_tracker_filters_members_and_old_forecasts(tmp_path):
+    """Only the selected members and recent analysis times are tracked."""
+    _write_forecast(tmp_path, max_hour=0, member_id="CONTROL__dmi")
+    _write_forecast(tmp_path, max_hour=0, member_id="MBR001__dmi")
+    forecasts = daemon.scan_grib_files(tmp_path)
+
+    tracker = daemon.ForecastTracker(max_hour=0, member_ids=["MBR001__dmi"])
+    for _ in range(2):
+        ready = tracker.ready_forecasts(forecasts, NOW)
+    assert ready == [(T_ANALYSIS, "MBR001__dmi")]
+
+    tracker = daemon.ForecastTracker(max_hour=0, lookback=datetime.timedelta(hours=1))
+    for _ in range(2):
+        ready = tracker.ready_forecasts(forecasts, NOW)
+    assert ready == []
+
+
+def test_run_daemon_retries_failed_conversion(tmp_path, monkeypatch):
+    """A failed conversion is retried after the retry interval."""
+    _write_forecast(tmp_path, max_hour=0)
+    calls = []
+
+    def _fake_convert_forecast(t_analysis, member_id, **kwargs):
+        calls.append((t_analysis, member_id))
+        if len(calls) == 1:
+            raise RuntimeError("conversion failed")
+
+    monkeypatch.setattr(daemon, "convert_forecast", _fake_convert_forecast)
+
+    daemon.run_daemon(
+        max_hour=0,
+        root_path=tmp_path,
+        poll_interval=0,
+        lookback=datetime.timedelta(days=365 * 100),
+        retry_interval=datetime.timedelta(0),
+        n_workers=1,
+        skip_s3_bucket_upload=True,
+        max_polls=5,
+    )
+
+    assert calls == [(T_ANALYSIS, "CONTROL__dmi")] * 2
+
+
+def test_convert_forecast_matches_cli(tmp_path, monkeypatch, synthetic_refs):
+    """The daemon writes the same stores, station index and report as the CLI."""
+    synthetic_refs()
+    fp_stations = tmp_path / "stations.csv"
+    fp_stations.write_text("name,lat,lon\nodense,55.21,10.38\n")
+    conversion_argv = [
+        "--grid-geometry-cache-path",
+        str(tmp_path / "grid-geometry"),
+        "--point-stores",
+        "--stations",
+        str(fp_stations),
+    ]
+    cli_root = run_cli(tmp_path, monkeypatch, *conversion_argv[2:])
+
+    # the refs exist already, so the GRIB files aren't indexed
+    built_refs = []
+    monkeypatch.setattr(
+        daemon, "build_indexes_and_refs", lambda **kwargs: built_refs.append(kwargs)
+    )
+    daemon_root = tmp_path / "daemon"
+    monkeypatch.setattr(cli_main, "LOCAL_COPY_STORAGE_PATH", daemon_root)
+    with dask_scheduler(n_workers=1):
+        daemon.convert_forecast(
+            t_analysis=T_REFS,
+            member_id="CONTROL__dmi",
+            max_hour=2,
+            n_workers=1,
+            skip_s3_bucket_upload=True,
+            report_path=tmp_path / "reports",
+            prometheus_textfile=None,
+            conversion_argv=conversion_argv,
+        )
+    assert len(built_refs) == 1
+
+    cli_files = sorted(p.relative_to(cli_root) for p in cli_root.rglob("*"))
+    daemon_files = sorted(p.relative_to(daemon_root) for p in daemon_root.rglob("*"))
+    assert daemon_files == cli_files
+    for fp in cli_root.glob("*.zarr"):
+        ds_cli = xr.open_zarr(fp)
+        ds_daemon = xr.open_zarr(daemon_root / fp.name)
+        xr.testing.assert_identical(
+            ds_daemon.drop_attrs(deep=False), ds_cli.drop_attrs(deep=False)
+        )
+        assert ds_daemon.attrs.keys() == ds_cli.attrs.keys()
+    assert (daemon_root / "stations.json").read_text() == (
+        cli_root / "stations.json"
+    ).read_text()
+
+    report_path = run_report_path(T_REFS, tmp_path / "reports", "CONTROL__dmi")
+    stages = {s["stage"] for s in json.loads(report_path.read_text())["stages"]}
+    assert {"build_refs", "build_parts", "write_local"} <= stages
@@ -0,0 +1,121 @@
+"""Tests for zarr_creator.encoding.
+
+Verifies that codec profiles are turned into zarr encodings, and that
+bit-rounded and packed variables round-trip within the expected precision
+(leaving the values that are written intact), including when written with
+rechunker.
+"""
+
+import numcodecs
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+
+from zarr_creator.encoding import CopyingBitRound, apply_codec_profiles, codec_encoding
+from zarr_creator.rechunk import rechunk_to_store
+
+
+def _make_dataset():
+    """Build a synthetic dataset with a continuous field and a fraction."""
+    rng = np.random.default_rng(0)
+    return xr.Dataset(
+        {
+            "t": (("time", "y", "x"), 250 + 50 * rng.random((2, 6, 8), dtype="f4")),
+            "lsm": (("y", "x"), rng.random((6, 8), dtype="f4")),
+        },
+        coords={"time": np.arange(2), "y": np.arange(6), "x": np.arange(8)},
+    )
+
+
+def test_codec_encoding_bitround_filter():
+    """`keepbits` adds a BitRound filter and the Blosc settings are used."""
+    encoding = codec_encoding(
+        dict(cname="lz4", clevel=3, shuffle="bitshuffle", keepbits=7),
+        dtype=np.dtype("float32"),
+    )
+
+    assert encoding["compressor"].cname == "lz4"
+    assert encoding["compressor"].clevel == 3
+    assert encoding["filters"][0].keepbits == 7
+    assert "dtype" not in encoding
+
+
+def test_bitround_filter_leaves_chunk_intact():
+    """The BitRound filter rounds a copy of the chunk and is stored as BitRound."""
+    (bitround,) = codec_encoding(dict(keepbits=3), dtype=np.dtype("float32"))["filters"]
+    chunk = _make_dataset()["t"].values
+    chunk_before = chunk.copy()
+
+    encoded = bitround.encode(chunk)
+
+    np.testing.assert_array_equal(chunk, chunk_before)
+    assert not np.array_equal(encoded.view("f4").reshape(chunk.shape), chunk)
+    assert bitround.get_config() == dict(id="bitround", keepbits=3)
+    # zarr builds the filters from the array metadata, so get the copying
+    # filter from the standard BitRound config
+    assert isinstance(numcodecs.get_codec(bitround.get_config()), CopyingBitRound)
+
+
+def test_bitround_leaves_inputs_of_other_outputs_intact(tmp_path, monkeypatch):
+    """Chunks also used by other outputs aren't changed by bit-rounding."""
+    monkeypatch.setattr(
+        "zarr_creator.encoding.VARIABLE_CODEC_PROFILES", dict(t="bitround12")
+    )
+    ds = _make_dataset()[["t"]].chunk(time=1)
+    values = ds["t"].values
+    # `t_copy` is computed from the same chunks of `t` in the graph
+    ds["t_copy"] = ds["t"] + 0
+
+    apply_codec_profiles(ds).to_zarr(tmp_path / "out.zarr", mode="w")
+
+    ds_read = xr.open_zarr(tmp_path / "out.zarr").load()
+    assert not np.array_equal(ds_read["t"], values)
+    np.testing.assert_array_equal(ds_read["t_copy"], values)
+
+
+def test_codec_encoding_rejects_bitround_of_integers():
+    """Bit-rounding values packed into an integer type is an error."""
+    with pytest.raises(ValueError, match="floating point"):
+        codec_encoding(dict(dtype="uint8", keepbits=4), dtype=np.dtype("float32"))
+
+
+def test_apply_codec_profiles_roundtrip(tmp_path, monkeypatch):
+    """Bit-rounded and packed variables are stored within their precision."""
+    monkeypatch.setattr(
+        "zarr_creator.encoding.VARIABLE_CODEC_PROFILES",
+        dict(t="bitround12", lsm="fraction"),
+    )
+    ds = _make_dataset()
+    ds.attrs["source"] = "test"
+    ds["t"].encoding = {"dtype": "float64"}
+
+    ds_encoded = apply_codec_profiles(ds)
+    # the encoding of the original dataset is left untouched
+    assert ds["t"].encoding == {"dtype": "float64"}
+
+    fp = tmp_path / "out.zarr"
+    ds_encoded.to_zarr(fp, mode="w", consolidated=True)
+
+    assert zarr.open_array(str(fp / "lsm")).dtype == np.uint8
+    ds_read = xr.open_zarr(fp).load()
+    assert not np.array_equal(ds_read["t"], ds["t"])
+    np.testing.assert_allclose(ds_read["t"], ds["t"], rtol=2.0**-12)
+    np.testing.assert_allclose(ds_read["lsm"], ds["lsm"], atol=0.005 + 1e-6)
+
+
+def test_apply_codec_profiles_with_rechunker(tmp_path, monkeypatch):
+    """The codec profiles are also used when writing via rechunker."""
+    monkeypatch.setattr(
+        "zarr_creator.encoding.VARIABLE_CODEC_PROFILES", dict(t="bitround12")
+    )
+    ds = apply_codec_profiles(_make_dataset())
+
+    fp = tmp_path / "out.zarr"
+    rechunk_to_store(
+        ds, chunks=dict(time=1, y=3, x=4), target_store=str(fp), max_mem="1MB"
+    )
+
+    z = zarr.open_array(str(fp / "t"))
+    assert z.filters[0].keepbits == 12
+    assert z.compressor.cname == "zstd"
@@ -0,0 +1,83 @@
+"""Tests for zarr_creator.geometry.
+
+Verifies the cell bounds and rotation angles of the grid geometry, that the
+geometry is only built once per grid, and that output datasets get either a
+copy of or a link to the geometry.
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from zarr_creator import geometry
+
+
+def _make_dataset(angle=0.0, x0=0.0):
+    """Build a synthetic dataset on a small grid rotated by `angle` degrees."""
+    x = x0 + np.arange(4.0)
+    y = np.arange(3.0)
+    xx, yy = np.meshgrid(x, y)
+    a = np.radians(angle)
+    # a small grid near the equator, so that lat/lon are close to cartesian
+    lon = 0.01 * (xx * np.cos(a) - yy * np.sin(a))
+    lat = 0.01 * (xx * np.sin(a) + yy * np.cos(a))
+    ds = xr.Dataset(
+        {
+            "t": (("time", "y", "x"), np.zeros((2, 3, 4), dtype="f4")),
+            "dini_projection": ((), 0, {"crs_wkt": "PROJCRS[...]"}),
+        },
+        coords={
+            "x": x,
+            "y": y,
+            "lat": (("y", "x"), lat, {"units": "degrees_north"}),
+            "lon": (("y", "x"), lon, {"units": "degrees_east"}),
+        },
+    )
+    ds["t"].attrs["grid_mapping"] = "dini_projection"
+    return ds
+
+
+def test_build_grid_geometry_bounds_and_rotation():
+    """Cell corners lie halfway between centres and rotation gives the angle."""
+    ds_geometry = geometry.build_grid_geometry(
+        _make_dataset(angle=30.0), bounds=True, rotation=True
+    )
+
+    np.testing.assert_allclose(ds_geometry["grid_rotation"], 30.0, atol=1e-3)
+    lat = _make_dataset(angle=0.0)["lat"].values
+    ds_geometry = geometry.build_grid_geometry(_make_dataset(), bounds=True)
+    np.testing.assert_allclose(
+        ds_geometry["lat_bounds"].isel(y=1, x=1),
+        lat[1, 1] + 0.005 * np.array([-1, -1, 1, 1]),
+    )
+    assert ds_geometry["lat"].attrs["bounds"] == "lat_bounds"
+    assert ds_geometry["lon_bounds"].attrs["grid_mapping"] == "dini_projection"
+
+
+def test_cached_grid_geometry_built_once_per_grid(tmp_path, monkeypatch):
+    """The geometry is reused for the same grid and built for a new grid."""
+    ds_geometry, fp = geometry.cached_grid_geometry(_make_dataset(), tmp_path)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("grid geometry built again")
+
+    monkeypatch.setattr(geometry, "build_grid_geometry", _fail)
+    ds_cached, fp_cached = geometry.cached_grid_geometry(_make_dataset(), tmp_path)
+    assert fp_cached == fp
+    xr.testing.assert_identical(ds_cached, ds_geometry)
+
+    with pytest.raises(AssertionError, match="built again"):
+        geometry.cached_grid_geometry(_make_dataset(x0=1.0), tmp_path)
+
+
+def test_attach_grid_geometry(tmp_path):
+    """Outputs get a copy of the 2D coordinates or a link to the store."""
+    ds = _make_dataset()
+    ds_geometry, fp = geometry.cached_grid_geometry(ds, tmp_path, rotation=True)
+
+    ds_copy = geometry.attach_grid_geometry(ds.drop_vars(["lat", "lon"]), ds_geometry)
+    assert {"lat", "lon", "grid_rotation"} <= set(ds_copy.coords)
+
+    ds_link = geometry.attach_grid_geometry(ds, ds_geometry, link=str(fp))
+    assert "lat" not in ds_link.coords
+    assert ds_link.attrs["grid_geometry"] == str(fp)
@@ -0,0 +1,162 @@
+"""Tests for GRIB indexing in zarr_creator.indexing.
+
+Verifies that cache keys follow file content, that unchanged files are not
+indexed again, that with a message selection only the selected messages are
+indexed, at their offsets in the GRIB file, and that indexing with a pool of
+worker processes gives the same indexes and refs as in a single process.
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip("gribscan")
+pytest.importorskip("eccodes")
+
+import eccodes  # noqa: E402
+import gribscan  # noqa: E402
+from gribscan.magician import MAGICIANS  # noqa: E402
+
+from zarr_creator import indexing  # noqa: E402
+
+
+def _write_grib(fp, content=b"GRIB" + b"\0" * 200 + b"7777"):
+    """Write a stand-in GRIB file (the content isn't decoded in these tests)."""
+    fp.write_bytes(content)
+    return fp
+
+
+def test_index_cache_key_changes_with_content(tmp_path):
+    """The key is stable for an unchanged file and changes when it is rewritten."""
+    fp = _write_grib(tmp_path / "fc2025030200+000CONTROL__dmi_sf")
+    key = indexing.index_cache_key(fp)
+
+    assert indexing.index_cache_key(fp) == key
+
+    _write_grib(fp, content=b"GRIB" + b"\1" * 200 + b"7777")
+    os.utime(fp, ns=(0, 0))
+    assert indexing.index_cache_key(fp) != key
+
+
+def test_index_files_skips_cached(tmp_path, monkeypatch):
+    """Only files missing from the cache are indexed."""
+    indexed = []
+
+    def _fake_index_file(fp, idxfile=None, selection=None):
+        indexed.append(fp)
+        idxfile.write_text("{}\n")
+        return str(idxfile)
+
+    monkeypatch.setattr(indexing, "_index_file", _fake_index_file)
+
+    grib_files = [
+        _write_grib(tmp_path / f"fc2025030200+{hour:03d}CONTROL__dmi_sf")
+        for hour in range(3)
+    ]
+    cache_path = tmp_path / "cache"
+
+    index_paths = indexing.index_files(grib_files, n_workers=1, cache_path=cache_path)
+    assert indexed == grib_files
+    assert all(os.path.exists(p) for p in index_paths)
+
+    indexed.clear()
+    _write_grib(grib_files[1], content=b"GRIB" + b"\2" * 300 + b"7777")
+    assert indexing.index_files(grib_files, n_workers=1, cache_path=cache_path)[0] == (
+        index_paths[0]
+    )
+    assert indexed == [grib_files[1]]
+
+
+def _grib_message(short_name, level, level_type="heightAboveGround", step=0):
+    """Encode a small GRIB2 message (from the eccodes sample) of a variable."""
+    gid = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        eccodes.codes_set(gid, "typeOfLevel", level_type)
+        eccodes.codes_set(gid, "level", level)
+        eccodes.codes_set(gid, "shortName", short_name)
+        eccodes.codes_set(gid, "stepRange", step)
+        return eccodes.codes_get_message(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+
+def test_scan_gribfile_indexes_selected_messages(tmp_path):
+    """Unselected messages are skipped and selected ones keep their offsets."""
+    messages = [_grib_message("t", 100), _grib_message("t", 50)]
+    # padding between messages is skipped
+    messages += [b"\0" * 7, _grib_message("u", 50), _grib_message("t", 250)]
+    fp = tmp_path / "fc2025030200+000CONTROL__dmi_sf"
+    fp.write_bytes(b"".join(messages))
+    offsets = [sum(len(m) for m in messages[:i]) for i in range(len(messages))]
+
+    with open(fp, "rb") as f:
+        assert [o for o, _ in indexing.split_grib_messages(f)] == [
+            offsets[i] for i in [0, 1, 3, 4]
+        ]
+        f.seek(0)
+        all_records = list(gribscan.scan_gribfile(f, filename=str(fp)))
+
+    selection = {"heightAboveGround": {"t": {50, 250}}}
+    with open(fp, "rb") as f:
+        records = list(indexing._scan_gribfile(f, str(fp), selection=selection))
+
+    assert [(r["_offset"], r["level"]) for r in records] == [
+        (offsets[1], 50),
+        (offsets[4], 250),
+    ]
+    # the records of the selected messages are those of a full scan
+    assert records == [
+        r for r in all_records if r["_offset"] in {offsets[1], offsets[4]}
+    ]
+
+
+def _write_forecast_gribs(root_path, n_hours=4):
+    """Write small GRIB files of the first forecast hours, returning their paths."""
+    grib_files = []
+    for hour in range(n_hours):
+        fp = root_path / f"fc2025030200+{hour:03d}CONTROL__dmi_sf"
+        fp.write_bytes(
+            b"".join(_grib_message("t", level, step=hour) for level in [50, 100])
+        )
+        grib_files.append(fp)
+    return grib_files
+
+
+def _index_with(grib_files, n_workers, cache_path):
+    """Index the files with `n_workers` processes, returning the index contents."""
+    index_paths = indexing.index_files(
+        grib_files,
+        n_workers=n_workers,
+        cache_path=cache_path,
+        selection={"heightAboveGround": {"t": None}},
+    )
+    return index_paths, [open(p).read() for p in index_paths]
+
+
+def test_index_files_with_worker_pool(tmp_path):
+    """Indexing in several worker processes matches indexing in one process."""
+    grib_files = _write_forecast_gribs(tmp_path)
+
+    _, indexes = _index_with(grib_files, n_workers=1, cache_path=tmp_path / "one")
+    _, indexes_pool = _index_with(grib_files, n_workers=3, cache_path=tmp_path / "pool")
+
+    assert all(index.count("\n") == 2 for index in indexes)
+    assert indexes_pool == indexes
+
+
+def test_build_refs_from_worker_pool_indexes(tmp_path):
+    """The refs built from the indexes of a worker pool match a single process."""
+    if "harmonie" not in MAGICIANS:
+        pytest.skip("gribscan without the harmonie magician")
+    grib_files = _write_forecast_gribs(tmp_path)
+
+    refs = {}
+    for n_workers in [1, 3]:
+        index_paths, _ = _index_with(
+            grib_files, n_workers=n_workers, cache_path=tmp_path / f"cache{n_workers}"
+        )
+        refs_path = tmp_path / f"refs{n_workers}"
+        indexing.build_refs(index_paths, refs_path=refs_path, prefix=f"{tmp_path}/")
+        refs[n_workers] = {fp.name: fp.read_text() for fp in refs_path.iterdir()}
+
+    assert refs[1] and refs[3] == refs[1]
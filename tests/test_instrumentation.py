@@ -0,0 +1,156 @@
+"""Tests for zarr_creator.instrumentation.
+
+Verifies that the stages of a run are recorded in the JSON run report and the
+Prometheus textfile, including when the run fails, that the GRIB messages read
+are counted, and that the counters of overlapping stages aren't counted twice
+(nor the dask task stats of later stages lost).
+"""
+
+import datetime
+import json
+import threading
+
+import dask
+import numpy as np
+import pytest
+import xarray as xr
+from dask.callbacks import Callback
+
+from zarr_creator.instrumentation import run_report, run_report_path, stage
+from zarr_creator.read_source import read_level_type_data
+from zarr_creator.write_zarr import write_output_zarrs
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+
+
+def test_run_report_records_write_stage(tmp_path):
+    """Writing a store records its bytes, chunks and dask tasks."""
+    ds = xr.Dataset(
+        {"t": (("time", "y", "x"), np.random.rand(4, 3, 4).astype("f4"))},
+        coords={"time": np.arange(4)},
+    ).chunk(time=1)
+    fp_metrics = tmp_path / "metrics" / "zarr_creator.prom"
+
+    with run_report(
+        T_ANALYSIS, report_path=tmp_path / "reports", prometheus_textfile=fp_metrics
+    ):
+        write_output_zarrs(
+            ds=ds,
+            dataset_id="single_levels",
+            rechunk_to=dict(time=1, y=3, x=2),
+            member="control",
+            t_analysis=T_ANALYSIS,
+            skip_s3_bucket_upload=True,
+            local_copy_path=tmp_path,
+            rechunk_method="memory",
+        )
+
+    report = json.loads(run_report_path(T_ANALYSIS, tmp_path / "reports").read_text())
+    assert report["status"] == "success"
+    (record,) = report["stages"]
+    assert record["stage"] == "write_local"
+    assert record["labels"] == dict(dataset="single_levels", member="control")
+    # 4 x 2 chunks of `t` and one chunk of each coordinate
+    assert record["chunks_written"] == 8 + 1
+    assert record["bytes_written"] > 0
+    assert record["dask"]["n_tasks"] > 0
+    assert record["peak_rss_bytes"] > 0
+
+    metrics = fp_metrics.read_text()
+    assert (
+        'zarr_creator_stage_chunks_written{stage="write_local",'
+        'dataset="single_levels",member="control"} 9'
+    ) in metrics
+    assert "zarr_creator_run_success 1" in metrics
+
+
+def test_run_report_written_for_failed_run(tmp_path):
+    """A failed run still writes its report, with the failed stage."""
+    with pytest.raises(RuntimeError):
+        with run_report(T_ANALYSIS, report_path=tmp_path):
+            with stage("build_parts", member="control"):
+                raise RuntimeError("no refs")
+
+    report = json.loads(run_report_path(T_ANALYSIS, tmp_path).read_text())
+    assert report["status"] == "failed"
+    assert report["stages"][0]["status"] == "failed"
+
+
+def _grib_bytes(refs_path, level_type, var_name):
+    """Bytes of the GRIB messages (refs to byte ranges) of a variable."""
+    refs = json.loads((refs_path / f"{level_type}.json").read_text())["refs"]
+    return sum(
+        ref[2]
+        for key, ref in refs.items()
+        if key.startswith(f"{var_name}/") and isinstance(ref, list)
+    )
+
+
+def _read_variable(ds, var_name, task_prefix):
+    """Load a variable and run a few tasks named `task_prefix`."""
+    ds[var_name].data.compute()
+    tasks = [dask.delayed(abs)(i, dask_key_name=f"{task_prefix}-{i}") for i in range(3)]
+    dask.compute(*tasks, scheduler="threads")
+
+
+def test_stage_counts_grib_bytes_read(tmp_path, synthetic_refs):
+    """The bytes of the GRIB messages read are recorded for the stage and run."""
+    refs_path = synthetic_refs()
+    ds = read_level_type_data(T_ANALYSIS, "isobaricInhPa", refs_path=refs_path)
+
+    with run_report(T_ANALYSIS, report_path=tmp_path, member_id="CONTROL__dmi"):
+        with stage("read", member="control"):
+            _read_variable(ds, "t", task_prefix="alpha")
+
+    report = json.loads(
+        run_report_path(T_ANALYSIS, tmp_path, member_id="CONTROL__dmi").read_text()
+    )
+    (record,) = report["stages"]
+    n_bytes = _grib_bytes(refs_path, "isobaricInhPa", "t")
+    assert n_bytes > 0
+    assert record["grib_bytes_read"] == report["grib_bytes_read"] == n_bytes
+    assert "concurrent" not in record
+    assert record["dask"]["task_time_by_prefix_s"].keys() >= {"alpha"}
+
+
+def test_concurrent_stages_not_counted_twice(tmp_path, synthetic_refs):
+    """Overlapping stages are marked concurrent and the run counts bytes once."""
+    refs_path = synthetic_refs()
+    ds = read_level_type_data(T_ANALYSIS, "isobaricInhPa", refs_path=refs_path)
+    barrier = threading.Barrier(2)
+
+    def _run_stage(var_name):
+        with stage("read", variable=var_name):
+            # both stages have started before either reads
+            barrier.wait()
+            _read_variable(ds, var_name, task_prefix=f"read_{var_name}")
+            barrier.wait()
+
+    with run_report(T_ANALYSIS, report_path=tmp_path) as report:
+        threads = [threading.Thread(target=_run_stage, args=(v,)) for v in "tu"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    report = report.to_dict()
+    assert len(report["stages"]) == 2
+    for record in report["stages"]:
+        assert record["concurrent"] is True
+        assert not record.keys() & {"bytes_read", "grib_bytes_read", "dask"}
+    assert report["grib_bytes_read"] == sum(
+        _grib_bytes(refs_path, "isobaricInhPa", v) for v in "tu"
+    )
+
+
+def test_task_stats_recorded_after_callbacks_dropped(monkeypatch):
+    """Tasks are counted after computations in other threads dropped the callbacks."""
+    # computations running at the same time in several threads can restore
+    # the registered callbacks to those of another thread, without ours
+    monkeypatch.setattr(Callback, "active", set())
+
+    with stage("compute") as record:
+        tasks = [dask.delayed(abs)(i, dask_key_name=f"alpha-{i}") for i in range(3)]
+        dask.compute(*tasks, scheduler="threads")
+
+    assert record["dask"]["task_time_by_prefix_s"].keys() >= {"alpha"}
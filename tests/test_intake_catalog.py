@@ -4,7 +4,7 @@ from pathlib import Path
 
 import pytest
 
-from zarr_creator import open_intake_catalog
+from zarr_creator import forecast_source, open_intake_catalog
 
 
 def _catalog_path() -> Path:
@@ -20,6 +20,16 @@ def _latest_available_analysis_time(now: datetime | None = None) -> datetime:
     return lagged.replace(hour=rounded_hour, minute=0, second=0, microsecond=0)
 
 
+def _source_urlpath(source) -> str | None:
+    reader_kwargs = getattr(getattr(source, "reader", None), "kwargs", {}) or {}
+    reader_args = reader_kwargs.get("args")
+    urlpath = None
+    if isinstance(reader_args, tuple):
+        if len(reader_args) >= 1:
+            urlpath = getattr(reader_args[0], "url", None)
+    return urlpath
+
+
 def test_intake_catalog_accepts_datetime_analysis_time():
     pytest.importorskip("intake")
     pytest.importorskip("intake_xarray")
@@ -29,12 +39,7 @@ def test_intake_catalog_accepts_datetime_analysis_time():
     source_template = catalog["height_levels"]
     source = source_template._entry(analysis_time=analysis_time)
 
-    reader_kwargs = getattr(getattr(source, "reader", None), "kwargs", {}) or {}
-    reader_args = reader_kwargs.get("args")
-    urlpath = None
-    if isinstance(reader_args, tuple):
-        if len(reader_args) >= 1:
-            urlpath = getattr(reader_args[0], "url", None)
+    urlpath = _source_urlpath(source)
 
     expected_time = analysis_time.strftime("%Y-%m-%dT%H%M%SZ")
 
@@ -43,6 +48,21 @@ def test_intake_catalog_accepts_datetime_analysis_time():
     assert urlpath.endswith("/height_levels.zarr/")
 
 
+def test_forecast_source_sets_analysis_time():
+    """`forecast_source` opens the catalog source of the given analysis time."""
+    pytest.importorskip("intake")
+    pytest.importorskip("intake_xarray")
+
+    analysis_time = datetime(2025, 2, 17, 3, tzinfo=timezone.utc)
+    source = forecast_source(
+        "pressure_levels", analysis_time=analysis_time, catalog_path=_catalog_path()
+    )
+
+    urlpath = _source_urlpath(source)
+    assert isinstance(urlpath, str)
+    assert urlpath.endswith("/2025-02-17T030000Z/pressure_levels.zarr/")
+
+
 @pytest.mark.integration
 def test_intake_catalog_to_dask_reads_remote_dataset():
     if os.getenv("RUN_INTAKE_S3_INTEGRATION", "").lower() not in {"1", "true", "yes"}:
@@ -0,0 +1,134 @@
+"""Tests for zarr_creator.inventory.
+
+Verifies that queries select the matching inventory entries, and that
+publishing a store to a local S3 stand-in adds it to the inventory at the
+bucket root, where `find_forecasts` and `latest_analysis_time` find it, and
+that concurrent updates of the inventory don't lose entries.
+"""
+
+import contextlib
+import datetime
+import json
+
+import numpy as np
+import xarray as xr
+
+from zarr_creator import (
+    find_forecasts,
+    inventory,
+    latest_analysis_time,
+    publish,
+    write_zarr,
+)
+from zarr_creator.inventory import query_inventory
+from zarr_creator.write_zarr import write_output_zarrs
+
+
+def _entry(analysis_time, dataset_id="single_levels", lead_times=(0, 1, 2)):
+    """Build an inventory entry with the fields used in queries."""
+    return dict(
+        analysis_time=analysis_time,
+        member="control",
+        dataset_id=dataset_id,
+        variables=["t2m", "u10m"],
+        lead_times=list(lead_times),
+    )
+
+
+def test_query_inventory():
+    """Entries are selected by dataset, time range, variables and lead time."""
+    entries = [
+        _entry("2025-02-17T06:00:00Z"),
+        _entry("2025-02-17T00:00:00Z"),
+        _entry("2025-02-17T03:00:00Z", dataset_id="pressure_levels"),
+        _entry("2025-02-17T09:00:00Z", lead_times=[0]),
+    ]
+    t_start = datetime.datetime(2025, 2, 17, 0, tzinfo=datetime.timezone.utc)
+
+    selected = query_inventory(
+        entries,
+        dataset_id="single_levels",
+        start=t_start,
+        end=t_start + datetime.timedelta(hours=6),
+        variables=["t2m"],
+    )
+    assert [e["analysis_time"] for e in selected] == [
+        "2025-02-17T00:00:00Z",
+        "2025-02-17T06:00:00Z",
+    ]
+    assert len(query_inventory(entries, min_lead_time=2)) == 3
+    assert query_inventory(entries, variables=["cape"]) == []
+
+
+def test_inventory_updated_on_publish(tmp_path, s3_bucket):
+    """Publishing stores to S3 adds them to the inventory at the bucket root."""
+    for hour in [0, 3]:
+        t_analysis = datetime.datetime(2025, 2, 17, hour, tzinfo=datetime.timezone.utc)
+        ds = xr.Dataset(
+            {"t2m": (("time", "y", "x"), np.zeros((2, 3, 4), dtype="f4"))},
+            coords={
+                "time": [
+                    np.datetime64(t_analysis.replace(tzinfo=None), "ns")
+                    + np.timedelta64(h, "h")
+                    for h in range(2)
+                ]
+            },
+        )
+        write_output_zarrs(
+            ds=ds,
+            dataset_id="single_levels",
+            rechunk_to=dict(time=1, y=3, x=4),
+            member="control",
+            t_analysis=t_analysis,
+            local_copy_path=tmp_path / f"{hour:02d}",
+        )
+
+    entries = find_forecasts(dataset_id="single_levels", storage_options=s3_bucket)
+    assert [e["analysis_time"] for e in entries] == [
+        "2025-02-17T00:00:00Z",
+        "2025-02-17T03:00:00Z",
+    ]
+    assert entries[-1]["url"] == write_zarr.output_url(
+        member="control", t_analysis=t_analysis, dataset_id="single_levels"
+    )
+    assert entries[-1]["lead_times"] == [0.0, 1.0]
+    assert entries[-1]["variables"] == ["t2m"]
+    assert entries[-1]["nbytes"] > 0
+    assert (
+        latest_analysis_time("single_levels", storage_options=s3_bucket) == t_analysis
+    )
+
+
+def test_concurrent_inventory_updates(s3_bucket, monkeypatch):
+    """An update racing with another writer is retried rather than lost."""
+    # as for writers in separate processes, which don't share the lock
+    monkeypatch.setattr(inventory, "_update_lock", contextlib.nullcontext())
+    url = write_zarr.INVENTORY_URL
+    read_versioned = publish._read_versioned
+    # another writer updates the inventory between the first read and the
+    # write (while creating it), and again on the retry (while replacing it)
+    racing_entries = {1: "2025-02-17T03:00:00Z", 3: "2025-02-17T06:00:00Z"}
+    n_reads = []
+
+    def _read_and_race(fs, path):
+        data, etag = read_versioned(fs, path)
+        n_reads.append(0 if data is None else len(json.loads(data)["datasets"]))
+        if len(n_reads) in racing_entries:
+            inventory.update_inventory(
+                _entry(racing_entries[len(n_reads)]), url=url, storage_options=s3_bucket
+            )
+        return data, etag
+
+    monkeypatch.setattr(publish, "_read_versioned", _read_and_race)
+    inventory.update_inventory(
+        _entry("2025-02-17T00:00:00Z"), url=url, storage_options=s3_bucket
+    )
+
+    entries = inventory.read_inventory(url, storage_options=s3_bucket)
+    assert [e["analysis_time"] for e in entries] == [
+        "2025-02-17T00:00:00Z",
+        "2025-02-17T03:00:00Z",
+        "2025-02-17T06:00:00Z",
+    ]
+    # the numbers of entries read by the two writers and their retries
+    assert n_reads == [0, 0, 1, 1, 2]
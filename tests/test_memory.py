@@ -0,0 +1,129 @@
+"""Tests for zarr_creator.memory.
+
+Verifies that a bounded write produces the same store as an unbounded one in
+batches sized to the memory budget, and that going over the budget fails with
+an error describing what was being written, also when the tasks run on the
+workers of a `dask.distributed.LocalCluster` as in a run with a memory limit.
+"""
+
+import datetime
+
+import dask.array
+import numpy as np
+import pytest
+import xarray as xr
+
+from zarr_creator import memory
+from zarr_creator.memory import (
+    MemoryBudgetExceeded,
+    batch_size,
+    memory_guard,
+    worker_memory_limit,
+    write_bounded,
+)
+from zarr_creator.scheduler import dask_scheduler
+from zarr_creator.write_zarr import write_output_zarrs
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+CHUNKS = dict(time=1, y=3, x=2)
+
+
+def _make_dataset(n_times=8):
+    """Build a synthetic dataset with a time-varying field and a static field."""
+    return xr.Dataset(
+        {
+            "t": (
+                ("time", "y", "x"),
+                np.arange(n_times * 3 * 4, dtype="f4").reshape(n_times, 3, 4),
+            ),
+            "lsm": (("y", "x"), np.ones((3, 4), dtype="f4")),
+        },
+        coords={"time": np.arange(n_times), "y": np.arange(3), "x": np.arange(4)},
+    ).chunk(time=1)
+
+
+def test_write_bounded_in_batches(tmp_path, monkeypatch):
+    """The store is written in batches and matches an unbounded write."""
+    ds = _make_dataset()
+    # leave 300 bytes of the budget for data: each timestep of `t` is 48
+    # bytes, so with 3 copies in flight two timesteps fit in a batch
+    monkeypatch.setattr(memory, "PARENT_MEMORY_FRACTION", 0.0)
+    monkeypatch.setattr(memory, "BATCH_MEMORY_FRACTION", 300 / 64e9)
+    assert batch_size(ds, CHUNKS, dim="time", memory_limit="64GB") == 2
+
+    n_batches = write_bounded(
+        ds, target=str(tmp_path / "ds.zarr"), chunks=CHUNKS, memory_limit="64GB"
+    )
+
+    # 4 batches of `t` plus the static `lsm`
+    assert n_batches == 5
+    xr.testing.assert_identical(xr.open_zarr(tmp_path / "ds.zarr").load(), ds.load())
+
+
+def test_write_output_zarrs_with_memory_limit(tmp_path, monkeypatch):
+    """write_output_zarrs with a memory limit writes the same local copy."""
+    ds = _make_dataset()
+    monkeypatch.setattr(memory, "PARENT_MEMORY_FRACTION", 0.0)
+    monkeypatch.setattr(memory, "BATCH_MEMORY_FRACTION", 300 / 64e9)
+
+    for name, memory_limit in [("bounded", "64GB"), ("unbounded", None)]:
+        write_output_zarrs(
+            ds=ds,
+            dataset_id="single_levels",
+            rechunk_to=CHUNKS,
+            member="control",
+            t_analysis=T_ANALYSIS,
+            skip_s3_bucket_upload=True,
+            local_copy_path=tmp_path / name,
+            memory_limit=memory_limit,
+        )
+
+    ds_bounded = xr.open_zarr(tmp_path / "bounded" / "single_levels.zarr")
+    ds_unbounded = xr.open_zarr(tmp_path / "unbounded" / "single_levels.zarr")
+    xr.testing.assert_identical(ds_bounded.load(), ds_unbounded.load())
+    assert ds_bounded["t"].encoding["chunks"] == (1, 3, 2)
+
+
+def test_chunk_larger_than_budget():
+    """A budget too small for a single chunk fails before writing."""
+    with pytest.raises(MemoryBudgetExceeded, match="one `time` chunk"):
+        batch_size(_make_dataset(), CHUNKS, dim="time", memory_limit="100B")
+
+
+def test_memory_guard_over_budget():
+    """Going over the budget stops the computation with a diagnosable error."""
+    with pytest.raises(MemoryBudgetExceeded, match="while writing test.zarr"):
+        with memory_guard("1MB", description="writing test.zarr"):
+            dask.array.ones((4, 4), chunks=2).sum().compute()
+
+
+def test_worker_memory_limit_reserves_parent_memory():
+    """The workers share the budget left after reserving this process' part."""
+    assert worker_memory_limit("16GB", n_workers=4) == 3e9
+    # 600 * 0.75 * 0.5 bytes for data fit one timestep of `t` (3 x 48 bytes)
+    assert batch_size(_make_dataset(), CHUNKS, dim="time", memory_limit="600B") == 1
+
+
+def test_write_bounded_over_budget_with_local_cluster(tmp_path, monkeypatch):
+    """The budget stops a batched write on `dask.distributed` workers."""
+    pytest.importorskip("distributed")
+    fp = tmp_path / "ds.zarr"
+    # one timestep per batch
+    monkeypatch.setattr(
+        memory,
+        "BATCH_MEMORY_FRACTION",
+        200 / (10e6 * (1 - memory.PARENT_MEMORY_FRACTION)),
+    )
+    # the cluster gets a generous budget so that dask doesn't pause its
+    # workers, the write a budget that the process tree is already over
+    with dask_scheduler(n_workers=1, memory_limit="8GB"):
+        with pytest.raises(MemoryBudgetExceeded, match="in batches of 1"):
+            write_bounded(
+                _make_dataset(), target=str(fp), chunks=CHUNKS, memory_limit="10MB"
+            )
+
+    # stopped after the first batch rather than once all were written
+    assert sorted(p.name for p in (fp / "t").iterdir() if p.name[0] != ".") == [
+        "0.0.0",
+        "0.0.1",
+    ]
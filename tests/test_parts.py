@@ -0,0 +1,61 @@
+"""Tests for zarr_creator.parts.
+
+Verifies that derived variables are named like GRIB variables in a part, and
+that the parts of several members are stacked along a `member` dimension,
+with the static fields kept without it.
+"""
+
+import numpy as np
+import xarray as xr
+
+from zarr_creator.parts import build_part, stack_members
+
+
+def _make_part(value):
+    """Build a synthetic part with a time-varying field and a static field."""
+    return xr.Dataset(
+        {
+            "t2m": (("time", "y", "x"), np.full((2, 3, 4), value, dtype="f4")),
+            "lsm": (("y", "x"), np.ones((3, 4), dtype="f4")),
+        },
+        coords={"time": np.arange(2), "y": np.arange(3), "x": np.arange(4)},
+    )
+
+
+def test_stack_members():
+    """Time-varying fields get a member dimension, static fields don't."""
+    ds = stack_members({"control": _make_part(0.0), "mbr001": _make_part(1.0)})
+
+    assert list(ds["member"].values) == ["control", "mbr001"]
+    assert ds["t2m"].dims == ("member", "time", "y", "x")
+    assert ds["lsm"].dims == ("y", "x")
+    np.testing.assert_array_equal(ds["t2m"].mean(["time", "y", "x"]), [0.0, 1.0])
+
+
+def test_build_part_with_derived_variables():
+    """Derived variables are selected by level and named with the mapping."""
+    dims = ("time", "level", "y", "x")
+    ds_level_type = xr.Dataset(
+        {
+            "u": (dims, np.full((2, 2, 3, 4), 3.0, dtype="f4")),
+            "v": (dims, np.full((2, 2, 3, 4), 4.0, dtype="f4")),
+        },
+        coords={"time": np.arange(2), "level": [10, 100]},
+    )
+    part_details = [
+        dict(
+            level_type="heightAboveGround",
+            variables={"u": [10]},
+            derived_variables={"ws": [10]},
+            level_name_mapping="{var_name}{level:d}m",
+        )
+    ]
+
+    ds = build_part(
+        part_details,
+        t_analysis=None,
+        read_level_type_data=lambda **kwargs: ds_level_type,
+    )
+
+    assert set(ds.data_vars) == {"u10m", "ws10m"}
+    np.testing.assert_allclose(ds["ws10m"], 5.0)
@@ -0,0 +1,88 @@
+"""Tests for zarr_creator.points.
+
+Verifies that the point stores are created from the map stores with the full
+time axis in each chunk, and that stations are indexed to their nearest grid
+point and point store tiles.
+"""
+
+import datetime
+
+import numpy as np
+import xarray as xr
+
+from zarr_creator.points import (
+    build_station_index,
+    open_map_store,
+    point_dataset_id,
+    read_stations,
+)
+from zarr_creator.rechunk import resolve_chunks
+from zarr_creator.write_zarr import write_output_zarrs
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+
+
+def _make_geometry():
+    """Build a synthetic 0.1 degree lat/lon grid geometry."""
+    lon, lat = np.meshgrid(10.0 + 0.1 * np.arange(6), 55.0 + 0.1 * np.arange(5))
+    return xr.Dataset(
+        coords={
+            "x": np.arange(6),
+            "y": np.arange(5),
+            "lat": (("y", "x"), lat),
+            "lon": (("y", "x"), lon),
+        }
+    )
+
+
+def test_build_station_index(tmp_path):
+    """Stations get the indices, tiles and distance of the nearest grid point."""
+    fp_stations = tmp_path / "stations.csv"
+    fp_stations.write_text("name,lat,lon\nodense,55.39,10.38\ncorner,55.0,10.0\n")
+
+    station_index = build_station_index(
+        read_stations(fp_stations),
+        _make_geometry(),
+        tiles={"single_levels_points": dict(y=2, x=2)},
+    )
+
+    odense, corner = station_index["stations"]
+    assert (odense["y"], odense["x"]) == (4, 4)
+    assert odense["tiles"] == {"single_levels_points": dict(y=2, x=2)}
+    assert odense["grid_lat"] == 55.4
+    # 0.01 degrees latitude and 0.02 degrees longitude at 55.4N
+    np.testing.assert_allclose(odense["distance_km"], 1.68, atol=0.01)
+    assert (corner["y"], corner["x"], corner["distance_km"]) == (0, 0, 0.0)
+
+
+def test_point_store_from_map_store(tmp_path):
+    """The point store holds the map store's data with full time axis chunks."""
+    ds = xr.Dataset(
+        {"t": (("time", "y", "x"), np.random.rand(4, 5, 6).astype("f4"))},
+        coords={"time": np.arange(4), "y": np.arange(5), "x": np.arange(6)},
+    )
+    write_kwargs = dict(
+        member="control",
+        t_analysis=T_ANALYSIS,
+        skip_s3_bucket_upload=True,
+        local_copy_path=tmp_path,
+        rechunk_method="memory",
+    )
+    write_output_zarrs(
+        ds=ds,
+        dataset_id="single_levels",
+        rechunk_to=dict(time=1, x=3, y=5),
+        **write_kwargs,
+    )
+
+    ds_map = open_map_store(tmp_path / "single_levels.zarr")
+    write_output_zarrs(
+        ds=ds_map,
+        dataset_id=point_dataset_id("single_levels"),
+        rechunk_to=resolve_chunks(ds_map, dict(time=None, x=4, y=2)),
+        **write_kwargs,
+    )
+
+    ds_points = xr.open_zarr(tmp_path / "single_levels_points.zarr")
+    assert ds_points["t"].encoding["chunks"] == (4, 2, 4)
+    xr.testing.assert_equal(ds_points.load(), ds)
@@ -0,0 +1,160 @@
+"""Tests for zarr_creator.publish.
+
+Verifies that output stores are written to a staging directory and moved into
+place when complete, that published stores in S3 are replaced in place, and
+that the publish marker is written last.
+"""
+
+import datetime
+
+import fsspec
+import numpy as np
+import pytest
+import xarray as xr
+from fsspec.implementations.memory import MemoryFileSystem
+
+from zarr_creator import write_zarr
+from zarr_creator.publish import publish_local_store, read_publish_marker, staging_path
+from zarr_creator.write_zarr import copy_zarr_store, write_output_zarrs
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+
+
+def _make_dataset(n_times=2, value=0.0):
+    """Build a small synthetic (time, y, x) dataset."""
+    return xr.Dataset(
+        {"t": (("time", "y", "x"), np.full((n_times, 3, 4), value, dtype="f4"))},
+        coords={"time": np.arange(n_times), "y": np.arange(3), "x": np.arange(4)},
+    )
+
+
+def _write(ds, local_copy_path):
+    """Write `ds` as the `single_levels` part without uploading to S3."""
+    write_output_zarrs(
+        ds=ds,
+        dataset_id="single_levels",
+        rechunk_to=dict(time=1),
+        member="control",
+        t_analysis=T_ANALYSIS,
+        skip_s3_bucket_upload=True,
+        local_copy_path=local_copy_path,
+    )
+
+
+def test_publish_local_store_replaces_target(tmp_path):
+    """The staged store replaces the previous one and nothing is left over."""
+    fp_target = tmp_path / "out.zarr"
+    _make_dataset(value=1.0).to_zarr(fp_target)
+
+    fp_staging = staging_path(fp_target)
+    _make_dataset(value=2.0).to_zarr(fp_staging, mode="w")
+    publish_local_store(fp_staging=fp_staging, fp_target=fp_target)
+
+    assert xr.open_zarr(fp_target)["t"].values.min() == 2.0
+    assert [p.name for p in tmp_path.iterdir()] == ["out.zarr"]
+
+
+def test_write_output_zarrs_writes_publish_marker(tmp_path):
+    """Published stores have a marker recording their dimension sizes."""
+    fp_store = tmp_path / "single_levels.zarr"
+    assert read_publish_marker(str(fp_store)) is None
+
+    _write(_make_dataset(n_times=2), local_copy_path=tmp_path)
+    assert read_publish_marker(str(fp_store))["dims"]["time"] == 2
+
+    _write(_make_dataset(n_times=3), local_copy_path=tmp_path)
+    assert read_publish_marker(str(fp_store))["dims"]["time"] == 3
+    assert [p.name for p in tmp_path.iterdir()] == ["single_levels.zarr"]
+
+
+def test_failed_write_keeps_published_store(tmp_path):
+    """A write that fails leaves the previously published store in place."""
+    _write(_make_dataset(value=1.0), local_copy_path=tmp_path)
+
+    ds_bad = _make_dataset(value=2.0)
+    da = ds_bad["t"].chunk(time=1)
+    ds_bad["t"] = (da.dims, da.data.map_blocks(_raise, dtype=da.dtype))
+    with pytest.raises(RuntimeError, match="failed"):
+        _write(ds_bad, local_copy_path=tmp_path)
+
+    fp_store = tmp_path / "single_levels.zarr"
+    assert xr.open_zarr(fp_store)["t"].values.min() == 1.0
+    assert read_publish_marker(str(fp_store)) is not None
+    assert [p.name for p in tmp_path.iterdir()] == ["single_levels.zarr"]
+
+
+def _raise(block):
+    raise RuntimeError("failed")
+
+
+def test_copy_zarr_store_copies_publish_marker(tmp_path):
+    """The publish marker of the source store is copied to the target."""
+    _write(_make_dataset(), local_copy_path=tmp_path)
+
+    dst = "memory://publish-marker/single_levels.zarr"
+    copy_zarr_store(src=str(tmp_path / "single_levels.zarr"), dst=dst)
+
+    assert read_publish_marker(dst) == read_publish_marker(
+        str(tmp_path / "single_levels.zarr")
+    )
+
+
+def test_copy_zarr_store_replaces_published_store_in_place(tmp_path, monkeypatch):
+    """A republished store is overwritten key by key, with the marker last."""
+    fp_store = tmp_path / "single_levels.zarr"
+    dst = "memory://publish-in-place/single_levels.zarr"
+    _write(_make_dataset(n_times=3, value=1.0), local_copy_path=tmp_path)
+    copy_zarr_store(src=str(fp_store), dst=dst)
+
+    operations = []
+    pipe_file, rm = MemoryFileSystem.pipe_file, MemoryFileSystem.rm
+
+    def _pipe_file(self, path, *args, **kwargs):
+        operations.append(("write", path.rsplit("/", 1)[-1]))
+        return pipe_file(self, path, *args, **kwargs)
+
+    def _rm(self, path, *args, **kwargs):
+        for fp in [path] if isinstance(path, str) else path:
+            operations.append(("rm", fp.rsplit("/", 1)[-1]))
+        return rm(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(MemoryFileSystem, "pipe_file", _pipe_file)
+    monkeypatch.setattr(MemoryFileSystem, "rm", _rm)
+    _write(_make_dataset(n_times=2, value=2.0), local_copy_path=tmp_path)
+    copy_zarr_store(src=str(fp_store), dst=dst)
+
+    # neither the store nor its marker are removed before being replaced,
+    # the chunk beyond the new shape is only removed once the metadata no
+    # longer references it
+    removed = [key for op, key in operations if op == "rm"]
+    assert removed == ["2.0.0"]
+    assert operations.index(("write", ".zmetadata")) < operations.index(("rm", "2.0.0"))
+    assert operations[-1] == ("write", "_published.json")
+
+    ds = xr.open_zarr(dst)
+    assert ds["t"].values.min() == 2.0
+    assert read_publish_marker(dst)["dims"]["time"] == 2
+
+
+def test_write_output_zarrs_to_s3_replaces_published_store(tmp_path, s3_bucket):
+    """Writing directly to S3 replaces the published store via a staging prefix."""
+    url = write_zarr.output_url(
+        member="control", t_analysis=T_ANALYSIS, dataset_id="single_levels"
+    )
+    fs = fsspec.filesystem("s3", **s3_bucket)
+
+    for n_times, value in [(3, 1.0), (2, 2.0)]:
+        write_output_zarrs(
+            ds=_make_dataset(n_times=n_times, value=value),
+            dataset_id="single_levels",
+            rechunk_to=dict(time=1),
+            member="control",
+            t_analysis=T_ANALYSIS,
+            local_copy_path=None,
+        )
+
+    ds = xr.open_zarr(fs.get_mapper(url))
+    assert ds["t"].values.min() == 2.0
+    assert read_publish_marker(url, storage_options=s3_bucket)["dims"]["time"] == 2
+    assert not fs.exists(f"{url}/t/2.0.0")
+    assert not fs.exists(f"{url}.staging")
@@ -0,0 +1,88 @@
+"""Tests for zarr_creator.read_source.
+
+Verifies that `LevelTypeDataReader` reads each level type from its refs (and
+only parses each once), that a level type without refs gives a clear
+error, and that the GRIB messages are read through the block cache and the
+cache is cleared.
+"""
+
+import numpy as np
+import pytest
+
+from zarr_creator.read_source import (
+    LevelTypeDataReader,
+    clear_block_cache,
+    read_level_type_data,
+)
+
+from .conftest import T_ANALYSIS, level_type_variables
+
+
+def test_reader_reads_each_level_type(synthetic_refs):
+    """Each level type is read with its variables and parsed only once."""
+    synthetic_refs(member_id="MBR001__dmi")
+    read_level_type_data = LevelTypeDataReader()
+
+    for level_type, variables in level_type_variables().items():
+        ds = read_level_type_data(
+            t_analysis=T_ANALYSIS, level_type=level_type, member_id="MBR001__dmi"
+        )
+        assert set(variables) <= set(ds.data_vars)
+        assert ds.sizes["time"] == 3
+        assert ds.time.attrs["standard_name"] == "time"
+        for var_name in variables:
+            assert ds[var_name].attrs["grid_mapping"] == "dini_projection"
+    assert read_level_type_data.n_hits == 0
+
+    ds = read_level_type_data(
+        t_analysis=T_ANALYSIS, level_type="isobaricInhPa", member_id="MBR001__dmi"
+    )
+    ds.attrs["changed"] = True
+    ds_again = read_level_type_data(
+        t_analysis=T_ANALYSIS, level_type="isobaricInhPa", member_id="MBR001__dmi"
+    )
+    assert read_level_type_data.n_hits == 2
+    assert "changed" not in ds_again.attrs
+    np.testing.assert_array_equal(ds.t.values, ds_again.t.values)
+
+
+def test_reader_missing_level_type(synthetic_refs):
+    """Reading a level type without refs names it and the level types found."""
+    refs_path = synthetic_refs()
+    read_level_type_data = LevelTypeDataReader()
+
+    with pytest.raises(FileNotFoundError, match="`isothermal`.*'heightAboveGround'"):
+        read_level_type_data(
+            t_analysis=T_ANALYSIS, level_type="isothermal", refs_path=refs_path
+        )
+
+
+def test_block_cache_used_and_cleared(tmp_path, synthetic_refs):
+    """GRIB messages are served from the block cache until it is cleared."""
+    refs_path = synthetic_refs()
+    fp_cache = tmp_path / "block-cache"
+
+    def _read(block_cache_path):
+        ds = read_level_type_data(
+            t_analysis=T_ANALYSIS,
+            level_type="isobaricInhPa",
+            refs_path=refs_path,
+            block_cache_path=block_cache_path,
+        )
+        return ds.t.values
+
+    values = _read(block_cache_path=None)
+    np.testing.assert_array_equal(_read(block_cache_path=str(fp_cache)), values)
+    assert any(p.is_file() for p in fp_cache.iterdir())
+
+    # with the GRIB file (standing in for the source bucket) zeroed, the
+    # messages already read are still served from the cache
+    fp_grib = refs_path / "isobaricInhPa.grib"
+    fp_grib.write_bytes(bytes(fp_grib.stat().st_size))
+    np.testing.assert_array_equal(_read(block_cache_path=str(fp_cache)), values)
+
+    clear_block_cache(str(fp_cache))
+    assert not fp_cache.exists()
+    # a new cache is started in the same directory, reading the GRIB file
+    assert (_read(block_cache_path=str(fp_cache)) == 0).all()
+    assert fp_cache.exists()
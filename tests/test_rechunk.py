@@ -0,0 +1,73 @@
+"""Tests for zarr_creator.rechunk.
+
+Verifies resolution of chunking specifications, selection of the rechunk
+method and that both rechunk methods write the requested chunks.
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from zarr_creator.rechunk import (
+    choose_rechunk_method,
+    rechunk_in_memory,
+    rechunk_to_store,
+    resolve_chunks,
+)
+
+
+def _make_dataset():
+    """Build a synthetic dataset chunked one timestep at a time."""
+    ds = xr.Dataset(
+        {
+            "t": (("time", "y", "x"), np.random.rand(4, 6, 8).astype("f4")),
+            "lsm": (("y", "x"), np.zeros((6, 8))),
+            "dini_projection": xr.DataArray(),
+        },
+        coords={"time": np.arange(4), "y": np.arange(6), "x": np.arange(8)},
+    )
+    return ds.chunk(dict(time=1))
+
+
+def test_resolve_chunks_sizes_and_fractions():
+    """Integers are used as-is, floats are fractions and missing dims unchunked."""
+    chunks = resolve_chunks(_make_dataset(), dict(time=1, x=0.5))
+
+    assert chunks == dict(time=1, y=6, x=4)
+
+
+def test_resolve_chunks_limits_to_dim_size():
+    """Chunk sizes larger than the dimension are reduced with a warning."""
+    with pytest.warns(UserWarning):
+        chunks = resolve_chunks(_make_dataset(), dict(time=10))
+
+    assert chunks["time"] == 4
+
+
+def test_choose_rechunk_method_auto():
+    """`auto` picks the in-memory method only if the dataset fits in max_mem."""
+    ds = _make_dataset()
+
+    assert choose_rechunk_method(ds, method="auto", max_mem="1MB") == "memory"
+    assert choose_rechunk_method(ds, method="auto", max_mem="100B") == "rechunker"
+    assert choose_rechunk_method(ds, method="rechunker", max_mem="1MB") == "rechunker"
+
+
+@pytest.mark.parametrize("method", ["memory", "rechunker"])
+def test_rechunk_writes_target_chunks(tmp_path, method):
+    """Both methods write a store with the target chunks and unchanged values."""
+    ds = _make_dataset()
+    chunks = dict(time=2, y=3, x=4)
+    fp = tmp_path / "out.zarr"
+
+    if method == "memory":
+        rechunk_in_memory(ds, chunks).to_zarr(fp, consolidated=True)
+    else:
+        rechunk_to_store(
+            ds, chunks=chunks, target_store=str(fp), max_mem="1MB", temp_path=tmp_path
+        )
+
+    ds_out = xr.open_zarr(fp)
+    assert ds_out.t.encoding["chunks"] == (2, 3, 4)
+    assert ds_out.lsm.encoding["chunks"] == (3, 4)
+    np.testing.assert_array_equal(ds_out.t.values, ds.t.values)
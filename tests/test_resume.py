@@ -0,0 +1,152 @@
+"""Tests for zarr_creator.resume.
+
+Verifies that the missing regions of an interrupted write are found and that
+resuming a write only computes and writes the chunks that are missing.
+"""
+
+import datetime
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+from zarr_creator.encoding import apply_codec_profiles
+from zarr_creator.publish import read_publish_marker, staging_path
+from zarr_creator.resume import is_resumable, missing_regions
+from zarr_creator.write_zarr import copy_zarr_store, write_output_zarrs
+
+T_ANALYSIS = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+CHUNKS = dict(time=1, y=3, x=2)
+
+
+def _make_dataset(n_times=4):
+    """Build a synthetic dataset with a time-varying field and a static field."""
+    return xr.Dataset(
+        {
+            "t": (
+                ("time", "y", "x"),
+                np.arange(n_times * 3 * 4, dtype="f4").reshape(n_times, 3, 4),
+            ),
+            "lsm": (("y", "x"), np.ones((3, 4), dtype="f4")),
+        },
+        coords={"time": np.arange(n_times), "y": np.arange(3), "x": np.arange(4)},
+    )
+
+
+def _fail_after(ds, n_times):
+    """Make computing `t` fail for all timesteps from `n_times` onwards."""
+
+    def _maybe_raise(block, block_info=None):
+        if block_info[0]["array-location"][0][0] >= n_times:
+            raise RuntimeError("interrupted")
+        return block
+
+    ds = ds.copy()
+    da = ds["t"].chunk(time=1)
+    ds["t"] = (da.dims, da.data.map_blocks(_maybe_raise, dtype=da.dtype))
+    return ds
+
+
+def _write(ds, local_copy_path, resume=True):
+    """Write `ds` as the `single_levels` part without uploading to S3."""
+    write_output_zarrs(
+        ds=ds,
+        dataset_id="single_levels",
+        rechunk_to=CHUNKS,
+        member="control",
+        t_analysis=T_ANALYSIS,
+        skip_s3_bucket_upload=True,
+        local_copy_path=local_copy_path,
+        rechunk_method="memory",
+        resume=resume,
+    )
+
+
+def test_missing_regions(tmp_path):
+    """Missing chunks are grouped into contiguous regions along time."""
+    ds = _make_dataset()
+    ds.chunk(CHUNKS).to_zarr(tmp_path / "out.zarr")
+    store = fsspec.get_mapper(str(tmp_path / "out.zarr"))
+    for key in ["t/1.0.1", "t/2.0.0", "lsm/0.1"]:
+        del store[key]
+
+    assert is_resumable(ds, store, chunks=CHUNKS)
+    regions, missing_vars = missing_regions(ds, store, chunks=CHUNKS)
+    assert regions == [slice(1, 3)]
+    assert missing_vars == ["lsm"]
+
+
+def test_is_resumable_requires_same_coordinates(tmp_path):
+    """A store written for other timesteps can't be resumed."""
+    ds = _make_dataset()
+    ds.chunk(CHUNKS).to_zarr(tmp_path / "out.zarr")
+    store = fsspec.get_mapper(str(tmp_path / "out.zarr"))
+
+    assert not is_resumable(ds.assign_coords(time=ds.time + 1), store, CHUNKS)
+    assert not is_resumable(ds, store, chunks=dict(CHUNKS, time=2))
+
+
+def test_resume_interrupted_write(tmp_path):
+    """Only the timesteps missing from an interrupted write are computed."""
+    ds = _make_dataset()
+    # a staging store left by a write that was interrupted after the first two
+    # timesteps had been written
+    fp_staging = staging_path(tmp_path / "single_levels.zarr")
+    apply_codec_profiles(ds).chunk(CHUNKS).to_zarr(fp_staging, mode="w")
+    store = fsspec.get_mapper(str(fp_staging))
+    for key in [k for k in store if k.startswith(("t/2.", "t/3."))]:
+        del store[key]
+
+    # computing the timesteps that were already written fails, so this only
+    # succeeds if they are skipped when resuming
+    ds_resume = ds.copy()
+    ds_resume["t"] = (
+        ds["t"].dims,
+        ds["t"].chunk(time=1).data.map_blocks(_only_from(2), dtype="f4"),
+    )
+    _write(ds_resume, local_copy_path=tmp_path)
+
+    fp_store = tmp_path / "single_levels.zarr"
+    assert read_publish_marker(str(fp_store)) is not None
+    xr.testing.assert_equal(xr.open_zarr(fp_store).load(), ds)
+    assert [p.name for p in tmp_path.iterdir()] == ["single_levels.zarr"]
+
+
+def _only_from(n_times):
+    """Block function that fails for the timesteps before `n_times`."""
+
+    def _maybe_raise(block, block_info=None):
+        if block_info[0]["array-location"][0][0] < n_times:
+            raise RuntimeError("recomputed")
+        return block
+
+    return _maybe_raise
+
+
+def test_resume_skips_published_store(tmp_path):
+    """A store that has already been published isn't written again."""
+    ds = _make_dataset()
+    _write(ds, local_copy_path=tmp_path)
+    marker = read_publish_marker(str(tmp_path / "single_levels.zarr"))
+
+    _write(_fail_after(ds, n_times=0), local_copy_path=tmp_path)
+    assert read_publish_marker(str(tmp_path / "single_levels.zarr")) == marker
+
+
+def test_copy_zarr_store_skip_existing(tmp_path):
+    """Only files missing from the target are copied when skipping existing."""
+    ds = _make_dataset()
+    _write(ds, local_copy_path=tmp_path)
+    src = str(tmp_path / "single_levels.zarr")
+
+    dst = "memory://resume-upload/single_levels.zarr"
+    copy_zarr_store(src=src, dst=dst)
+    fs = fsspec.filesystem("memory")
+    fs.rm("/resume-upload/single_levels.zarr/t/3.0.0")
+    fs.pipe_file("/resume-upload/single_levels.zarr/t/0.0.0", b"x" * 3)
+
+    copy_zarr_store(src=src, dst=dst, skip_existing=True)
+
+    assert fs.exists("/resume-upload/single_levels.zarr/t/3.0.0")
+    # files with the same key but a different size are copied again
+    xr.testing.assert_equal(xr.open_zarr(dst).load(), ds)
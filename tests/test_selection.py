@@ -0,0 +1,93 @@
+"""Tests for zarr_creator.selection.
+
+Verifies that the GRIB messages required by a data collection are derived
+correctly from its variables, levels and derived-variable inputs.
+"""
+
+from collections import OrderedDict
+
+from zarr_creator.selection import is_required, required_messages, selection_key
+
+DATA_COLLECTION = OrderedDict(
+    single_levels=[
+        dict(
+            level_type="heightAboveGround",
+            variables={"lsm": None, "swavr_accum": None},
+        ),
+        dict(
+            level_type="heightAboveGround",
+            variables={"orography": lambda ds: ds["z"]},
+            inputs={"z": None},
+        ),
+        dict(
+            level_type="heightAboveGround",
+            variables={"t": [0, 2]},
+            level_name_mapping="{var_name}{level:d}m",
+        ),
+    ],
+    height_levels=[
+        dict(level_type="heightAboveGround", variables={"t": [50, 100]}),
+    ],
+)
+
+
+def test_required_messages_merges_levels_across_parts():
+    """Levels requested for a variable by several parts are combined."""
+    selection = required_messages(DATA_COLLECTION)
+
+    assert selection["heightAboveGround"]["t"] == {0, 2, 50, 100}
+    assert selection["heightAboveGround"]["lsm"] is None
+
+
+def test_required_messages_uses_inputs_and_accumulated_short_names():
+    """Derived variables select their inputs, `_accum` maps to the shortName."""
+    selection = required_messages(DATA_COLLECTION)
+
+    assert "orography" not in selection["heightAboveGround"]
+    assert selection["heightAboveGround"]["z"] is None
+    assert selection["heightAboveGround"]["swavr"] is None
+
+
+def test_is_required():
+    """Messages are only required for selected level types, names and levels."""
+    selection = required_messages(DATA_COLLECTION)
+
+    assert is_required(selection, "heightAboveGround", "t", 2)
+    assert is_required(selection, "heightAboveGround", "lsm", 0)
+    assert not is_required(selection, "heightAboveGround", "t", 10)
+    assert not is_required(selection, "heightAboveGround", "u", 10)
+    assert not is_required(selection, "hybrid", "t", 2)
+
+
+def test_selection_key_is_stable():
+    """The key doesn't depend on the order of levels and changes with content."""
+    selection = required_messages(DATA_COLLECTION)
+    reordered = {
+        "heightAboveGround": dict(
+            reversed(list(selection["heightAboveGround"].items()))
+        ),
+    }
+
+    assert selection_key(selection) == selection_key(reordered)
+    assert selection_key(selection) != selection_key({"hybrid": {"t": None}})
+
+
+def test_required_messages_uses_derived_variable_inputs():
+    """Registered derived variables select their inputs on the same levels."""
+    selection = required_messages(
+        dict(
+            single_levels=[
+                dict(
+                    level_type="heightAboveGround",
+                    derived_variables={"ws": [10], "td": [2]},
+                )
+            ]
+        )
+    )
+
+    assert selection["heightAboveGround"] == {
+        "u": {10},
+        "v": {10},
+        "t": {2},
+        "r": {2},
+    }
@@ -0,0 +1,82 @@
+"""Tests for the startup time of the zarr_creator command line interface.
+
+Verifies that `python -m zarr_creator --help` and
+`python -m zarr_creator.indexing --help` (timed with `-X importtime`) don't
+import the data stack and stay within an import-time budget, and that the refs
+root path is only required once refs are looked up.
+"""
+
+import datetime
+import os
+import subprocess
+import sys
+
+import pytest
+
+from zarr_creator.read_source import refs_path_for
+
+# total import time of `python -m zarr_creator --help` (in seconds), which
+# leaves plenty of margin on slow machines while being well below the time it
+# takes to import xarray and dask
+IMPORT_TIME_BUDGET = 0.5
+# modules that are only imported once a conversion is run
+DEFERRED_MODULES = [
+    "xarray",
+    "dask",
+    "numpy",
+    "zarr",
+    "rechunker",
+    "s3fs",
+    "eccodes",
+    "gribscan",
+]
+
+
+def _import_times(stderr: str) -> dict:
+    """Parse `-X importtime` output into the cumulative time (s) per module."""
+    import_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # nested imports are indented, and included in the cumulative time of
+        # the module that imported them
+        if not name[1:].startswith(" "):
+            import_times[name.strip()] = int(cumulative) / 1e6
+    return import_times
+
+
+@pytest.mark.parametrize("module", ["zarr_creator", "zarr_creator.indexing"])
+def test_cli_help_import_time(module):
+    """`--help` imports none of the data stack and stays within the budget."""
+    env = {k: v for k, v in os.environ.items() if k != "REFS_ROOT_PATH"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", module, "--help"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    assert "--t_analysis" in result.stdout
+
+    imported = {
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert not imported & set(DEFERRED_MODULES)
+    assert sum(_import_times(result.stderr).values()) < IMPORT_TIME_BUDGET
+
+
+def test_refs_path_requires_refs_root_path(monkeypatch):
+    """The refs root path is read from the environment when refs are found."""
+    t_analysis = datetime.datetime(2025, 2, 17, 1, tzinfo=datetime.timezone.utc)
+
+    monkeypatch.delenv("REFS_ROOT_PATH", raising=False)
+    with pytest.raises(ValueError, match="REFS_ROOT_PATH must be set"):
+        refs_path_for(t_analysis=t_analysis)
+
+    monkeypatch.setenv("REFS_ROOT_PATH", "/refs")
+    assert str(refs_path_for(t_analysis=t_analysis, member_id="MBR001__dmi")) == (
+        "/refs/MBR001__dmi/2025-02-17T0100Z.jsons"
+    )
@@ -0,0 +1,88 @@
+"""Tests for zarr_creator.streaming.
+
+Verifies that streaming a forecast one hour at a time (with the GRIB files
+standing in for by synthetic refs of each hour) appends every hour to the
+stores of the member, with the times decoded correctly and the same values as
+converting the whole forecast at once.
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip("gribscan")
+pytest.importorskip("eccodes")
+
+from zarr_creator import streaming  # noqa: E402
+from zarr_creator.config import DATA_COLLECTION  # noqa: E402
+from zarr_creator.write_zarr import local_copy_path_for  # noqa: E402
+
+from .conftest import (  # noqa: E402
+    T_ANALYSIS,
+    level_type_variables,
+    run_cli,
+    synthetic_level_type_dataset,
+    write_refs,
+)
+
+MEMBER_ID = "MBR001__dmi"
+MAX_HOUR = 3
+
+
+@pytest.fixture
+def hourly_refs(monkeypatch):
+    """Write the refs of each forecast hour instead of indexing GRIB files."""
+    datasets = {
+        level_type: synthetic_level_type_dataset(
+            level_type, variables, t_analysis=T_ANALYSIS, n_times=MAX_HOUR + 1
+        )
+        for level_type, variables in level_type_variables().items()
+    }
+
+    def _build_refs(index_paths, refs_path, prefix):
+        hour = int(refs_path.name)
+        refs_path.mkdir(parents=True, exist_ok=True)
+        for level_type, ds in datasets.items():
+            write_refs(
+                ds.isel(time=[hour]),
+                fp_refs=refs_path / f"{level_type}.json",
+                fp_data=refs_path / f"{level_type}.grib",
+            )
+
+    monkeypatch.setattr(streaming, "wait_for_files", lambda *args, **kwargs: None)
+    monkeypatch.setattr(streaming, "index_files", lambda *args, **kwargs: [])
+    monkeypatch.setattr(streaming, "build_refs", _build_refs)
+
+
+def test_stream_forecast_appends_hours(
+    tmp_path, monkeypatch, synthetic_refs, hourly_refs
+):
+    """Each hour is appended with its time and the values of the full forecast."""
+    synthetic_refs(member_id=MEMBER_ID, n_times=MAX_HOUR + 1)
+    cli_root = run_cli(tmp_path, monkeypatch, "--members", MEMBER_ID)
+
+    streamed_root = tmp_path / "streamed"
+    monkeypatch.setattr(streaming, "LOCAL_COPY_STORAGE_PATH", streamed_root)
+    streaming.stream_forecast(
+        t_analysis=T_ANALYSIS,
+        max_hour=MAX_HOUR,
+        member_id=MEMBER_ID,
+        skip_s3_bucket_upload=True,
+    )
+
+    fp_streamed = local_copy_path_for(streamed_root, "mbr001")
+    fp_cli = local_copy_path_for(cli_root, "mbr001")
+    t0 = np.datetime64(T_ANALYSIS.replace(tzinfo=None), "ns")
+    for part_id in DATA_COLLECTION:
+        ds = xr.open_zarr(fp_streamed / f"{part_id}.zarr")
+        np.testing.assert_array_equal(
+            ds.time.values, t0 + np.arange(MAX_HOUR + 1) * np.timedelta64(1, "h")
+        )
+        assert ds.time.encoding["units"].startswith("hours since 2025-02-17")
+        ds_cli = xr.open_zarr(fp_cli / f"{part_id}.zarr")
+        # the scalar level coordinate left by selecting single levels isn't
+        # always kept when the hours are concatenated
+        xr.testing.assert_allclose(
+            ds.drop_vars("level", errors="ignore").drop_attrs(),
+            ds_cli.drop_vars("level", errors="ignore").drop_attrs(),
+        )
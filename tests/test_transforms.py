@@ -1,13 +1,20 @@
-"""Tests for zarr_creator.transforms.derive_orography_from_geopotential.
+"""Tests for zarr_creator.transforms.
 
 Verifies scaling, time-dimension handling, attribute assignment, and
-grid_mapping passthrough.
+grid_mapping passthrough of the orography, de-accumulation from adjacent
+timesteps, and the values and single pass over shared inputs of the
+registered derived variables.
 """
 
 import numpy as np
+import pytest
 import xarray as xr
 
-from zarr_creator.transforms import derive_orography_from_geopotential
+from zarr_creator.transforms import (
+    deaccumulate,
+    derive_orography_from_geopotential,
+    derive_variables,
+)
 
 
 def _make_geopotential(values, time_steps=2, grid_mapping=None):
@@ -68,3 +75,105 @@ def test_omits_grid_mapping_when_absent():
     result = derive_orography_from_geopotential(_make_geopotential([[0.0]]))
 
     assert "grid_mapping" not in result.attrs
+
+
+def _make_level_type_dataset():
+    """Build a synthetic level-type dataset with (time, level, y, x) fields."""
+    dims = ("time", "level", "y", "x")
+    shape = (2, 2, 1, 4)
+    u = np.broadcast_to(np.array([1.0, 0.0, -1.0, 0.0], dtype="f4"), shape)
+    v = np.broadcast_to(np.array([0.0, 1.0, 0.0, -2.0], dtype="f4"), shape)
+    ds = xr.Dataset(
+        {
+            "u": (dims, u.copy()),
+            "v": (dims, v.copy()),
+            "t": (dims, np.full(shape, 293.15, dtype="f4")),
+            "r": (dims, np.full(shape, 100.0, dtype="f4")),
+        },
+        coords={"time": [0, 1], "level": [2, 10]},
+    )
+    for var_name in ds.data_vars:
+        ds[var_name].attrs["grid_mapping"] = "dini_projection"
+    return ds
+
+
+def test_derive_variables_values():
+    """Wind speed, direction and dewpoint are computed on the requested levels."""
+    ds = derive_variables(
+        _make_level_type_dataset(), {"ws": [10], "wdir": [10], "td": [2]}
+    )
+
+    np.testing.assert_allclose(ds["ws"].isel(time=0, level=0, y=0), [1, 1, 1, 2])
+    # direction the wind blows from
+    np.testing.assert_allclose(ds["wdir"].isel(time=0, level=0, y=0), [270, 180, 90, 0])
+    # the dewpoint equals the temperature at saturation
+    np.testing.assert_allclose(ds["td"], 293.15, rtol=1e-6)
+    assert list(ds["ws"].level.values) == [10]
+    assert ds["ws"].dtype == np.float32
+    assert ds["ws"].attrs["standard_name"] == "wind_speed"
+    assert ds["td"].attrs["grid_mapping"] == "dini_projection"
+
+
+def test_derive_variables_reads_shared_inputs_once():
+    """Inputs shared by derived variables are read once per chunk."""
+    ds = _make_level_type_dataset().chunk(time=1)
+    ds_derived = derive_variables(ds, {"ws": None, "wdir": None})
+
+    graph = xr.merge([ds_derived["ws"], ds_derived["wdir"]]).__dask_graph__()
+    n_kernel_tasks = sum(
+        1
+        for key in dict(graph)
+        if isinstance(key, tuple) and key[0].startswith("fused_kernel-")
+    )
+    assert n_kernel_tasks == ds.u.data.npartitions
+
+
+def test_derive_variables_unknown_name():
+    """Derived variables must be registered."""
+    with pytest.raises(KeyError, match="Unknown derived variables"):
+        derive_variables(_make_level_type_dataset(), {"not_registered": None})
+
+
+def _make_accumulated(n_times=4, rate=100.0):
+    """Build a synthetic accumulated flux (J m-2) with hourly timesteps."""
+    times = np.datetime64("2025-01-01T00") + np.arange(n_times) * np.timedelta64(1, "h")
+    return xr.DataArray(
+        np.broadcast_to(
+            (rate * 3600.0 * np.arange(n_times))[:, None, None], (n_times, 2, 3)
+        ).copy(),
+        dims=("time", "y", "x"),
+        coords={"time": times},
+        name="swavr_accum",
+        attrs={
+            "units": "J m-2",
+            "long_name": "Accumulated surface downwelling shortwave flux",
+            "grid_mapping": "dini_projection",
+        },
+    )
+
+
+def test_deaccumulate_values_and_attrs():
+    """The mean rate over each step is returned, undefined at the first step."""
+    result = deaccumulate(_make_accumulated())
+
+    np.testing.assert_allclose(result.isel(y=0, x=0), [np.nan, 100, 100, 100])
+    assert result.attrs["units"] == "W m-2"
+    assert result.attrs["long_name"] == "Mean surface downwelling shortwave flux"
+    assert result.attrs["cell_methods"] == "time: mean"
+    assert result.attrs["grid_mapping"] == "dini_projection"
+
+
+def test_deaccumulate_uses_only_adjacent_timesteps():
+    """A timestep is computed from itself and the previous timestep only."""
+    da = _make_accumulated().chunk(time=1)
+
+    def _fail_before(block, block_info=None):
+        if block_info[0]["array-location"][0][0] < 2:
+            raise RuntimeError("timestep loaded")
+        return block
+
+    da = da.copy(data=da.data.map_blocks(_fail_before, dtype=da.dtype))
+    result = deaccumulate(da)
+
+    assert result.chunks[0] == (1, 1, 1, 1)
+    np.testing.assert_allclose(result.isel(time=3).values, 100.0)
@@ -0,0 +1,68 @@
+"""Tests for zarr_creator.write_zarr.
+
+Verifies that a finished zarr store can be copied to another fsspec target
+(including a local S3 stand-in) without re-computing the dataset.
+"""
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+from zarr_creator import write_zarr
+from zarr_creator.write_zarr import copy_zarr_store
+
+
+def _make_dataset():
+    """Build a small synthetic (time, y, x) dataset."""
+    return xr.Dataset(
+        {"t": (("time", "y", "x"), np.arange(2 * 3 * 4, dtype="f4").reshape(2, 3, 4))},
+        coords={"time": [0, 1], "y": [0, 1, 2], "x": [0, 1, 2, 3]},
+    )
+
+
+def test_copy_zarr_store_roundtrip(tmp_path):
+    """The copied store opens to the same dataset as the source store."""
+    ds = _make_dataset()
+    fp_src = tmp_path / "src.zarr"
+    ds.to_zarr(fp_src, mode="w", consolidated=True)
+
+    dst = "memory://copy-roundtrip/dst.zarr"
+    copy_zarr_store(src=str(fp_src), dst=dst)
+
+    xr.testing.assert_identical(xr.open_zarr(dst).load(), xr.open_zarr(fp_src).load())
+
+
+def test_copy_zarr_store_replaces_existing_target(tmp_path):
+    """Keys left over from a previous store at the target are removed."""
+    dst = "memory://copy-replace/dst.zarr"
+    fs = fsspec.filesystem("memory")
+    fs.pipe_file("/copy-replace/dst.zarr/stale", b"stale")
+
+    fp_src = tmp_path / "src.zarr"
+    _make_dataset().to_zarr(fp_src, mode="w", consolidated=True)
+    copy_zarr_store(src=str(fp_src), dst=dst)
+
+    assert not fs.exists("/copy-replace/dst.zarr/stale")
+    assert fs.exists("/copy-replace/dst.zarr/.zmetadata")
+
+
+def test_copy_zarr_store_to_s3_stand_in(tmp_path, s3_bucket):
+    """Stores are uploaded concurrently to a local moto S3 server."""
+    storage_options = write_zarr.s3_storage_options(concurrency=4)
+    fs = fsspec.filesystem("s3", **storage_options)
+
+    ds = _make_dataset()
+    fp_src = tmp_path / "src.zarr"
+    ds.chunk(time=1, y=1).to_zarr(fp_src, mode="w", consolidated=True)
+
+    dst = f"s3://{write_zarr.BUCKET_NAME}/dst.zarr"
+    copy_zarr_store(
+        src=str(fp_src),
+        dst=dst,
+        dst_storage_options=storage_options,
+        concurrency=4,
+        multipart_chunksize="5MB",
+    )
+
+    ds_copy = xr.open_zarr(fs.get_mapper(dst)).load()
+    xr.testing.assert_identical(ds_copy, xr.open_zarr(fp_src).load())
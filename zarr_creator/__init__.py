@@ -1,3 +1,4 @@
+import datetime
 import importlib.metadata
 from pathlib import Path
 from typing import Any
@@ -24,3 +25,84 @@ def open_intake_catalog(catalog_path: str | Path | None = None) -> Any:
         catalog_path = Path(catalog_path)
 
     return intake.open_catalog(str(catalog_path))
+
+
+def find_forecasts(
+    dataset_id: str | None = None,
+    member: str | None = "control",
+    start: datetime.datetime | None = None,
+    end: datetime.datetime | None = None,
+    variables: list | None = None,
+    min_lead_time: float | None = None,
+    inventory_url: str | None = None,
+    storage_options: dict | None = None,
+) -> list[dict]:
+    """
+    Find published forecasts in the inventory at the root of the S3 bucket
+    (a single request, without listing the bucket), sorted by analysis time.
+    See `zarr_creator.inventory.query_inventory` for the query parameters.
+    Each entry has the `analysis_time`, `member`, `dataset_id`, `url`,
+    `variables`, `dims`, `lead_times`, `nbytes` and `published_at` of a store.
+    """
+    from .inventory import (
+        INVENTORY_READ_STORAGE_OPTIONS,
+        query_inventory,
+        read_inventory,
+    )
+    from .write_zarr import INVENTORY_URL
+
+    entries = read_inventory(
+        inventory_url or INVENTORY_URL,
+        storage_options=(
+            INVENTORY_READ_STORAGE_OPTIONS
+            if storage_options is None
+            else storage_options
+        ),
+    )
+    return query_inventory(
+        entries,
+        dataset_id=dataset_id,
+        member=member,
+        start=start,
+        end=end,
+        variables=variables,
+        min_lead_time=min_lead_time,
+    )
+
+
+def latest_analysis_time(
+    dataset_id: str, member: str = "control", **query
+) -> datetime.datetime | None:
+    """
+    Analysis time of the latest published forecast of `dataset_id` (and
+    matching `query`, see `find_forecasts`), or `None` if there is none. Use
+    it to open a forecast with `forecast_source`.
+    """
+    entries = find_forecasts(dataset_id=dataset_id, member=member, **query)
+    if not entries:
+        return None
+    return datetime.datetime.strptime(
+        entries[-1]["analysis_time"], "%Y-%m-%dT%H:%M:%SZ"
+    ).replace(tzinfo=datetime.timezone.utc)
+
+
+def forecast_source(
+    dataset_id: str,
+    analysis_time: datetime.datetime | None = None,
+    catalog_path: str | Path | None = None,
+) -> Any:
+    """
+    Intake source of the forecast of `dataset_id` (e.g. "height_levels") at
+    `analysis_time` in the project's intake catalog (see
+    `open_intake_catalog`), by default the latest published forecast (see
+    `latest_analysis_time`), e.g. `forecast_source("height_levels").to_dask()`.
+    """
+    if analysis_time is None:
+        analysis_time = latest_analysis_time(dataset_id)
+        if analysis_time is None:
+            raise ValueError(f"No published forecasts of {dataset_id} were found")
+
+    catalog = open_intake_catalog(catalog_path)
+    # the source in the catalog is built with the default parameters, so the
+    # analysis time is set through its catalog entry
+    return catalog[dataset_id]._entry(analysis_time=analysis_time)
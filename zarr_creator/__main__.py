@@ -1,26 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
-import datetime
+import contextlib
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import isodate
-import xarray as xr
 from loguru import logger
 
-from . import __version__
-from .config import DATA_COLLECTION
+# only the settings needed to build the argument parser are imported here, the
+# modules that convert the data (and import xarray, dask, eccodes etc) are
+# imported once a conversion is run, so that e.g. `--help` returns quickly
 from .grib_definitions import set_local_eccodes_definitions_path
-from .read_source import read_level_type_data
-from .write_zarr import write_output_zarrs
+from .settings import (
+    GRID_GEOMETRY_CACHE_PATH,
+    GRID_GEOMETRY_MODES,
+    PROMETHEUS_TEXTFILE,
+    RECHUNK_METHODS,
+    RUN_REPORT_PATH,
+    UPLOAD_CONCURRENCY,
+    UPLOAD_MULTIPART_CHUNKSIZE,
+)
 
 DEFAULT_ANALYSIS_TIME = "2025-02-17T01:00:00Z"
 DEFAULT_FORECAST_DURATION = "PT3H"
 DEFAULT_CHUNKING = dict(time=54, x=300, y=260)
 LOCAL_COPY_STORAGE_PATH = Path("/tmp/dini-recent")
-
-set_local_eccodes_definitions_path()
+# member name used for the output stores with all members stacked together
+STACKED_MEMBERS_NAME = "ensemble"
 
 
 def _setup_argparse():
@@ -52,6 +61,179 @@ def _setup_argparse():
         ),
     )
 
+    argparser.add_argument(
+        "--rechunk-method",
+        default="auto",
+        choices=RECHUNK_METHODS,
+        help=(
+            "How to rechunk each part to the chunking set in `OUTPUT_CHUNKING`. "
+            "With `auto` parts no larger than --rechunk-max-mem are rechunked "
+            "in memory, larger parts are rechunked with `rechunker`"
+        ),
+    )
+    argparser.add_argument(
+        "--rechunk-max-mem",
+        default="2GB",
+        help="Memory limit used when rechunking, e.g. `2GB`",
+    )
+    argparser.add_argument(
+        "--rechunk-temp-path",
+        default=None,
+        help=(
+            "Directory for intermediate stores created by `rechunker` "
+            "(defaults to the system temporary directory)"
+        ),
+    )
+    argparser.add_argument(
+        "--concurrent-parts",
+        action="store_true",
+        help=(
+            "Write all parts (single_levels, pressure_levels, height_levels) "
+            "concurrently using a shared dask scheduler, rather than one after "
+            "another"
+        ),
+    )
+    argparser.add_argument(
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of dask workers to use (defaults to the number of CPUs)",
+    )
+    argparser.add_argument(
+        "--memory-limit",
+        default=None,
+        help=(
+            "Total memory budget for the run, e.g. `16GB`. The dask workers "
+            "share the budget, each part is written in batches sized to fit "
+            "it and the run fails if the RSS goes over it. Requires "
+            "dask.distributed (dependency group 'distributed')"
+        ),
+    )
+    argparser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=UPLOAD_CONCURRENCY,
+        help="Number of objects uploaded to the S3 bucket concurrently",
+    )
+    argparser.add_argument(
+        "--upload-multipart-chunksize",
+        default=UPLOAD_MULTIPART_CHUNKSIZE,
+        help=(
+            "Part size for multipart uploads to the S3 bucket, objects smaller "
+            "than twice this size are uploaded in a single request"
+        ),
+    )
+    argparser.add_argument(
+        "--members",
+        nargs="+",
+        default=[os.getenv("MEMBER_ID", "CONTROL__dmi")],
+        help=(
+            "Members to convert (as in the GRIB filenames, e.g. CONTROL__dmi "
+            "MBR001__dmi), all written with the same dask workers"
+        ),
+    )
+    argparser.add_argument(
+        "--stack-members",
+        action="store_true",
+        help=(
+            f"Stack the members along a `member` dimension into a single store "
+            f"for each part (with member name `{STACKED_MEMBERS_NAME}`), rather "
+            "than writing separate stores for each member"
+        ),
+    )
+    argparser.add_argument(
+        "--build-refs",
+        action="store_true",
+        help=(
+            "Index the GRIB files and build the refs of all members (with one "
+            "pool of indexing processes) before converting, rather than using "
+            "refs built with build_indexes_and_refs.sh"
+        ),
+    )
+    argparser.add_argument(
+        "--max-hour",
+        type=int,
+        default=int(os.getenv("MAX_HOUR", 36)),
+        help="Maximum forecast hour to index with --build-refs (inclusive)",
+    )
+    argparser.add_argument(
+        "--index-cache-path",
+        default=os.getenv("INDEX_CACHE_PATH") or None,
+        help="GRIB index cache used with --build-refs, see zarr_creator.indexing",
+    )
+    argparser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Resume an earlier interrupted run for the same analysis time, "
+            "only writing and uploading the parts of the output zarrs that "
+            "are missing"
+        ),
+    )
+    argparser.add_argument(
+        "--grid-geometry",
+        default="copy",
+        choices=GRID_GEOMETRY_MODES,
+        help=(
+            "Either copy the cached 2D grid coordinates (lat/lon and, if "
+            "enabled, bounds and rotation) into every output zarr, or link to "
+            "a single copy of the grid geometry store uploaded to the S3 bucket "
+            "in the `grid_geometry` attribute of each output zarr"
+        ),
+    )
+    argparser.add_argument(
+        "--grid-geometry-bounds",
+        action="store_true",
+        help="Include the lat/lon of the cell corners in the grid geometry",
+    )
+    argparser.add_argument(
+        "--grid-geometry-rotation",
+        action="store_true",
+        help=(
+            "Include the angle between east and the grid x-axis in the grid "
+            "geometry (to rotate grid-relative winds to east/north)"
+        ),
+    )
+    argparser.add_argument(
+        "--grid-geometry-cache-path",
+        default=GRID_GEOMETRY_CACHE_PATH,
+        help="Directory the grid geometry of each grid is cached in",
+    )
+    argparser.add_argument(
+        "--run-report-path",
+        default=RUN_REPORT_PATH,
+        help=(
+            "Directory the JSON run report (wall time, peak RSS, bytes read "
+            "and written and dask task stats of each stage) is written to, as "
+            "`<analysis_time>.json`"
+        ),
+    )
+    argparser.add_argument(
+        "--prometheus-textfile",
+        default=PROMETHEUS_TEXTFILE,
+        help=(
+            "If given, also write the run report as Prometheus metrics to this "
+            "file (e.g. in the node-exporter textfile collector directory)"
+        ),
+    )
+    argparser.add_argument(
+        "--point-stores",
+        action="store_true",
+        help=(
+            "Also write each part in a layout for reading time series at "
+            "single locations (chunked as in `POINT_OUTPUT_CHUNKING`), as "
+            "`{part}_points.zarr`"
+        ),
+    )
+    argparser.add_argument(
+        "--stations",
+        default=None,
+        help=(
+            "CSV file of stations (columns `name`, `lat` and `lon`) to write "
+            "the grid index of, as `stations.json` next to the output zarrs"
+        ),
+    )
+
     return argparser
 
 
@@ -66,97 +248,253 @@ def cli(argv=None):
     logger.remove()
     logger.add(sys.stderr, level=args.log_level.upper())
 
-    parts = {}
-    for part_id, part_details in DATA_COLLECTION.items():
-        ds_part = xr.Dataset()
-        for level_details in part_details:
-            level_type = level_details["level_type"]
-            variables = level_details["variables"]
-            level_name_mapping = level_details.get("level_name_mapping", None)
+    from .instrumentation import run_report
+
+    set_local_eccodes_definitions_path()
+
+    with run_report(
+        t_analysis=args.t_analysis,
+        report_path=args.run_report_path,
+        prometheus_textfile=args.prometheus_textfile,
+        members=args.members,
+    ):
+        _run(args)
+
+
+def _run(args):
+    from .instrumentation import stage
+    from .selection import required_messages
+
+    if args.build_refs:
+        # only imported when refs are built
+        from .indexing import build_members_indexes_and_refs
+
+        with stage("build_refs"):
+            build_members_indexes_and_refs(
+                t_analysis=args.t_analysis,
+                max_hour=args.max_hour,
+                member_ids=args.members,
+                n_workers=args.n_workers,
+                cache_path=args.index_cache_path,
+                selection=required_messages(),
+            )
+
+    _convert(args)
+
+
+def _convert(args, start_scheduler=True):
+    """
+    Convert the members `args.members` of the analysis time `args.t_analysis`
+    from their refs: build the parts, attach the grid geometry, write (and
+    publish) the output zarrs, write the station index and delete the GRIB
+    block cache (if used, see `read_source.clear_block_cache`), which is kept
+    until then so that a resumed conversion doesn't read the GRIB messages
+    again. This is shared by the command line interface and the daemon
+    (`daemon.convert_forecast`), which keeps its dask scheduler running
+    between forecasts and so calls this with `start_scheduler=False`.
+    """
+    from .config import DATA_COLLECTION
+    from .instrumentation import stage
+    from .memory import concurrent_writes
+    from .parts import build_parts, stack_members
+    from .read_source import LevelTypeDataReader, clear_block_cache
+    from .scheduler import dask_scheduler
+    from .write_zarr import output_member_name
+
+    # shared across all parts so that each level type is only read once
+    read_level_type_data = LevelTypeDataReader()
+
+    parts_by_member = {}
+    for member_id in args.members:
+        member = output_member_name(member_id)
+        with stage("build_parts", member=member):
+            parts_by_member[member] = build_parts(
+                t_analysis=args.t_analysis,
+                read_level_type_data=read_level_type_data,
+                member_id=member_id,
+            )
+
+    read_level_type_data.log_summary()
+    # the parts hold all the data they need, so the reader (and the datasets
+    # it has cached) can be released
+    del read_level_type_data
 
-            ds_level_type = read_level_type_data(
-                t_analysis=args.t_analysis, level_type=level_type
+    with stage("grid_geometry"):
+        parts_by_member, ds_geometry = _with_grid_geometry(parts_by_member, args)
+
+    if args.stack_members:
+        outputs = [
+            (
+                STACKED_MEMBERS_NAME,
+                part_id,
+                stack_members(
+                    {
+                        member: parts[part_id]
+                        for member, parts in parts_by_member.items()
+                    }
+                ),
             )
+            for part_id in DATA_COLLECTION
+        ]
+    else:
+        outputs = [
+            (member, part_id, ds_part)
+            for member, parts in parts_by_member.items()
+            for part_id, ds_part in parts.items()
+        ]
+
+    # the outputs are consumed as they are written below
+    members = list(dict.fromkeys(member for member, _, _ in outputs))
 
-            for var_name, levels in variables.items():
-                if callable(levels):
-                    da = levels(ds_level_type)
-                    ds_part[var_name] = da
-                    if "grid_mapping" in da.attrs:
-                        ds_part[da.attrs["grid_mapping"]] = ds_level_type[
-                            da.attrs["grid_mapping"]
-                        ]
-                    continue
-
-                da = ds_level_type[var_name]
-
-                if levels is None:
-                    if level_name_mapping is None:
-                        new_name = var_name
-                    else:
-                        new_name = level_name_mapping.format(var_name=var_name)
-                    ds_part[new_name] = da
-                elif level_name_mapping is None:
-                    # assuming we're just selecting levels and not changing the name
-                    da = da.sel(level=levels)
-                    ds_part[var_name] = da
-                else:
-                    # mapping each level to a new variable name
-                    for level in levels:
-                        da_level = da.sel(level=level)
-                        new_name = level_name_mapping.format(
-                            level=level, var_name=var_name
-                        )
-                        ds_part[new_name] = da_level
-
-                if "grid_mapping" in da.attrs:
-                    ds_part[da.attrs["grid_mapping"]] = ds_level_type[
-                        da.attrs["grid_mapping"]
-                    ]
-
-        # use "altitude" and "pressure" as dimension names instead of "level"
-        if "level" in ds_part.dims:
-            if level_type == "isobaricInhPa":
-                ds_part = ds_part.rename({"level": "pressure"})
-            elif level_type == "heightAboveGround":
-                ds_part = ds_part.rename({"level": "altitude"})
-            elif level_type == "heightAboveSea":
-                ds_part = ds_part.rename({"level": "altitude"})
-            else:
-                raise NotImplementedError(f"Level type {level_type} not implemented")
-
-        # check if any of the coordinates don't have any variables, if so drop them
-        for coord in ds_part.coords:
-            if all(coord not in ds_part[v].coords for v in list(ds_part.data_vars)):
-                ds_part = ds_part.drop_vars(coord)
-
-        parts[part_id] = ds_part
-
-    for part_id, ds_part in parts.items():
-        rechunk_to = dict(time=1, x=ds_part.x.size // 2, y=ds_part.y.size // 2)
-        # check that with the chunking provided that the arrays exactly fit into the chunks
-        for dim in rechunk_to:
-            assert ds_part[dim].size % rechunk_to[dim] == 0
-
-        # set zarr-creator version
-        ds_part.attrs["zarr_creator_version"] = __version__
-        # set creation timestamp
-        ds_part.attrs["zarr_creation_time"] = datetime.datetime.now(
-            datetime.timezone.utc
-        ).isoformat()
-        # add link to repo
-        ds_part.attrs["zarr_creator_repo"] = (
-            "https://github.com/dmidk/nwp-forecast-zarr-creator"
+    if start_scheduler:
+        scheduler = dask_scheduler(
+            n_workers=args.n_workers, memory_limit=args.memory_limit
         )
+    else:
+        scheduler = contextlib.nullcontext()
+    with scheduler:
+        if args.concurrent_parts:
+            # the parts are written to separate stores, so we can write them
+            # all at once with the tasks sharing the same dask workers
+            with (
+                concurrent_writes(len(outputs)),
+                ThreadPoolExecutor(max_workers=len(outputs)) as executor,
+            ):
+                futures = [
+                    executor.submit(_write_part, member, part_id, ds_part, args)
+                    for member, part_id, ds_part in outputs
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            # each part (and its task graph) is released once it has been
+            # written, rather than being kept until all parts are written
+            del parts_by_member
+            while outputs:
+                member, part_id, ds_part = outputs.pop(0)
+                _write_part(member, part_id, ds_part, args)
+                del ds_part
+
+    if args.stations is not None:
+        with stage("station_index"):
+            _write_station_index(
+                members=members,
+                ds_geometry=ds_geometry,
+                args=args,
+            )
+
+    clear_block_cache()
+
+
+def _with_grid_geometry(parts_by_member, args):
+    from .geometry import (
+        attach_grid_geometry,
+        cached_grid_geometry,
+        grid_geometry_url,
+        upload_grid_geometry,
+    )
+
+    # all parts are on the same grid, so the geometry is built (or loaded
+    # from the cache) from the first one
+    ds_first = next(iter(next(iter(parts_by_member.values())).values()))
+    ds_geometry, fp_geometry = cached_grid_geometry(
+        ds_first,
+        cache_path=args.grid_geometry_cache_path,
+        bounds=args.grid_geometry_bounds,
+        rotation=args.grid_geometry_rotation,
+    )
+
+    link = None
+    if args.grid_geometry == "link":
+        if args.skip_s3_bucket_upload:
+            link = str(fp_geometry)
+        else:
+            link = grid_geometry_url(fp_geometry.stem)
+            upload_grid_geometry(fp_geometry, link)
+
+    parts_by_member = {
+        member: {
+            part_id: attach_grid_geometry(ds_part, ds_geometry, link=link)
+            for part_id, ds_part in parts.items()
+        }
+        for member, parts in parts_by_member.items()
+    }
+    return parts_by_member, ds_geometry
+
+
+def _write_station_index(members, ds_geometry, args):
+    from .config import POINT_OUTPUT_CHUNKING
+    from .points import (
+        STATION_INDEX_FILENAME,
+        build_station_index,
+        point_dataset_id,
+        read_stations,
+        station_index_url,
+        write_station_index,
+    )
+    from .write_zarr import local_copy_path_for, s3_storage_options
+
+    tiles = {}
+    if args.point_stores:
+        tiles = {
+            point_dataset_id(part_id): dict(y=chunking["y"], x=chunking["x"])
+            for part_id, chunking in POINT_OUTPUT_CHUNKING.items()
+        }
+    station_index = build_station_index(
+        read_stations(args.stations), ds_geometry, tiles=tiles
+    )
+    for member in members:
+        fp_local = local_copy_path_for(LOCAL_COPY_STORAGE_PATH, member)
+        write_station_index(station_index, str(fp_local / STATION_INDEX_FILENAME))
+        if not args.skip_s3_bucket_upload:
+            write_station_index(
+                station_index,
+                station_index_url(member=member, t_analysis=args.t_analysis),
+                storage_options=s3_storage_options(),
+            )
+
+
+def _write_part(member, part_id, ds_part, args):
+    from .config import OUTPUT_CHUNKING, POINT_OUTPUT_CHUNKING
+    from .parts import add_provenance_attrs
+    from .points import open_map_store, point_dataset_id
+    from .rechunk import resolve_chunks
+    from .write_zarr import local_copy_path_for, write_output_zarrs
+
+    rechunk_to = resolve_chunks(ds_part, OUTPUT_CHUNKING[part_id])
+    # check that with the chunking provided that the arrays exactly fit into the chunks
+    for dim in rechunk_to:
+        assert ds_part[dim].size % rechunk_to[dim] == 0
+
+    add_provenance_attrs(ds_part)
+
+    local_copy_path = local_copy_path_for(LOCAL_COPY_STORAGE_PATH, member)
+    write_kwargs = dict(
+        member=member,
+        t_analysis=args.t_analysis,
+        skip_s3_bucket_upload=args.skip_s3_bucket_upload,
+        local_copy_path=local_copy_path,
+        rechunk_method=args.rechunk_method,
+        rechunk_max_mem=args.rechunk_max_mem,
+        rechunk_temp_path=args.rechunk_temp_path,
+        upload_concurrency=args.upload_concurrency,
+        upload_multipart_chunksize=args.upload_multipart_chunksize,
+        resume=args.resume,
+        memory_limit=args.memory_limit,
+    )
+    write_output_zarrs(
+        ds=ds_part, dataset_id=part_id, rechunk_to=rechunk_to, **write_kwargs
+    )
 
+    if args.point_stores:
+        # created from the map store just written, so that the GRIB messages
+        # aren't read again
+        ds_points = open_map_store(local_copy_path / f"{part_id}.zarr")
         write_output_zarrs(
-            ds=ds_part,
-            member="control",
-            dataset_id=part_id,
-            rechunk_to=rechunk_to,
-            t_analysis=args.t_analysis,
-            skip_s3_bucket_upload=args.skip_s3_bucket_upload,
-            local_copy_path=LOCAL_COPY_STORAGE_PATH,
+            ds=ds_points,
+            dataset_id=point_dataset_id(part_id),
+            rechunk_to=resolve_chunks(ds_points, POINT_OUTPUT_CHUNKING[part_id]),
+            **write_kwargs,
         )
 
 
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Virtual aggregate of the published output stores of a member and part across
+all analysis times, so that an archive of forecasts can be opened lazily as a
+single dataset (with `analysis_time` and `lead_time` dimensions instead of
+`time`) rather than opening one store per forecast.
+
+The aggregate is a reference file in the kerchunk (version 1) format, read
+with fsspec's `reference://` filesystem. It holds the metadata of all arrays
+(so no metadata is read from the individual stores when opening it) and a
+reference to each chunk of the published stores. Every chunk of a zarr store
+is a separate object, so the references point to whole objects. Stores are
+found through the inventory (see `zarr_creator.inventory`). Only the metadata
+of stores that are new, or republished since the aggregate was last updated,
+is read to check that they have the same arrays as the others. Stores whose
+arrays differ (e.g. written with different codecs) are left out.
+
+The reference file is rewritten on each update, so an aggregate only covers
+the stores within a retention window of the latest analysis time, up to a
+maximum number of stores, which bounds its size. Updates are conditional
+writes in S3 (see `publish.update_object`), so that concurrent updates don't
+lose each other's stores.
+
+Update the aggregates with `python -m zarr_creator.aggregate`, and open one
+with `open_aggregate`.
+"""
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import math
+
+import fsspec
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+from .config import DATA_COLLECTION
+from .inventory import INVENTORY_READ_STORAGE_OPTIONS, query_inventory, read_inventory
+from .publish import update_object
+from .write_zarr import BUCKET_NAME, INVENTORY_URL, s3_storage_options
+
+AGGREGATE_PREFIX_FORMAT = "dini/{member}/aggregate/{dataset_id}.json"
+SOURCE_TIME_DIM = "time"
+ANALYSIS_TIME_DIM = "analysis_time"
+LEAD_TIME_DIM = "lead_time"
+ANALYSIS_TIME_UNITS = "hours since 1970-01-01 00:00:00"
+# attributes of the aggregate recording the publish time of each store it
+# includes (keyed by analysis time) and the store its array metadata is taken
+# from, so that it can be updated incrementally
+SOURCES_ATTR = "aggregate_sources"
+TEMPLATE_ATTR = "aggregate_template"
+# the stores kept in an aggregate: those with analysis times within the
+# retention window of the latest one, up to a maximum number (the most recent)
+AGGREGATE_RETENTION = datetime.timedelta(days=30)
+AGGREGATE_MAX_STORES = 240
+
+
+def aggregate_url(member: str, dataset_id: str) -> str:
+    """
+    URL of the aggregate of a member and part in the S3 bucket, e.g.
+    "s3://harmonie-zarr/dini/control/aggregate/single_levels.json"
+    """
+    prefix = AGGREGATE_PREFIX_FORMAT.format(member=member, dataset_id=dataset_id)
+    return f"s3://{BUCKET_NAME}/{prefix}"
+
+
+def _read_zmetadata(url: str, storage_options: dict = None) -> dict:
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    return json.loads(fs.cat_file(f"{root}/.zmetadata"))["metadata"]
+
+
+def _read_refs(url: str, storage_options: dict = None) -> dict | None:
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    try:
+        return json.loads(fs.cat_file(path))
+    except FileNotFoundError:
+        return None
+
+
+def _arrays(metadata: dict) -> dict:
+    # the `.zarray` and dimension names of each array in consolidated metadata
+    return {
+        key[: -len("/.zarray")]: (
+            zarray,
+            metadata[key.replace(".zarray", ".zattrs")]["_ARRAY_DIMENSIONS"],
+        )
+        for key, zarray in metadata.items()
+        if key.endswith("/.zarray")
+    }
+
+
+def _without_time(zarray: dict, dims: list) -> dict:
+    zarray = dict(zarray)
+    if SOURCE_TIME_DIM in dims:
+        i = dims.index(SOURCE_TIME_DIM)
+        zarray["shape"] = zarray["shape"][:i] + zarray["shape"][i + 1 :]
+    return zarray
+
+
+def is_compatible(metadata: dict, template: dict) -> bool:
+    """
+    Check that the consolidated `metadata` of a store has the same arrays as
+    the `template` store, apart from their length along `time`.
+    """
+    arrays, template_arrays = _arrays(metadata), _arrays(template)
+    if set(arrays) != set(template_arrays):
+        return False
+    return all(
+        dims == template_arrays[name][1]
+        and _without_time(zarray, dims) == _without_time(*template_arrays[name])
+        for name, (zarray, dims) in arrays.items()
+        if name != SOURCE_TIME_DIM
+    )
+
+
+def _inline_array(name: str, values: np.ndarray, attrs: dict) -> dict:
+    return {
+        f"{name}/.zarray": dict(
+            zarr_format=2,
+            shape=[len(values)],
+            chunks=[max(len(values), 1)],
+            dtype=values.dtype.str,
+            compressor=None,
+            filters=None,
+            fill_value=None,
+            order="C",
+        ),
+        f"{name}/.zattrs": dict(_ARRAY_DIMENSIONS=[name], **attrs),
+        f"{name}/0": "base64:" + base64.b64encode(values.tobytes()).decode(),
+    }
+
+
+def _chunk_ranges(zarray: dict) -> list:
+    return [range(math.ceil(n / c)) for n, c in zip(zarray["shape"], zarray["chunks"])]
+
+
+def _chunk_key(zarray: dict, indices) -> str:
+    return zarray.get("dimension_separator", ".").join(map(str, indices)) or "0"
+
+
+def build_aggregate_refs(stores: list[dict], template: dict, template_url: str) -> dict:
+    """
+    Build the references of the aggregate of `stores`.
+
+    Parameters
+    ----------
+    stores : list of dict
+        The stores to aggregate, as inventory entries (with `analysis_time`,
+        `url`, `lead_times` and `published_at`), sorted by analysis time.
+    template : dict
+        Consolidated metadata of the store the array metadata is taken from.
+        Arrays without a `time` dimension (e.g. `lsm` or `lat`) are
+        referenced in this store.
+    template_url : str
+        URL of the template store.
+
+    Returns
+    -------
+    dict
+        The references, in the kerchunk version 1 format.
+    """
+    lead_times = sorted({lead for store in stores for lead in store["lead_times"]})
+    i_lead = {lead: i for i, lead in enumerate(lead_times)}
+    analysis_hours = np.array(
+        [
+            (
+                datetime.datetime.strptime(s["analysis_time"], "%Y-%m-%dT%H:%M:%SZ")
+                - datetime.datetime(1970, 1, 1)
+            )
+            // datetime.timedelta(hours=1)
+            for s in stores
+        ],
+        dtype="<i8",
+    )
+
+    # the store URLs are given as templates to keep the references short
+    templates = {f"s{i}": store["url"] for i, store in enumerate(stores)}
+    templates["template"] = template_url
+
+    attrs = dict(template.get(".zattrs", {}))
+    attrs[SOURCES_ATTR] = {s["analysis_time"]: s["published_at"] for s in stores}
+    attrs[TEMPLATE_ATTR] = template_url
+    refs = {".zgroup": dict(zarr_format=2), ".zattrs": attrs}
+    refs.update(
+        _inline_array(
+            ANALYSIS_TIME_DIM,
+            analysis_hours,
+            dict(
+                units=ANALYSIS_TIME_UNITS,
+                calendar="proleptic_gregorian",
+                standard_name="forecast_reference_time",
+            ),
+        )
+    )
+    refs.update(
+        _inline_array(
+            LEAD_TIME_DIM,
+            np.array(lead_times, dtype="<f8"),
+            dict(units="hours", standard_name="forecast_period"),
+        )
+    )
+
+    for name, (zarray, dims) in _arrays(template).items():
+        if name == SOURCE_TIME_DIM:
+            continue
+        zattrs = dict(template[f"{name}/.zattrs"])
+
+        if SOURCE_TIME_DIM not in dims:
+            refs[f"{name}/.zarray"] = zarray
+            refs[f"{name}/.zattrs"] = zattrs
+            for indices in itertools.product(*_chunk_ranges(zarray)):
+                key = _chunk_key(zarray, indices)
+                refs[f"{name}/{key}"] = [f"{{{{template}}}}/{name}/{key}"]
+            continue
+
+        i_time = dims.index(SOURCE_TIME_DIM)
+        if zarray["chunks"][i_time] != 1:
+            raise ValueError(
+                f"`{name}` has {zarray['chunks'][i_time]} timesteps per chunk, "
+                "only stores with one timestep per chunk can be aggregated"
+            )
+        rest = _without_time(zarray, dims)
+        rest["chunks"] = zarray["chunks"][:i_time] + zarray["chunks"][i_time + 1 :]
+        agg_zarray = dict(
+            zarray,
+            shape=[len(stores), len(lead_times)] + rest["shape"],
+            chunks=[1, 1] + rest["chunks"],
+        )
+        if agg_zarray["fill_value"] is None and np.dtype(zarray["dtype"]).kind == "f":
+            # chunks of lead times missing from a forecast read as NaN
+            agg_zarray["fill_value"] = "NaN"
+        zattrs["_ARRAY_DIMENSIONS"] = [ANALYSIS_TIME_DIM, LEAD_TIME_DIM] + [
+            d for d in dims if d != SOURCE_TIME_DIM
+        ]
+        refs[f"{name}/.zarray"] = agg_zarray
+        refs[f"{name}/.zattrs"] = zattrs
+
+        rest_indices = list(itertools.product(*_chunk_ranges(rest)))
+        for i_store, store in enumerate(stores):
+            for i, lead in enumerate(store["lead_times"]):
+                for indices in rest_indices:
+                    src_key = _chunk_key(
+                        zarray, indices[:i_time] + (i,) + indices[i_time:]
+                    )
+                    key = _chunk_key(agg_zarray, (i_store, i_lead[lead]) + indices)
+                    refs[f"{name}/{key}"] = [f"{{{{s{i_store}}}}}/{name}/{src_key}"]
+
+    refs[".zmetadata"] = dict(
+        zarr_consolidated_format=1,
+        metadata={
+            k: v for k, v in refs.items() if k.rsplit("/", 1)[-1].startswith(".z")
+        },
+    )
+    return dict(version=1, templates=templates, refs=refs)
+
+
+def _parse_time(t: str) -> datetime.datetime:
+    return datetime.datetime.strptime(t, "%Y-%m-%dT%H:%M:%SZ").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+def update_aggregate(
+    member: str,
+    dataset_id: str,
+    url: str = None,
+    inventory_url: str = INVENTORY_URL,
+    storage_options: dict = None,
+    retention: datetime.timedelta = AGGREGATE_RETENTION,
+    max_stores: int = AGGREGATE_MAX_STORES,
+) -> int:
+    """
+    Build the aggregate of the published stores of a member and part, or
+    update it with the stores published since it was last updated.
+
+    Parameters
+    ----------
+    member : str
+        The member name, e.g. "control".
+    dataset_id : str
+        The dataset id, e.g. "single_levels".
+    url : str, optional
+        URL of the aggregate, defaults to `aggregate_url(member, dataset_id)`.
+    inventory_url : str, optional
+        URL of the inventory of published stores.
+    storage_options : dict, optional
+        fsspec storage options for the bucket, defaults to
+        `write_zarr.s3_storage_options()`.
+    retention : datetime.timedelta, optional
+        Only stores with analysis times within `retention` of the latest one
+        are kept in the aggregate.
+    max_stores : int, optional
+        Maximum number of stores (the most recent) kept in the aggregate.
+
+    Returns
+    -------
+    int
+        The number of stores in the aggregate.
+    """
+    if storage_options is None:
+        storage_options = s3_storage_options()
+    if url is None:
+        url = aggregate_url(member=member, dataset_id=dataset_id)
+
+    def _published_stores():
+        return query_inventory(
+            read_inventory(inventory_url, storage_options=storage_options),
+            dataset_id=dataset_id,
+            member=member,
+        )
+
+    published = _published_stores()
+    if not published:
+        logger.warning(f"No published {dataset_id} stores of {member} to aggregate")
+        return 0
+    n_stores = 0
+
+    def _updated_refs(data: bytes | None) -> bytes:
+        nonlocal published, n_stores
+        if published is None:
+            # the update is being retried, and the aggregate written in the
+            # meantime may include stores published since the inventory was read
+            published = _published_stores()
+        t_latest = _parse_time(published[-1]["analysis_time"])
+        entries = query_inventory(published, start=t_latest - retention)
+        entries, published = entries[-max_stores:], None
+        urls = {entry["url"] for entry in entries}
+
+        sources, template_url = {}, entries[-1]["url"]
+        if data is not None:
+            attrs = json.loads(data)["refs"][".zattrs"]
+            # the arrays without a `time` dimension are referenced in the
+            # template store, so it must be one of the stores that are kept
+            if attrs[TEMPLATE_ATTR] in urls:
+                sources = attrs[SOURCES_ATTR]
+                template_url = attrs[TEMPLATE_ATTR]
+        template = _read_zmetadata(template_url, storage_options=storage_options)
+
+        stores = []
+        for entry in entries:
+            if sources.get(entry["analysis_time"]) != entry["published_at"]:
+                metadata = _read_zmetadata(
+                    entry["url"], storage_options=storage_options
+                )
+                if not is_compatible(metadata, template):
+                    logger.warning(
+                        f"Leaving {entry['url']} out of the aggregate, its arrays "
+                        f"differ from those of {template_url}"
+                    )
+                    continue
+            stores.append(entry)
+
+        refs = build_aggregate_refs(
+            stores, template=template, template_url=template_url
+        )
+        n_new = len(stores) - len(set(sources) & {s["analysis_time"] for s in stores})
+        n_stores = len(stores)
+        logger.info(f"Aggregating {n_stores} stores in {url} ({n_new} new)")
+        return json.dumps(refs, separators=(",", ":")).encode()
+
+    update_object(url, _updated_refs, storage_options=storage_options)
+    logger.info(f"Updated aggregate {url} with {n_stores} stores")
+    return n_stores
+
+
+def open_aggregate(
+    member: str = "control",
+    dataset_id: str = "single_levels",
+    url: str = None,
+    storage_options: dict = INVENTORY_READ_STORAGE_OPTIONS,
+) -> xr.Dataset:
+    """
+    Open the aggregate of a member and part lazily as a single dataset, with
+    `analysis_time` and `lead_time` dimensions.
+    """
+    if url is None:
+        url = aggregate_url(member=member, dataset_id=dataset_id)
+    mapper = fsspec.get_mapper(
+        "reference://",
+        fo=url,
+        target_options=storage_options,
+        remote_protocol="s3",
+        remote_options=storage_options,
+    )
+    return xr.open_zarr(mapper, consolidated=True, decode_timedelta=True)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description=(
+            "Build or update the virtual aggregates of the published zarr stores "
+            "across analysis times"
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "--members", nargs="+", default=["control"], help="Members to aggregate"
+    )
+    argparser.add_argument(
+        "--dataset-ids",
+        nargs="+",
+        default=list(DATA_COLLECTION),
+        help="Parts to aggregate",
+    )
+    argparser.add_argument(
+        "--inventory-url",
+        default=INVENTORY_URL,
+        help="URL of the inventory of published stores",
+    )
+    argparser.add_argument(
+        "--retention-days",
+        type=float,
+        default=AGGREGATE_RETENTION / datetime.timedelta(days=1),
+        help=(
+            "Only keep the stores with analysis times within this many days of "
+            "the latest one in each aggregate"
+        ),
+    )
+    argparser.add_argument(
+        "--max-stores",
+        type=int,
+        default=AGGREGATE_MAX_STORES,
+        help="Maximum number of stores (the most recent) kept in each aggregate",
+    )
+    args = argparser.parse_args(argv)
+
+    for member in args.members:
+        for dataset_id in args.dataset_ids:
+            update_aggregate(
+                member=member,
+                dataset_id=dataset_id,
+                inventory_url=args.inventory_url,
+                retention=datetime.timedelta(days=args.retention_days),
+                max_stores=args.max_stores,
+            )
+
+
+if __name__ == "__main__":
+    with logger.catch(reraise=True):
+        main()
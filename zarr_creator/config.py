@@ -1,9 +1,16 @@
 # The "data collection" may contain multiple named parts (each will be put in its own zarr archive)
 # Each part may contain multiple "level types" (e.g. heightAboveGround, etc)
-# and a name-mapping may also be defined
+# and a name-mapping may also be defined. Variables derived with a function
+# must list the GRIB variables they are derived from in `inputs`, so that only
+# the GRIB messages needed are indexed (see `zarr_creator.selection`).
+# Element-wise derived variables registered in
+# `transforms.DERIVED_VARIABLES` (e.g. wind speed and dewpoint) are listed
+# with their levels under `derived_variables` instead, and are named like the
+# GRIB variables of the same entry. Their inputs are declared in the registry
+# and are read once for all derived variables of an entry
 from collections import OrderedDict
 
-from .transforms import derive_orography_from_geopotential
+from .transforms import deaccumulate, derive_orography_from_geopotential
 
 DATA_COLLECTION = OrderedDict(
     single_levels=[
@@ -51,6 +58,20 @@ DATA_COLLECTION = OrderedDict(
             variables={
                 "orography": lambda ds: derive_orography_from_geopotential(ds["z"]),
             },
+            # the GRIB variables (and levels, `None` for all) that the derived
+            # variables above are computed from
+            inputs={"z": None},
+        ),
+        # mean radiative fluxes over each output step, de-accumulated from
+        # the accumulated fluxes so that consumers don't need to load and diff
+        # the full time axis
+        dict(
+            level_type="heightAboveGround",
+            variables={
+                "swavr_mean0m": lambda ds: deaccumulate(ds["swavr_accum"]),
+                "lwavr_mean0m": lambda ds: deaccumulate(ds["lwavr_accum"]),
+            },
+            inputs={"swavr_accum": None, "lwavr_accum": None},
         ),
         dict(
             level_type="heightAboveGround",
@@ -61,6 +82,11 @@ DATA_COLLECTION = OrderedDict(
                 "u": [10],
                 "v": [10],
             },
+            derived_variables={
+                "td": [2],
+                "ws": [10],
+                "wdir": [10],
+            },
             level_name_mapping="{var_name}{level:d}m",
         ),
         dict(
@@ -107,6 +133,67 @@ DATA_COLLECTION = OrderedDict(
                 v: [50, 100, 150, 250]  # only these in DINI
                 for v in "t r u v".split()
             },
+            derived_variables={v: [50, 100, 150, 250] for v in ["ws", "wdir"]},
         )
     ],
 )
+
+# Chunking of the zarr archive written for each part. Integer values give the
+# chunk size along a dimension, float values give the chunk size as a fraction
+# of the dimension size (e.g. `0.5` splits the dimension into two chunks).
+# Dimensions that aren't listed (e.g. `pressure` and `altitude`) are stored in
+# a single chunk. When members are stacked into one store (`--stack-members`)
+# each member is stored in separate chunks, so that a single member can be
+# read without reading the others
+OUTPUT_CHUNKING = OrderedDict(
+    single_levels=dict(member=1, time=1, x=0.5, y=0.5),
+    pressure_levels=dict(member=1, time=1, x=0.5, y=0.5),
+    height_levels=dict(member=1, time=1, x=0.5, y=0.5),
+)
+
+# Chunking of the optional point stores (`--point-stores`, see
+# `zarr_creator.points`), laid out for reading time series at single
+# locations: the full time axis (`time=None`, i.e. not split into chunks, like
+# the levels that aren't listed) in each chunk, with small x/y tiles. The tiles
+# don't need to divide the grid evenly
+POINT_OUTPUT_CHUNKING = OrderedDict(
+    single_levels=dict(member=1, time=None, x=32, y=32),
+    pressure_levels=dict(member=1, time=None, x=16, y=16),
+    height_levels=dict(member=1, time=None, x=16, y=16),
+)
+
+# Compression of the variables in the output zarr archives. Each codec profile
+# sets the Blosc compressor (`cname`, `clevel` and `shuffle`) and optionally:
+# - `keepbits`: number of mantissa bits kept when bit-rounding floating point
+#   values (the rest are rounded to zero so that they compress well),
+#   `None` keeps all bits
+# - `dtype`: the type the values are stored as, with `scale_factor`,
+#   `add_offset` and `fill_value` (for missing values) to pack floating point
+#   values into an integer type (CF packing, unpacked by xarray on reading)
+# `scripts/benchmark_codecs.py` reports the compression ratio and encoding
+# throughput of each profile for an existing output zarr archive
+CODEC_PROFILES = dict(
+    # lossless, used for all variables not listed in `VARIABLE_CODEC_PROFILES`
+    default=dict(cname="zstd", clevel=5, shuffle="shuffle"),
+    # keeps 12 mantissa bits, i.e. a relative precision of ~2.4e-4 (e.g.
+    # ~0.07K at 290K)
+    bitround12=dict(cname="zstd", clevel=5, shuffle="bitshuffle", keepbits=12),
+    # fractions in [0, 1] (e.g. cloud cover and land-sea mask) stored to a
+    # precision of 0.01 as single bytes
+    fraction=dict(
+        cname="zstd",
+        clevel=5,
+        shuffle="noshuffle",
+        dtype="uint8",
+        scale_factor=0.01,
+        fill_value=255,
+    ),
+)
+
+# Codec profile (a key in `CODEC_PROFILES`) used for each output variable
+VARIABLE_CODEC_PROFILES = dict(
+    hcc="fraction",
+    lcc="fraction",
+    mcc="fraction",
+    lsm="fraction",
+)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Long-running scheduler which watches `SRC_GRIB_ROOT_PATH` for the GRIB files
+of new forecasts and converts each forecast as soon as all of its files have
+arrived, replacing the polling loop in `run.sh`.
+
+All forecasts (analysis times and members) with files in `SRC_GRIB_ROOT_PATH`
+are tracked at once by listing the directory every `--poll-interval` seconds.
+A forecast is converted once the `sf` and `pl` files of every forecast hour
+exist and haven't changed size since the previous listing (so that files
+still being written aren't read). eccodes, the dask scheduler and the s3fs
+session are set up once and stay warm in this process between forecasts.
+
+Each forecast is converted as `python -m zarr_creator` converts it (with the
+same grid geometry, point stores, station index, memory budget and run
+report), with any options the daemon doesn't know passed on to the
+conversion.
+
+Usage:
+
+    python -m zarr_creator.daemon --member-ids CONTROL__dmi --point-stores
+"""
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+from loguru import logger
+
+from . import __main__ as cli_main
+from .config import DATA_COLLECTION
+from .grib_definitions import set_local_eccodes_definitions_path
+from .indexing import GRIB_FILE_TYPES, SRC_GRIB_ROOT_PATH, build_indexes_and_refs
+from .instrumentation import run_report, stage
+from .publish import read_publish_marker
+from .scheduler import dask_scheduler
+from .selection import required_messages
+from .settings import PROMETHEUS_TEXTFILE, RUN_REPORT_PATH
+from .write_zarr import output_member_name, output_url, s3_storage_options
+
+# matches the GRIB filenames of `indexing.GRIB_FILENAME_FORMAT`
+GRIB_FILENAME_REGEX = re.compile(
+    r"^fc(?P<t_analysis>\d{10})\+(?P<hour>\d{3})(?P<member_id>.+)_(?P<file_type>[a-z]+)$"
+)
+
+
+def parse_grib_filename(fn: str) -> tuple | None:
+    """
+    Parse a GRIB filename (e.g. `fc2025030206+042CONTROL__dmi_pl`) into the
+    analysis time, member id, forecast hour and file type, returning `None` if
+    `fn` isn't a GRIB file of a forecast.
+    """
+    match = GRIB_FILENAME_REGEX.match(fn)
+    if match is None or match["file_type"] not in GRIB_FILE_TYPES:
+        return None
+    t_analysis = datetime.datetime.strptime(match["t_analysis"], "%Y%m%d%H").replace(
+        tzinfo=datetime.timezone.utc
+    )
+    return t_analysis, match["member_id"], int(match["hour"]), match["file_type"]
+
+
+def scan_grib_files(root_path: str) -> dict:
+    """
+    List the GRIB files in `root_path` with a single directory scan, returning
+    the size of each file keyed by `(t_analysis, member_id)` and then by
+    `(hour, file_type)`.
+    """
+    forecasts = {}
+    with os.scandir(root_path) as entries:
+        for entry in entries:
+            parsed = parse_grib_filename(entry.name)
+            if parsed is None or not entry.is_file():
+                continue
+            t_analysis, member_id, hour, file_type = parsed
+            forecasts.setdefault((t_analysis, member_id), {})[
+                (hour, file_type)
+            ] = entry.stat().st_size
+    return forecasts
+
+
+class ForecastTracker:
+    """
+    Tracks the GRIB files of all forecasts between directory scans to find the
+    forecasts which are complete and ready to be converted.
+
+    Parameters
+    ----------
+    max_hour : int
+        Maximum forecast hour (inclusive) of a complete forecast.
+    member_ids : list of str, optional
+        The members to convert, all members are converted if not given.
+    lookback : datetime.timedelta, optional
+        Forecasts with analysis times older than this are ignored, so that
+        old forecasts left in the source directory aren't converted.
+    retry_interval : datetime.timedelta, optional
+        Time to wait before retrying a forecast whose conversion failed.
+    """
+
+    def __init__(
+        self,
+        max_hour: int,
+        member_ids: list = None,
+        lookback: datetime.timedelta = datetime.timedelta(hours=24),
+        retry_interval: datetime.timedelta = datetime.timedelta(minutes=5),
+    ):
+        self.max_hour = max_hour
+        self.member_ids = member_ids
+        self.lookback = lookback
+        self.retry_interval = retry_interval
+        self.expected_files = {
+            (hour, file_type)
+            for hour in range(max_hour + 1)
+            for file_type in GRIB_FILE_TYPES
+        }
+        self.done = set()
+        self._retry_after = {}
+        self._previous_sizes = {}
+
+    def ready_forecasts(self, forecasts: dict, now: datetime.datetime) -> list:
+        """
+        Find the forecasts in `forecasts` (see `scan_grib_files`) which are
+        complete, haven't changed since the previous scan and haven't been
+        converted yet, ordered by analysis time.
+        """
+        ready = []
+        for key, file_sizes in forecasts.items():
+            t_analysis, member_id = key
+            if key in self.done or t_analysis < now - self.lookback:
+                continue
+            if self.member_ids is not None and member_id not in self.member_ids:
+                continue
+            if now < self._retry_after.get(key, now):
+                continue
+            if not self.expected_files.issubset(file_sizes):
+                continue
+
+            sizes = {k: file_sizes[k] for k in self.expected_files}
+            if self._previous_sizes.get(key) == sizes:
+                ready.append(key)
+            else:
+                logger.debug(f"All files of {key} exist, waiting for them to settle")
+            self._previous_sizes[key] = sizes
+        return sorted(ready)
+
+    def mark_done(self, key: tuple):
+        """Stop tracking the forecast `key`, which has been converted."""
+        self.done.add(key)
+        self._previous_sizes.pop(key, None)
+        self._retry_after.pop(key, None)
+
+    def mark_failed(self, key: tuple, now: datetime.datetime):
+        """Retry converting the forecast `key` after the retry interval."""
+        self._retry_after[key] = now + self.retry_interval
+
+
+def is_published(t_analysis: datetime.datetime, member: str) -> bool:
+    """
+    Check if all parts of a forecast have been published to the S3 bucket.
+    """
+    return all(
+        read_publish_marker(
+            output_url(member=member, t_analysis=t_analysis, dataset_id=part_id),
+            storage_options=s3_storage_options(),
+        )
+        is not None
+        for part_id in DATA_COLLECTION
+    )
+
+
+def conversion_args(
+    t_analysis: datetime.datetime,
+    member_id: str,
+    n_workers: int = None,
+    memory_limit: str = None,
+    skip_s3_bucket_upload: bool = False,
+    conversion_argv: list = (),
+) -> argparse.Namespace:
+    """
+    The arguments of the command line interface (see
+    `python -m zarr_creator --help`) to convert a forecast with, from the
+    options in `conversion_argv` (e.g. `["--point-stores"]`) and the analysis
+    time, member and scheduler options of the daemon. The conversion is
+    always resumed, so that an interrupted attempt is continued.
+    """
+    argv = [
+        *conversion_argv,
+        "--t_analysis",
+        t_analysis.isoformat(),
+        "--members",
+        member_id,
+        "--resume",
+    ]
+    if n_workers is not None:
+        argv += ["--n-workers", str(n_workers)]
+    if memory_limit is not None:
+        argv += ["--memory-limit", memory_limit]
+    if skip_s3_bucket_upload:
+        argv += ["--skip-s3-bucket-upload"]
+    return cli_main._setup_argparse().parse_args(argv)
+
+
+def convert_forecast(
+    t_analysis: datetime.datetime,
+    member_id: str,
+    max_hour: int,
+    root_path: str = None,
+    n_workers: int = None,
+    cache_path: str = None,
+    skip_s3_bucket_upload: bool = False,
+    memory_limit: str = None,
+    report_path: str = RUN_REPORT_PATH,
+    prometheus_textfile: str = PROMETHEUS_TEXTFILE,
+    conversion_argv: list = (),
+):
+    """
+    Index the GRIB files of a complete forecast, build its refs and convert
+    the forecast as the command line interface does (see
+    `__main__._convert`), with the options in `conversion_argv` (see
+    `conversion_args`), using the dask scheduler already running in the
+    daemon. A run report (see `instrumentation.run_report`) is written for
+    each forecast converted.
+    """
+    args = conversion_args(
+        t_analysis=t_analysis,
+        member_id=member_id,
+        n_workers=n_workers,
+        memory_limit=memory_limit,
+        skip_s3_bucket_upload=skip_s3_bucket_upload,
+        conversion_argv=conversion_argv,
+    )
+    with run_report(
+        t_analysis=t_analysis,
+        report_path=report_path,
+        prometheus_textfile=prometheus_textfile,
+        member_id=member_id,
+    ):
+        with stage("build_refs", member=output_member_name(member_id)):
+            build_indexes_and_refs(
+                t_analysis=t_analysis,
+                max_hour=max_hour,
+                n_workers=n_workers,
+                member_id=member_id,
+                root_path=root_path,
+                cache_path=cache_path,
+                selection=required_messages(),
+            )
+        cli_main._convert(args, start_scheduler=False)
+
+
+def run_daemon(
+    max_hour: int,
+    member_ids: list = None,
+    root_path: str = SRC_GRIB_ROOT_PATH,
+    poll_interval: float = 10.0,
+    lookback: datetime.timedelta = datetime.timedelta(hours=24),
+    retry_interval: datetime.timedelta = datetime.timedelta(minutes=5),
+    n_workers: int = None,
+    memory_limit: str = None,
+    cache_path: str = None,
+    skip_s3_bucket_upload: bool = False,
+    report_path: str = RUN_REPORT_PATH,
+    prometheus_textfile: str = PROMETHEUS_TEXTFILE,
+    conversion_argv: list = (),
+    max_polls: int = None,
+):
+    """
+    Watch `root_path` and convert each forecast as soon as it is complete.
+
+    Parameters
+    ----------
+    max_hour : int
+        Maximum forecast hour (inclusive) of a complete forecast.
+    member_ids : list of str, optional
+        The members to convert (as in the GRIB filenames, e.g.
+        "CONTROL__dmi"), all members are converted if not given.
+    root_path : str, optional
+        Directory the GRIB files arrive in.
+    poll_interval : float, optional
+        Seconds between scans of `root_path`.
+    lookback : datetime.timedelta, optional
+        Forecasts with older analysis times are ignored.
+    retry_interval : datetime.timedelta, optional
+        Time to wait before retrying a forecast whose conversion failed.
+    n_workers : int, optional
+        Number of indexing worker processes and dask workers.
+    memory_limit : str, optional
+        Total memory budget for the conversion, shared by the dask workers
+        (see `dask_scheduler`) and bounding the writes (see
+        `memory.write_bounded`).
+    cache_path : str, optional
+        Directory of the GRIB index cache, see `indexing.index_files`.
+    skip_s3_bucket_upload : bool, optional
+        If True, only write the local copies of the zarr stores.
+    report_path : str, optional
+        Directory the run report of each forecast is written to, see
+        `instrumentation.run_report_path`.
+    prometheus_textfile : str, optional
+        If given, the run report of the latest forecast converted is also
+        written as Prometheus metrics to this file.
+    conversion_argv : list of str, optional
+        Options of the command line interface to convert each forecast with,
+        see `conversion_args`.
+    max_polls : int, optional
+        Stop after this many scans of `root_path`, runs forever by default.
+    """
+    tracker = ForecastTracker(
+        max_hour=max_hour,
+        member_ids=member_ids,
+        lookback=lookback,
+        retry_interval=retry_interval,
+    )
+    logger.info(
+        f"Watching {root_path} for forecasts of members "
+        f"{member_ids or 'all'} up to hour {max_hour}"
+    )
+
+    with dask_scheduler(n_workers=n_workers, memory_limit=memory_limit):
+        n_polls = 0
+        while max_polls is None or n_polls < max_polls:
+            t_poll_start = time.monotonic()
+            now = datetime.datetime.now(datetime.timezone.utc)
+
+            for key in tracker.ready_forecasts(scan_grib_files(root_path), now=now):
+                t_analysis, member_id = key
+                member = output_member_name(member_id)
+                if not skip_s3_bucket_upload and is_published(t_analysis, member):
+                    logger.info(f"{t_analysis} ({member_id}) is already published")
+                    tracker.mark_done(key)
+                    continue
+
+                logger.info(f"Converting {t_analysis} ({member_id})")
+                t_start = time.monotonic()
+                try:
+                    convert_forecast(
+                        t_analysis=t_analysis,
+                        member_id=member_id,
+                        max_hour=max_hour,
+                        root_path=root_path,
+                        n_workers=n_workers,
+                        cache_path=cache_path,
+                        skip_s3_bucket_upload=skip_s3_bucket_upload,
+                        memory_limit=memory_limit,
+                        report_path=report_path,
+                        prometheus_textfile=prometheus_textfile,
+                        conversion_argv=conversion_argv,
+                    )
+                except Exception:
+                    logger.exception(f"Converting {t_analysis} ({member_id}) failed")
+                    tracker.mark_failed(
+                        key, now=datetime.datetime.now(datetime.timezone.utc)
+                    )
+                else:
+                    logger.info(
+                        f"Published {t_analysis} ({member_id}) "
+                        f"{time.monotonic() - t_start:.0f}s after it was complete"
+                    )
+                    tracker.mark_done(key)
+
+            n_polls += 1
+            if max_polls is None or n_polls < max_polls:
+                time.sleep(max(0.0, poll_interval - (time.monotonic() - t_poll_start)))
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description="Convert forecasts to zarr as soon as all their GRIB files arrive",
+        epilog=(
+            "Any other options are passed on to the conversion of each forecast, "
+            "see `python -m zarr_creator --help` (e.g. --point-stores or "
+            "--concurrent-parts)"
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "--member-ids",
+        nargs="+",
+        default=[os.getenv("MEMBER_ID", "CONTROL__dmi")],
+        help="Members to convert (as in the GRIB filenames)",
+    )
+    argparser.add_argument(
+        "--all-members",
+        action="store_true",
+        help="Convert all members with GRIB files, ignoring --member-ids",
+    )
+    argparser.add_argument(
+        "--max-hour",
+        type=int,
+        default=int(os.getenv("MAX_HOUR", 36)),
+        help="Maximum forecast hour of a complete forecast (inclusive)",
+    )
+    argparser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between scans of SRC_GRIB_ROOT_PATH for new GRIB files",
+    )
+    argparser.add_argument(
+        "--lookback-hours",
+        type=float,
+        default=24.0,
+        help="Ignore forecasts with analysis times older than this many hours",
+    )
+    argparser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of indexing processes and dask workers (defaults to the number of CPUs)",
+    )
+    argparser.add_argument(
+        "--memory-limit",
+        default=None,
+        help=(
+            "Total memory budget for the conversion, e.g. `16GB`, shared by the "
+            "dask workers and bounding the writes. Requires dask.distributed "
+            "(dependency group 'distributed')"
+        ),
+    )
+    argparser.add_argument(
+        "--index-cache-path",
+        default=os.getenv("INDEX_CACHE_PATH") or None,
+        help="If set, keep GRIB index files in this directory, see zarr_creator.indexing",
+    )
+    argparser.add_argument(
+        "--skip-s3-bucket-upload",
+        action="store_true",
+        help="If provided, skip uploading zarr outputs to the S3 bucket.",
+    )
+    argparser.add_argument(
+        "--run-report-path",
+        default=RUN_REPORT_PATH,
+        help=(
+            "Directory the JSON run report of each forecast is written to, as "
+            "`<analysis_time>_<member_id>.json`"
+        ),
+    )
+    argparser.add_argument(
+        "--prometheus-textfile",
+        default=PROMETHEUS_TEXTFILE,
+        help=(
+            "If given, also write the run report of the latest forecast "
+            "converted as Prometheus metrics to this file"
+        ),
+    )
+    argparser.add_argument("--log-level", default="INFO", help="The log level to use")
+    args, conversion_argv = argparser.parse_known_args(argv)
+    # fail on unknown options now rather than when converting the first forecast
+    cli_main._setup_argparse().parse_args(conversion_argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+
+    set_local_eccodes_definitions_path()
+
+    run_daemon(
+        max_hour=args.max_hour,
+        member_ids=None if args.all_members else args.member_ids,
+        poll_interval=args.poll_interval,
+        lookback=datetime.timedelta(hours=args.lookback_hours),
+        n_workers=args.n_workers,
+        memory_limit=args.memory_limit,
+        cache_path=args.index_cache_path,
+        skip_s3_bucket_upload=args.skip_s3_bucket_upload,
+        report_path=args.run_report_path,
+        prometheus_textfile=args.prometheus_textfile,
+        conversion_argv=conversion_argv,
+    )
+
+
+if __name__ == "__main__":
+    with logger.catch(reraise=True):
+        main()
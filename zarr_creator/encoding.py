@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Encoding (compression, bit-rounding and packing) of the variables in the output
+zarr archives, built from the codec profiles in `config.CODEC_PROFILES` and
+assigned to variables with `config.VARIABLE_CODEC_PROFILES`.
+
+The encoding is set on each variable's `.encoding` so that it is used both
+when writing directly with `Dataset.to_zarr` and when writing via `rechunker`.
+Bit-rounding is applied as a zarr filter (`numcodecs.BitRound`), so that it is
+stored in the array metadata and also applied to data appended to an existing
+store.
+"""
+import numcodecs
+import numpy as np
+import xarray as xr
+from loguru import logger
+from numcodecs import BitRound, Blosc
+from numcodecs.compat import ensure_ndarray_like
+
+from .config import CODEC_PROFILES, VARIABLE_CODEC_PROFILES
+
+DEFAULT_CODEC_PROFILE = "default"
+
+BLOSC_SHUFFLES = dict(
+    noshuffle=Blosc.NOSHUFFLE,
+    shuffle=Blosc.SHUFFLE,
+    bitshuffle=Blosc.BITSHUFFLE,
+)
+# number of mantissa bits in each floating point type, the maximum `keepbits`
+MANTISSA_BITS = {np.dtype("float32"): 23, np.dtype("float64"): 52}
+
+
+class CopyingBitRound(BitRound):
+    """
+    `numcodecs.BitRound` filter which rounds a copy of each chunk, as
+    `BitRound` rounds the chunk it is given in place, which would change the
+    values of the variable for any other computations that use them (e.g.
+    `u` and `v` for the derived wind speed). zarr builds the filters of an
+    array from its metadata, so this is registered as the codec of
+    `BitRound`'s id in this process. The codec id and configuration are
+    those of `BitRound`, so the stores can be read without this package.
+    """
+
+    def encode(self, buf):
+        return super().encode(ensure_ndarray_like(buf).copy())
+
+
+numcodecs.register_codec(CopyingBitRound)
+
+
+def codec_encoding(profile: dict, dtype: np.dtype) -> dict:
+    """
+    Build the xarray zarr encoding for a variable of type `dtype` from a codec
+    profile.
+
+    Parameters
+    ----------
+    profile : dict
+        The codec profile, with the Blosc compressor settings `cname`,
+        `clevel` and `shuffle` (one of "noshuffle", "shuffle" or
+        "bitshuffle"), and optionally `keepbits` (the number of mantissa bits
+        kept when bit-rounding floating point values), `dtype` (the type the
+        values are stored as) with `scale_factor`, `add_offset` and
+        `fill_value` to pack floating point values into an integer type.
+    dtype : numpy.dtype
+        The (decoded) type of the variable.
+
+    Returns
+    -------
+    dict
+        The encoding to set on the variable.
+    """
+    encoding = dict(
+        compressor=Blosc(
+            cname=profile.get("cname", "zstd"),
+            clevel=profile.get("clevel", 5),
+            shuffle=BLOSC_SHUFFLES[profile.get("shuffle", "shuffle")],
+        )
+    )
+
+    stored_dtype = np.dtype(profile.get("dtype", dtype))
+    if stored_dtype != dtype:
+        encoding["dtype"] = stored_dtype
+    for key in ["scale_factor", "add_offset"]:
+        if key in profile:
+            encoding[key] = profile[key]
+    if "fill_value" in profile:
+        encoding["_FillValue"] = profile["fill_value"]
+
+    keepbits = profile.get("keepbits")
+    if keepbits is not None:
+        if stored_dtype not in MANTISSA_BITS:
+            raise ValueError(
+                f"Bit-rounding (keepbits={keepbits}) can only be applied to "
+                f"floating point values, not {stored_dtype}"
+            )
+        if not 0 <= keepbits <= MANTISSA_BITS[stored_dtype]:
+            raise ValueError(
+                f"keepbits must be between 0 and {MANTISSA_BITS[stored_dtype]} "
+                f"for {stored_dtype}, got {keepbits}"
+            )
+        encoding["filters"] = [CopyingBitRound(keepbits=keepbits)]
+
+    return encoding
+
+
+def variable_codec_profile(var_name: str) -> str:
+    """
+    Name of the codec profile used for the variable `var_name`.
+    """
+    return VARIABLE_CODEC_PROFILES.get(var_name, DEFAULT_CODEC_PROFILE)
+
+
+def apply_codec_profiles(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Set the encoding of every data variable in `ds` from its codec profile,
+    replacing any existing encoding, so that the zarr dataset that is written
+    isn't reliant on the gribscan package's decoding functions.
+    """
+    ds = ds.copy()
+    ds.encoding = {}
+    for var_name in ds.data_vars:
+        profile_name = variable_codec_profile(var_name)
+        logger.debug(f"Encoding {var_name} with codec profile `{profile_name}`")
+        ds[var_name].encoding = codec_encoding(
+            CODEC_PROFILES[profile_name], dtype=ds[var_name].dtype
+        )
+    return ds
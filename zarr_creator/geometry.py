@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cached geometry (2D latitude and longitude, and optionally cell bounds and
+grid rotation angles) of the model grid. The geometry is computed once per
+grid definition (projection, x and y coordinates) and stored in a zarr store
+in `GRID_GEOMETRY_CACHE_PATH`, which is reused across runs and parts.
+
+The output datasets either get a copy of the cached 2D coordinates, or
+(rather than writing the same arrays into every output store) a link to a
+single copy of the geometry store uploaded next to the outputs in the S3
+bucket, in the `grid_geometry` global attribute.
+"""
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+from .publish import (
+    publish_local_store,
+    publish_marker,
+    read_publish_marker,
+    staging_path,
+    write_publish_marker,
+)
+from .settings import GRID_GEOMETRY_CACHE_PATH
+from .write_zarr import BUCKET_NAME, copy_zarr_store, s3_storage_options
+
+GRID_GEOMETRY_PREFIX_FORMAT = "dini/grid/{name}.zarr"
+
+# names of the 2D coordinates gribscan gives the grid
+LATITUDE = "lat"
+LONGITUDE = "lon"
+BOUNDS_DIM = "nv"
+ROTATION = "grid_rotation"
+
+
+def _grid_mapping_name(ds: xr.Dataset) -> str | None:
+    for var_name in ds.variables:
+        if "grid_mapping" in ds[var_name].attrs:
+            return ds[var_name].attrs["grid_mapping"]
+    return None
+
+
+def grid_key(ds: xr.Dataset) -> str:
+    """
+    Short stable hash of the grid definition of `ds` (the WKT of its grid
+    mapping and its x and y coordinates), identifying the cached geometry.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    grid_mapping = _grid_mapping_name(ds)
+    if grid_mapping is not None:
+        h.update(ds[grid_mapping].attrs.get("crs_wkt", "").encode())
+    for dim in ["x", "y"]:
+        h.update(np.ascontiguousarray(ds[dim].values, dtype="f8").tobytes())
+    return h.hexdigest()
+
+
+def _cell_corners(a: np.ndarray) -> np.ndarray:
+    # values at the cell corners, as the mean of the four surrounding cell
+    # centres, linearly extrapolated at the edges of the grid
+    a = np.pad(a, 1, mode="reflect", reflect_type="odd")
+    return 0.25 * (a[:-1, :-1] + a[1:, :-1] + a[:-1, 1:] + a[1:, 1:])
+
+
+def _cell_bounds(a: np.ndarray) -> np.ndarray:
+    corners = _cell_corners(a)
+    # CF order: counterclockwise starting at the corner with the smallest
+    # x and y indices
+    return np.stack(
+        [corners[:-1, :-1], corners[:-1, 1:], corners[1:, 1:], corners[1:, :-1]],
+        axis=-1,
+    )
+
+
+def build_grid_geometry(
+    ds: xr.Dataset, bounds: bool = False, rotation: bool = False
+) -> xr.Dataset:
+    """
+    Build the grid geometry of `ds` from its 2D `lat` and `lon`
+    coordinates.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        A dataset on the grid, with `x` and `y` dimensions and 2D `lat` and
+        `lon` coordinates.
+    bounds : bool, optional
+        Include the latitude and longitude of the four corners of each cell.
+    rotation : bool, optional
+        Include the angle (counterclockwise, in degrees) from east to the
+        grid x-axis, used to rotate grid-relative winds to east/north
+        components.
+    """
+    if LATITUDE not in ds.coords or LONGITUDE not in ds.coords:
+        raise ValueError(
+            f"Dataset has no `{LATITUDE}` and `{LONGITUDE}` coordinates to build "
+            "the grid geometry from"
+        )
+    lat = ds[LATITUDE].transpose("y", "x")
+    lon = ds[LONGITUDE].transpose("y", "x")
+    ds_geometry = xr.Dataset(
+        coords={
+            "x": ds["x"],
+            "y": ds["y"],
+            LATITUDE: lat.compute(),
+            LONGITUDE: lon.compute(),
+        }
+    )
+    grid_mapping = _grid_mapping_name(ds)
+    if grid_mapping is not None:
+        ds_geometry[grid_mapping] = ds[grid_mapping]
+
+    lat_values = ds_geometry[LATITUDE].values
+    lon_values = ds_geometry[LONGITUDE].values
+    if bounds:
+        for name, values in [(LATITUDE, lat_values), (LONGITUDE, lon_values)]:
+            ds_geometry.coords[f"{name}_bounds"] = (
+                ("y", "x", BOUNDS_DIM),
+                _cell_bounds(values),
+                {"units": ds_geometry[name].attrs.get("units", "")},
+            )
+            ds_geometry[name].attrs["bounds"] = f"{name}_bounds"
+    if rotation:
+        dlat = np.gradient(lat_values, axis=-1)
+        dlon = np.gradient(lon_values, axis=-1) * np.cos(np.radians(lat_values))
+        ds_geometry.coords[ROTATION] = (
+            ("y", "x"),
+            np.degrees(np.arctan2(dlat, dlon)),
+            {
+                "units": "degree",
+                "long_name": "Angle from east to the grid x-axis " "(counterclockwise)",
+            },
+        )
+    if grid_mapping is not None:
+        for name in ds_geometry.coords:
+            if "y" in ds_geometry[name].dims and "x" in ds_geometry[name].dims:
+                ds_geometry[name].attrs["grid_mapping"] = grid_mapping
+    return ds_geometry
+
+
+def grid_geometry_name(
+    ds: xr.Dataset, bounds: bool = False, rotation: bool = False
+) -> str:
+    """
+    Name of the cached geometry store for the grid of `ds`, e.g.
+    "3f2a9c0d1e4b5a6c-bounds-rotation".
+    """
+    name = grid_key(ds)
+    if bounds:
+        name += "-bounds"
+    if rotation:
+        name += "-rotation"
+    return name
+
+
+def cached_grid_geometry(
+    ds: xr.Dataset,
+    cache_path: str = GRID_GEOMETRY_CACHE_PATH,
+    bounds: bool = False,
+    rotation: bool = False,
+) -> tuple[xr.Dataset, Path]:
+    """
+    Load the grid geometry of `ds` from the cache, building and caching it
+    first if this grid hasn't been seen before (see `build_grid_geometry`).
+
+    Returns
+    -------
+    xarray.Dataset
+        The grid geometry, loaded into memory.
+    pathlib.Path
+        Path of the cached geometry store.
+    """
+    name = grid_geometry_name(ds, bounds=bounds, rotation=rotation)
+    fp = Path(cache_path) / f"{name}.zarr"
+
+    if read_publish_marker(str(fp)) is None:
+        logger.info(f"Building grid geometry {name}")
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        ds_geometry = build_grid_geometry(ds, bounds=bounds, rotation=rotation)
+        # several runs may share the cache, so the store is written to a
+        # staging directory and renamed into place once complete
+        fp_staging = staging_path(fp)
+        ds_geometry.to_zarr(fp_staging, mode="w", consolidated=True)
+        write_publish_marker(str(fp_staging), publish_marker(str(fp_staging)))
+        publish_local_store(fp_staging, fp)
+    else:
+        logger.info(f"Using cached grid geometry {fp}")
+
+    return xr.open_zarr(fp).load(), fp
+
+
+def grid_geometry_url(name: str) -> str:
+    """
+    URL of the geometry store with name `name` (see `grid_geometry_name`) in
+    the S3 bucket.
+    """
+    return f"s3://{BUCKET_NAME}/{GRID_GEOMETRY_PREFIX_FORMAT.format(name=name)}"
+
+
+def upload_grid_geometry(fp: Path, url: str) -> None:
+    """
+    Upload the cached geometry store `fp` to `url`, unless it has already
+    been uploaded (by an earlier run for the same grid).
+    """
+    storage_options = s3_storage_options()
+    if read_publish_marker(url, storage_options=storage_options) is not None:
+        logger.info(f"Grid geometry already uploaded to {url}")
+        return
+    copy_zarr_store(src=str(fp), dst=url, dst_storage_options=storage_options)
+
+
+def attach_grid_geometry(
+    ds: xr.Dataset, ds_geometry: xr.Dataset, link: str = None
+) -> xr.Dataset:
+    """
+    Include the grid geometry in the output dataset `ds`, either by copying
+    the 2D coordinates of `ds_geometry` (replacing those read from the
+    refs), or, if `link` is given, by dropping the 2D coordinates from `ds`
+    and storing `link` (the URL of the geometry store) in its `grid_geometry`
+    attribute.
+    """
+    geometry_coords = [
+        name for name in ds_geometry.coords if name not in ds_geometry.dims
+    ]
+    if link is not None:
+        ds = ds.drop_vars([name for name in geometry_coords if name in ds.variables])
+        ds.attrs["grid_geometry"] = link
+        return ds
+
+    if not np.array_equal(ds["x"].values, ds_geometry["x"].values) or not (
+        np.array_equal(ds["y"].values, ds_geometry["y"].values)
+    ):
+        raise ValueError("Dataset is on a different grid than the grid geometry")
+    return ds.assign_coords({name: ds_geometry[name] for name in geometry_coords})
@@ -6,7 +6,6 @@ with eccodes.
 
 import importlib.resources as pkg_resources
 
-import eccodes
 from loguru import logger
 
 # pkg_resources.path requires that we provide the path to a file, so we give a
@@ -48,6 +47,11 @@ def set_local_eccodes_definitions_path():
     # works, lol
     p = f"{LOCAL_GRIB_DEFNS_PATH}:{p_default}"
 
+    # eccodes is imported here rather than at the top of the module, so that
+    # the modules that only need to call this function (e.g. the command line
+    # interfaces) can be imported without loading the eccodes library
+    import eccodes
+
     logger.info(f"Setting eccodes definitions path to: {p}")
     eccodes.codes_set_definitions_path(p)
 
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Building of GRIB indexes and gribscan refs for a forecast in a single python
+process. This replaces calling `zarr_creator.build_indexes` and
+`gribscan-build` separately for each file type from
+`build_indexes_and_refs.sh`, so that eccodes is only imported once and all the
+`sf` and `pl` files are indexed by one pool of worker processes.
+
+Usage:
+
+    python -m zarr_creator.indexing --t_analysis 2025-03-02T00:00:00Z
+
+Will index the GRIB files
+
+    {SRC_GRIB_ROOT_PATH}/fc2025030200+000CONTROL__dmi_sf
+    {SRC_GRIB_ROOT_PATH}/fc2025030200+000CONTROL__dmi_pl
+    ...
+    {SRC_GRIB_ROOT_PATH}/fc2025030200+036CONTROL__dmi_pl
+
+and write the refs (one .json file per level type) to
+`{REFS_ROOT_PATH}/{MEMBER_ID}/2025-03-02T0000Z.jsons/`.
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import isodate
+from loguru import logger
+
+# eccodes and gribscan (which imports xarray) are imported once files are
+# indexed, and the modules that import xarray once the refs are built, so that
+# e.g. `--help` returns quickly
+from .grib_definitions import set_local_eccodes_definitions_path
+
+SRC_GRIB_ROOT_PATH = os.getenv("SRC_GRIB_ROOT_PATH", "/mnt/harmonie-data-from-pds/ml")
+GRIB_FILE_TYPES = ["sf", "pl"]
+GRIB_FILENAME_FORMAT = "fc{t_analysis:%Y%m%d%H}+{hour:03d}{member_id}_{file_type}"
+# number of bytes read from the start and end of each GRIB file when computing
+# the index cache key
+INDEX_CACHE_HASH_NBYTES = 64 * 1024
+# size of the read buffer used when scanning GRIB files for indexing
+INDEX_READ_BUFFER_SIZE = 16 * 1024 * 1024
+# index files in the cache that haven't been modified for longer than this are
+# removed, so that the cache doesn't keep growing
+INDEX_CACHE_MAX_AGE = datetime.timedelta(days=3)
+# start method of the indexing worker processes, see `index_files`
+INDEX_WORKER_START_METHOD = "forkserver"
+
+
+def grib_filepath(
+    t_analysis: datetime.datetime,
+    hour: int,
+    file_type: str,
+    member_id: str = None,
+    root_path: str = None,
+) -> Path:
+    """
+    Path of the source GRIB file for a given analysis time, forecast hour and
+    file type (`sf` or `pl`), e.g. `fc2025030206+042CONTROL__dmi_pl`.
+    """
+    if member_id is None:
+        member_id = os.getenv("MEMBER_ID", "CONTROL__dmi")
+    if root_path is None:
+        root_path = SRC_GRIB_ROOT_PATH
+    fn = GRIB_FILENAME_FORMAT.format(
+        t_analysis=t_analysis, hour=hour, member_id=member_id, file_type=file_type
+    )
+    return Path(root_path) / fn
+
+
+def forecast_grib_files(
+    t_analysis: datetime.datetime,
+    max_hour: int,
+    member_id: str = None,
+    root_path: str = None,
+) -> dict:
+    """
+    Paths of all GRIB files of a forecast, as a dict of lists of paths (one
+    for each forecast hour `0..max_hour`) keyed by file type.
+    """
+    return {
+        file_type: [
+            grib_filepath(
+                t_analysis=t_analysis,
+                hour=hour,
+                file_type=file_type,
+                member_id=member_id,
+                root_path=root_path,
+            )
+            for hour in range(max_hour + 1)
+        ]
+        for file_type in GRIB_FILE_TYPES
+    }
+
+
+def check_files_exist(filepaths: list):
+    """
+    Raise a `FileNotFoundError` listing all of `filepaths` that don't exist.
+    The files don't always arrive in order, so all of them are checked.
+    """
+    missing = [str(fp) for fp in filepaths if not Path(fp).exists()]
+    if len(missing) > 0:
+        raise FileNotFoundError(
+            f"{len(missing)} GRIB file(s) do not exist: {', '.join(missing)}"
+        )
+
+
+def wait_for_files(filepaths: list, poll_interval: float, timeout: float):
+    """
+    Wait until all `filepaths` exist, checking every `poll_interval` seconds
+    and raising a `TimeoutError` if they don't all exist within `timeout`
+    seconds.
+    """
+    t_start = time.monotonic()
+    while True:
+        missing = [fp for fp in filepaths if not Path(fp).exists()]
+        if len(missing) == 0:
+            return
+        if time.monotonic() - t_start > timeout:
+            raise TimeoutError(f"Timed out waiting for {missing}")
+        logger.debug(f"Waiting for {missing}")
+        time.sleep(poll_interval)
+
+
+def _init_worker():
+    # each worker process has its own eccodes instance and so needs to be
+    # pointed to the local GRIB definitions
+    set_local_eccodes_definitions_path()
+
+
+def index_cache_key(fp, selection: dict = None) -> str:
+    """
+    Key identifying the content of a GRIB file in the index cache, made from
+    the file's path, size and modification time together with a hash of the
+    first and last `INDEX_CACHE_HASH_NBYTES` bytes of the file. This is cheap
+    to compute but changes whenever the file is replaced or (re)written. The
+    message selection the file is indexed with (if any) is included too.
+    """
+    fp = Path(fp)
+    stat = fp.stat()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{fp.absolute()}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    if selection is not None:
+        from .selection import selection_key
+
+        h.update(selection_key(selection).encode())
+    with open(fp, "rb") as f:
+        h.update(f.read(INDEX_CACHE_HASH_NBYTES))
+        if stat.st_size > INDEX_CACHE_HASH_NBYTES:
+            f.seek(max(INDEX_CACHE_HASH_NBYTES, stat.st_size - INDEX_CACHE_HASH_NBYTES))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def prune_index_cache(cache_path, max_age: datetime.timedelta = INDEX_CACHE_MAX_AGE):
+    """
+    Remove index files from the cache that are older than `max_age`.
+    """
+    t_oldest = time.time() - max_age.total_seconds()
+    for fp in Path(cache_path).glob("*.index"):
+        if fp.stat().st_mtime < t_oldest:
+            fp.unlink(missing_ok=True)
+
+
+def split_grib_messages(f_grib):
+    """
+    Split a GRIB file (opened for reading in binary mode) into its messages,
+    yielding the offset and the bytes of each message. Bytes between messages
+    (e.g. padding) and broken messages are skipped.
+
+    This replaces gribscan's private `gribscan.gribscan._split_file`, so that
+    indexing doesn't depend on gribscan internals that can change between
+    versions. Only GRIB edition 2 messages, and edition 1 messages without
+    the special coding of messages larger than 8MB, are supported.
+    """
+    while True:
+        offset = f_grib.tell()
+        indicator = f_grib.read(16)
+        if len(indicator) < 16:
+            return
+
+        if indicator[:4] != b"GRIB":
+            # continue from the next "GRIB", keeping the last bytes read in
+            # case it starts within them
+            idx = indicator.find(b"GRIB", 1)
+            f_grib.seek(offset + (idx if idx > 0 else len(indicator) - 3))
+            continue
+
+        edition = indicator[7]
+        if edition == 2:
+            length = int.from_bytes(indicator[8:16], "big")
+        elif edition == 1:
+            length = int.from_bytes(indicator[4:7], "big")
+            if length & 0x800000:
+                raise NotImplementedError(
+                    f"Large GRIB edition 1 message at offset {offset} isn't supported"
+                )
+        else:
+            raise ValueError(f"Unknown GRIB edition {edition} at offset {offset}")
+
+        f_grib.seek(offset)
+        data = f_grib.read(length)
+        if data[-4:] != b"7777":
+            logger.warning(f"Skipping broken GRIB message at offset {offset}")
+            f_grib.seek(offset + 4)
+            continue
+        yield offset, data
+
+
+def _scan_gribfile(f_grib, filename: str, selection: dict = None):
+    import eccodes
+    import gribscan
+
+    from .selection import is_required
+
+    if selection is None:
+        yield from gribscan.scan_gribfile(f_grib, filename=filename)
+        return
+
+    # only the keys needed for the selection are decoded for every message,
+    # the full scan (which decodes many more keys) is only done for the
+    # messages that are selected
+    for offset, data in split_grib_messages(f_grib):
+        mid = eccodes.codes_new_from_message(data)
+        try:
+            level_type = eccodes.codes_get(mid, "typeOfLevel")
+            short_name = eccodes.codes_get(mid, "shortName")
+            level = eccodes.codes_get(mid, "level")
+        finally:
+            eccodes.codes_release(mid)
+
+        if not is_required(selection, level_type, short_name, level):
+            continue
+
+        f_message = io.BufferedReader(io.BytesIO(data))
+        for record in gribscan.scan_gribfile(f_message, filename=filename):
+            record["_offset"] += offset
+            yield record
+
+
+def _index_file(fp, idxfile=None, selection=None) -> str:
+    if idxfile is None:
+        idxfile = Path(f"{fp}.index")
+    idxfile = Path(idxfile)
+
+    # the GRIB file is read sequentially through a large read buffer so that
+    # it can be indexed directly from the (FUSE mounted) source bucket with
+    # few large reads, rather than first copying it to local storage
+    tempfile = idxfile.with_suffix(".index.partial")
+    with open(fp, "rb", buffering=INDEX_READ_BUFFER_SIZE) as f_grib:
+        with open(tempfile, "w") as f_index:
+            for record in _scan_gribfile(f_grib, str(fp), selection=selection):
+                json.dump(record, f_index)
+                f_index.write("\n")
+    tempfile.rename(idxfile)
+
+    return str(idxfile)
+
+
+def index_files(
+    grib_files: list, n_workers: int = None, cache_path=None, selection: dict = None
+) -> list:
+    """
+    Create a gribscan index for each of `grib_files`, returning the paths of
+    the index files.
+
+    Parameters
+    ----------
+    grib_files : list
+        Paths of the GRIB files to index.
+    n_workers : int, optional
+        Number of worker processes to index with, defaults to the number of
+        CPUs. With `n_workers=1` the files are indexed in the calling process,
+        which must then already have set the local eccodes definitions path.
+    cache_path : str or Path, optional
+        If provided, index files are stored in this directory under a key
+        computed by `index_cache_key`, and files that have already been
+        indexed (and haven't changed since) are not indexed again. Otherwise
+        index files are written next to each GRIB file with suffix `.index`.
+    selection : dict, optional
+        If provided, only the GRIB messages in this selection (see
+        `selection.required_messages`) are included in the index files.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if cache_path is None:
+        index_paths = [Path(f"{fp}.index") for fp in grib_files]
+        to_index = [
+            (fp, idxfile, selection) for fp, idxfile in zip(grib_files, index_paths)
+        ]
+    else:
+        Path(cache_path).mkdir(parents=True, exist_ok=True)
+        prune_index_cache(cache_path)
+        index_paths = [
+            Path(cache_path) / f"{index_cache_key(fp, selection=selection)}.index"
+            for fp in grib_files
+        ]
+        to_index = [
+            (fp, idxfile, selection)
+            for fp, idxfile in zip(grib_files, index_paths)
+            if not idxfile.exists()
+        ]
+        logger.info(
+            f"Index cache {cache_path}: {len(grib_files) - len(to_index)} hit(s), "
+            f"{len(to_index)} miss(es)"
+        )
+
+    t_start = time.perf_counter()
+    if n_workers == 1 or len(to_index) <= 1:
+        for fp, idxfile, selection in to_index:
+            _index_file(fp, idxfile, selection)
+    else:
+        # the workers are started from a fork server rather than forked from
+        # this process, which may have other threads running (e.g. dask, the
+        # s3fs event loop or loguru) whose locks would be copied while held
+        ctx = mp.get_context(INDEX_WORKER_START_METHOD)
+        with ctx.Pool(min(n_workers, len(to_index)), initializer=_init_worker) as pool:
+            pool.starmap(_index_file, to_index)
+
+    logger.info(
+        f"Indexed {len(to_index)} GRIB files with {n_workers} worker(s) in "
+        f"{time.perf_counter() - t_start:.1f}s"
+    )
+    return [str(p) for p in index_paths]
+
+
+def build_refs(index_paths: list, refs_path: Path, prefix: str):
+    """
+    Build gribscan refs (one .json file per level type) from the index files,
+    writing them to `refs_path`. This is equivalent to
+    `gribscan-build ... -o {refs_path} --prefix {prefix} -m harmonie`.
+    """
+    import gribscan
+    from gribscan.magician import MAGICIANS
+
+    refs = gribscan.grib_magic(
+        index_paths, magician=MAGICIANS["harmonie"](), global_prefix=prefix
+    )
+
+    Path(refs_path).mkdir(parents=True, exist_ok=True)
+    for dataset, ref in refs.items():
+        with open(Path(refs_path) / f"{dataset}.json", "w") as f:
+            json.dump(ref, f)
+
+
+def build_indexes_and_refs(
+    t_analysis: datetime.datetime,
+    max_hour: int,
+    n_workers: int = None,
+    member_id: str = None,
+    root_path: str = None,
+    temp_path: str = None,
+    cache_path: str = None,
+    selection: dict = None,
+) -> Path:
+    """
+    Index all the `sf` and `pl` GRIB files of a forecast and build the refs
+    for each level type, returning the path of the directory the refs were
+    written to.
+
+    Parameters
+    ----------
+    t_analysis : datetime.datetime
+        The analysis time of the forecast.
+    max_hour : int
+        Maximum forecast hour to include (inclusive).
+    n_workers : int, optional
+        Number of worker processes used for indexing, defaults to the number
+        of CPUs.
+    member_id : str, optional
+        Member identifier in the GRIB filenames, defaults to the `MEMBER_ID`
+        environment variable (or "CONTROL__dmi").
+    root_path : str, optional
+        Directory containing the GRIB files, defaults to `SRC_GRIB_ROOT_PATH`.
+    temp_path : str, optional
+        If provided, the GRIB files are copied to this directory before
+        indexing and the refs point to these copies.
+    cache_path : str, optional
+        Directory of the index cache, see `index_files`. If not provided the
+        index files are written next to the GRIB files.
+    selection : dict, optional
+        If provided, only the GRIB messages in this selection are indexed and
+        included in the refs, see `selection.required_messages`.
+    """
+    return build_members_indexes_and_refs(
+        t_analysis=t_analysis,
+        max_hour=max_hour,
+        member_ids=[member_id],
+        n_workers=n_workers,
+        root_path=root_path,
+        temp_path=temp_path,
+        cache_path=cache_path,
+        selection=selection,
+    )[member_id]
+
+
+def build_members_indexes_and_refs(
+    t_analysis: datetime.datetime,
+    max_hour: int,
+    member_ids: list,
+    n_workers: int = None,
+    root_path: str = None,
+    temp_path: str = None,
+    cache_path: str = None,
+    selection: dict = None,
+) -> dict:
+    """
+    Index the GRIB files of several members of a forecast with one pool of
+    worker processes and build the refs for each member, returning the path
+    of the refs directory of each member keyed by member id. See
+    `build_indexes_and_refs` for the parameters.
+    """
+    grib_files = {}
+    for member_id in member_ids:
+        member_grib_files = forecast_grib_files(
+            t_analysis=t_analysis,
+            max_hour=max_hour,
+            member_id=member_id,
+            root_path=root_path,
+        )
+        for file_type, fps in member_grib_files.items():
+            grib_files[(member_id, file_type)] = fps
+    check_files_exist([fp for fps in grib_files.values() for fp in fps])
+
+    if temp_path is not None:
+        logger.info(f"Copying GRIB files to {temp_path} before indexing")
+        Path(temp_path).mkdir(parents=True, exist_ok=True)
+        grib_files = {
+            key: [Path(shutil.copy2(fp, temp_path)) for fp in fps]
+            for key, fps in grib_files.items()
+        }
+
+    all_grib_files = [fp for fps in grib_files.values() for fp in fps]
+    index_paths = dict(
+        zip(
+            all_grib_files,
+            index_files(
+                all_grib_files,
+                n_workers=n_workers,
+                cache_path=cache_path,
+                selection=selection,
+            ),
+        )
+    )
+
+    from .read_source import refs_path_for
+
+    refs_paths = {}
+    for (member_id, file_type), fps in grib_files.items():
+        refs_path = refs_path_for(t_analysis=t_analysis, member_id=member_id)
+        # refs are built one file type at a time, with the refs for level
+        # types present in both `sf` and `pl` files taken from the last file
+        # type
+        logger.info(f"Building refs for {file_type} files in {refs_path}")
+        build_refs(
+            index_paths=[index_paths[fp] for fp in fps],
+            refs_path=refs_path,
+            prefix=f"{fps[0].parent}/",
+        )
+        refs_paths[member_id] = refs_path
+
+    return refs_paths
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description="Build GRIB indexes and gribscan refs for a forecast",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "--t_analysis",
+        type=isodate.parse_datetime,
+        required=True,
+        help="Analysis time as ISO8601 string",
+    )
+    argparser.add_argument(
+        "--max-hour",
+        type=int,
+        default=int(os.getenv("MAX_HOUR", 36)),
+        help="Maximum forecast hour to index (inclusive)",
+    )
+    argparser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of indexing worker processes (defaults to the number of CPUs)",
+    )
+    argparser.add_argument(
+        "--temp-path",
+        default=os.getenv("SRC_GRIB_TEMP_PATH") or None,
+        help="If set, copy GRIB files to this directory before indexing",
+    )
+    argparser.add_argument(
+        "--index-cache-path",
+        default=os.getenv("INDEX_CACHE_PATH") or None,
+        help=(
+            "If set, keep GRIB index files in this directory keyed by each "
+            "file's path, size, modification time and a hash of its header, "
+            "so that unchanged files aren't indexed again on retries"
+        ),
+    )
+    argparser.add_argument(
+        "--index-all-messages",
+        action="store_true",
+        help=(
+            "Index all GRIB messages, rather than only the variables, levels "
+            "and level types used in `DATA_COLLECTION`"
+        ),
+    )
+    argparser.add_argument("--log-level", default="INFO", help="The log level to use")
+    args = argparser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+
+    set_local_eccodes_definitions_path()
+
+    from .selection import required_messages
+
+    build_indexes_and_refs(
+        t_analysis=args.t_analysis,
+        max_hour=args.max_hour,
+        n_workers=args.n_workers,
+        temp_path=args.temp_path,
+        cache_path=args.index_cache_path,
+        selection=None if args.index_all_messages else required_messages(),
+    )
+
+
+if __name__ == "__main__":
+    with logger.catch(reraise=True):
+        main()
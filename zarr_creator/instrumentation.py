@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages of a run (building refs, building the parts,
+writing the local copies and uploading them), recording for each stage:
+
+- the wall time
+- the peak resident set size (RSS) of this process during the stage, and the
+  lifetime peak RSS of the dask workers when using `dask.distributed`
+- the bytes read by this process (and the dask workers) through any read
+  syscall (Linux only, from `/proc/self/io`), which includes e.g. the refs,
+  the cached grid geometry and the local copies read for uploading
+- the bytes of the GRIB messages read through the refs (counted by
+  `read_source.GribMessageStore`)
+- the bytes and chunks written, and chunks written per second, for stages
+  that write zarr stores
+- the number of dask tasks run and the time spent in them, in total and by
+  task name prefix
+
+The bytes read are counted for the whole process (and all workers), and the
+dask task stats can't be separated between computations running at the same
+time (dask only runs the callbacks of the first of them, and the task stream
+of `dask.distributed` covers the whole cluster). So these counters can't be
+attributed to a stage that overlaps with stages running in other threads
+(e.g. the parts written with `--concurrent-parts`): these stages are marked
+as `concurrent` and recorded without them. The bytes read in total by the
+run are counted over the periods in which any stage is running, so that
+overlapping stages aren't counted twice. The peak RSS of a stage is always
+the peak of the whole process (and isn't summed over stages).
+
+The stages are collected into a run report which is written as JSON (one file
+per analysis time) and optionally as a Prometheus textfile (for the
+node-exporter textfile collector) at the end of the run.
+"""
+import collections
+import contextlib
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+from pathlib import Path
+
+import dask.utils
+from dask.callbacks import Callback
+from loguru import logger
+
+from .read_source import grib_bytes_read
+from .settings import PROMETHEUS_TEXTFILE, RUN_REPORT_PATH
+
+PROMETHEUS_PREFIX = "zarr_creator"
+# interval at which the RSS of this process is sampled during a stage
+RSS_SAMPLE_INTERVAL = 0.1
+# number of task name prefixes (by time spent) included for each stage
+N_TOP_TASK_PREFIXES = 10
+
+# the counters of bytes read, in this process and summed over the workers
+IO_COUNTERS = ["bytes_read", "grib_bytes_read"]
+
+# the report stages are recorded into, set by `run_report`
+_active_report = None
+# the stages currently running (in any thread), and the bytes read when the
+# first of them started, see `stage`
+_running_stages = set()
+_running_since = None
+_running_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def _read_io_bytes() -> int | None:
+    # bytes read by this process (through any read syscall), Linux only
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _current_rss() -> int | None:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def _lifetime_peak_rss() -> int:
+    # `ru_maxrss` is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker_counters() -> dict:
+    return dict(
+        bytes_read=_read_io_bytes(),
+        grib_bytes_read=grib_bytes_read(),
+        peak_rss=_lifetime_peak_rss(),
+    )
+
+
+def _distributed_client():
+    try:
+        from distributed import get_client
+    except ImportError:
+        return None
+    try:
+        return get_client()
+    except ValueError:
+        return None
+
+
+class _RssSampler(threading.Thread):
+    # samples the RSS of this process in the background to find its peak
+    # during a stage (`ru_maxrss` only gives the peak over the process
+    # lifetime)
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = _current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(RSS_SAMPLE_INTERVAL):
+            rss = _current_rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def stop(self) -> int | None:
+        self._stop_event.set()
+        self.join()
+        rss = _current_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+        return self.peak
+
+
+class _TaskStats:
+    # the tasks run by dask's local schedulers (threads, processes and
+    # synchronous) for a stage and the time spent in them by task name prefix
+
+    def __init__(self):
+        self.n_tasks = 0
+        self.task_time = collections.Counter()
+
+    def summary(self) -> dict:
+        return _task_summary(self.n_tasks, self.task_time)
+
+
+def _thread_task_stats() -> list:
+    # the task stats of the stages running in this thread (outermost first)
+    if not hasattr(_thread_local, "task_stats"):
+        _thread_local.task_stats = []
+        _thread_local.task_starts = {}
+    return _thread_local.task_stats
+
+
+def _pretask(key, dsk, state):
+    if _thread_task_stats():
+        _thread_local.task_starts[key] = time.perf_counter()
+
+
+def _posttask(key, result, dsk, state, worker_id):
+    task_stats = _thread_task_stats()
+    t_start = _thread_local.task_starts.pop(key, None)
+    if t_start is None:
+        return
+    dt = time.perf_counter() - t_start
+    for stats in task_stats:
+        stats.n_tasks += 1
+        stats.task_time[dask.utils.key_split(key)] += dt
+
+
+# The local schedulers call the callbacks from the thread that started the
+# computation, so the tasks are counted for the stages of that thread. The
+# callback is shared by all stages rather than registered for each, as the
+# schedulers swap out the registered callbacks while computing (so that
+# callbacks registered by a stage in another thread would be lost or leaked).
+# Computations running at the same time in several threads can still drop it
+# when restoring the callbacks, so it is registered again by each stage
+_task_callback = Callback(pretask=_pretask, posttask=_posttask)
+
+
+def _task_summary(n_tasks: int, task_time: collections.Counter) -> dict:
+    return dict(
+        n_tasks=n_tasks,
+        task_time_s=round(sum(task_time.values()), 3),
+        task_time_by_prefix_s={
+            prefix: round(t, 3)
+            for prefix, t in task_time.most_common(N_TOP_TASK_PREFIXES)
+        },
+    )
+
+
+@contextlib.contextmanager
+def _task_stats():
+    client = _distributed_client()
+    if client is None:
+        _task_callback.register()
+        stats = _TaskStats()
+        task_stats = _thread_task_stats()
+        task_stats.append(stats)
+        try:
+            yield stats.summary
+        finally:
+            task_stats.remove(stats)
+        return
+
+    from distributed import get_task_stream
+
+    with get_task_stream(client) as task_stream:
+
+        def _summary():
+            task_time = collections.Counter()
+            for task in task_stream.data:
+                for startstop in task["startstops"]:
+                    if startstop["action"] == "compute":
+                        task_time[dask.utils.key_split(task["key"])] += (
+                            startstop["stop"] - startstop["start"]
+                        )
+            return _task_summary(len(task_stream.data), task_time)
+
+        yield _summary
+
+
+def _sum_worker_counters(client) -> dict:
+    counters = client.run(_worker_counters).values()
+    summed = {k: sum(c[k] or 0 for c in counters) for k in IO_COUNTERS}
+    return dict(summed, peak_rss=max((c["peak_rss"] for c in counters), default=0))
+
+
+def _io_counters(client) -> dict:
+    # bytes read so far by this process and the dask workers
+    counters = dict(bytes_read=_read_io_bytes(), grib_bytes_read=grib_bytes_read())
+    if client is not None:
+        workers = _sum_worker_counters(client)
+        for k in IO_COUNTERS:
+            if counters[k] is not None:
+                counters[k] += workers[k]
+        counters["workers_peak_rss"] = workers["peak_rss"]
+    return counters
+
+
+def _io_delta(start: dict, end: dict) -> dict:
+    return {
+        k: end[k] - start[k]
+        for k in IO_COUNTERS
+        if start.get(k) is not None and end.get(k) is not None
+    }
+
+
+class _RunningStage:
+    # a stage running in a thread, which is concurrent if it overlaps with a
+    # stage running in another thread
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.concurrent = False
+
+
+def _start_running(client) -> tuple:
+    global _running_since
+    running = _RunningStage()
+    with _running_lock:
+        counters = _io_counters(client)
+        if not _running_stages:
+            _running_since = counters
+        for other in _running_stages:
+            if other.thread != running.thread:
+                other.concurrent = running.concurrent = True
+        _running_stages.add(running)
+    return running, counters
+
+
+def _stop_running(running: _RunningStage, client) -> dict:
+    # the bytes read since the first of the running stages started are added
+    # to the run totals once no stage is running
+    with _running_lock:
+        counters = _io_counters(client)
+        _running_stages.discard(running)
+        if not _running_stages and _active_report is not None:
+            _active_report.add_io(_io_delta(_running_since, counters))
+    return counters
+
+
+@contextlib.contextmanager
+def stage(name: str, **labels):
+    """
+    Context manager recording the wall time, peak RSS, bytes read and dask
+    task stats of a stage of the run (in the active run report, if any).
+
+    Yields the stage record (a dict), to which the caller can add
+    `bytes_written` and `chunks_written` for stages writing zarr stores.
+    Stages overlapping with stages in other threads are recorded with
+    `concurrent=True` and without the bytes read and dask task stats, as
+    these can't be attributed to a single stage.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, e.g. "write_local".
+    **labels
+        Labels identifying the stage, e.g. `dataset="single_levels"`.
+    """
+    record = dict(stage=name, labels=labels)
+    client = _distributed_client()
+    running, counters_start = _start_running(client)
+    sampler = _RssSampler()
+    sampler.start()
+    t_start = time.perf_counter()
+    try:
+        with _task_stats() as task_summary:
+            yield record
+        record["status"] = "success"
+    except BaseException:
+        record["status"] = "failed"
+        raise
+    finally:
+        wall_time = time.perf_counter() - t_start
+        record["wall_time_s"] = round(wall_time, 3)
+        record["peak_rss_bytes"] = sampler.stop()
+        counters_end = _stop_running(running, client)
+        if running.concurrent:
+            record["concurrent"] = True
+        else:
+            record.update(_io_delta(counters_start, counters_end))
+        if client is not None:
+            record["workers_peak_rss_bytes"] = counters_end["workers_peak_rss"]
+        if "chunks_written" in record and wall_time > 0:
+            record["chunks_per_s"] = round(record["chunks_written"] / wall_time, 1)
+        if record["status"] == "success" and not running.concurrent:
+            record["dask"] = task_summary()
+
+        logger.info(
+            f"Stage {name} {labels}: {wall_time:.1f}s, peak RSS "
+            f"{dask.utils.format_bytes(record['peak_rss_bytes'] or 0)}"
+        )
+        if _active_report is not None:
+            _active_report.add_stage(record)
+
+
+def store_stats(fp: Path) -> dict:
+    """
+    Number of bytes and chunks (i.e. files other than zarr metadata) in the
+    local zarr store `fp`.
+    """
+    n_bytes = 0
+    n_chunks = 0
+    for dirpath, _, filenames in os.walk(fp):
+        for filename in filenames:
+            n_bytes += os.path.getsize(os.path.join(dirpath, filename))
+            if not filename.startswith((".", "_")):
+                n_chunks += 1
+    return dict(bytes_written=n_bytes, chunks_written=n_chunks)
+
+
+class RunReport:
+    """
+    The stages recorded during a run for a single analysis time, written as
+    a JSON report and optionally as a Prometheus textfile.
+    """
+
+    def __init__(self, t_analysis: datetime.datetime, **attrs):
+        self.t_analysis = t_analysis
+        self.attrs = attrs
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.finished_at = None
+        self.status = "running"
+        self.stages = []
+        # bytes read while any stage was running, see `stage`
+        self.io = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, record: dict):
+        with self._lock:
+            self.stages.append(record)
+
+    def add_io(self, counters: dict):
+        with self._lock:
+            for k, n in counters.items():
+                self.io[k] = self.io.get(k, 0) + n
+
+    def to_dict(self) -> dict:
+        return dict(
+            t_analysis=self.t_analysis.isoformat(),
+            started_at=self.started_at.isoformat(),
+            finished_at=self.finished_at and self.finished_at.isoformat(),
+            status=self.status,
+            wall_time_s=round(
+                (
+                    (self.finished_at or datetime.datetime.now(datetime.timezone.utc))
+                    - self.started_at
+                ).total_seconds(),
+                3,
+            ),
+            peak_rss_bytes=_lifetime_peak_rss(),
+            bytes_read=self.io.get("bytes_read"),
+            grib_bytes_read=self.io.get("grib_bytes_read"),
+            bytes_written=sum(s.get("bytes_written", 0) for s in self.stages),
+            **self.attrs,
+            stages=self.stages,
+        )
+
+    def write_json(self, fp: Path):
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(json.dumps(self.to_dict(), indent=2, default=str))
+        logger.info(f"Run report written to {fp}")
+
+    def prometheus_text(self) -> str:
+        """
+        The report as Prometheus metrics in the text exposition format, with
+        one sample per stage for each stage metric.
+        """
+        report = self.to_dict()
+        stage_metrics = [
+            ("stage_wall_time_seconds", "wall_time_s", "Wall time of the stage"),
+            ("stage_peak_rss_bytes", "peak_rss_bytes", "Peak RSS during the stage"),
+            ("stage_bytes_read", "bytes_read", "Bytes read during the stage"),
+            (
+                "stage_grib_bytes_read",
+                "grib_bytes_read",
+                "Bytes of GRIB messages read during the stage",
+            ),
+            ("stage_bytes_written", "bytes_written", "Bytes written by the stage"),
+            ("stage_chunks_written", "chunks_written", "Chunks written by the stage"),
+            ("stage_chunks_per_second", "chunks_per_s", "Chunks written per second"),
+        ]
+        lines = []
+        for metric, key, help_text in stage_metrics:
+            samples = [s for s in report["stages"] if s.get(key) is not None]
+            if not samples:
+                continue
+            lines += [
+                f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}",
+                f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge",
+            ]
+            lines += [
+                f"{PROMETHEUS_PREFIX}_{metric}{_prometheus_labels(s)} {s[key]}"
+                for s in samples
+            ]
+        for metric, value, help_text in [
+            ("run_wall_time_seconds", report["wall_time_s"], "Wall time of the run"),
+            ("run_peak_rss_bytes", report["peak_rss_bytes"], "Peak RSS of the run"),
+            (
+                "run_success",
+                int(report["status"] == "success"),
+                "Whether the run succeeded",
+            ),
+            (
+                "run_analysis_time_seconds",
+                self.t_analysis.timestamp(),
+                "Analysis time converted by the run",
+            ),
+        ]:
+            lines += [
+                f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}",
+                f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge",
+                f"{PROMETHEUS_PREFIX}_{metric} {value}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, fp: Path):
+        # written to a temporary file and renamed so that the textfile
+        # collector never reads a partially written file
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp_tmp = fp.with_name(f".{fp.name}.tmp")
+        fp_tmp.write_text(self.prometheus_text())
+        os.replace(fp_tmp, fp)
+        logger.info(f"Prometheus metrics written to {fp}")
+
+
+def _prometheus_labels(record: dict) -> str:
+    labels = dict(stage=record["stage"], **record["labels"])
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def run_report_path(
+    t_analysis: datetime.datetime,
+    report_path: str = RUN_REPORT_PATH,
+    member_id: str = None,
+) -> Path:
+    """
+    Path of the JSON run report for an analysis time, e.g.
+    "/tmp/zarr-creator-run-reports/2025-02-17T0100Z.json", or for a single
+    member of it, e.g. "/tmp/zarr-creator-run-reports/2025-02-17T0100Z_CONTROL__dmi.json"
+    (as the daemon converts each member separately).
+    """
+    t_utc = t_analysis.astimezone(datetime.timezone.utc)
+    suffix = "" if member_id is None else f"_{member_id}"
+    return Path(report_path) / f"{t_utc:%Y-%m-%dT%H%MZ}{suffix}.json"
+
+
+@contextlib.contextmanager
+def run_report(
+    t_analysis: datetime.datetime,
+    report_path: str = RUN_REPORT_PATH,
+    prometheus_textfile: str = PROMETHEUS_TEXTFILE,
+    member_id: str = None,
+    **attrs,
+):
+    """
+    Context manager collecting the stages (see `stage`) run within it into a
+    `RunReport`, which is written (also if the run fails) to
+    `report_path` (see `run_report_path`) and, if given, as a Prometheus
+    textfile to `prometheus_textfile`. Set `member_id` for runs converting a
+    single member, so that the reports of the members of an analysis time are
+    written to separate files.
+    """
+    global _active_report
+    if t_analysis.tzinfo is None:
+        t_analysis = t_analysis.replace(tzinfo=datetime.timezone.utc)
+    if member_id is not None:
+        attrs["member_id"] = member_id
+    report = RunReport(t_analysis=t_analysis, **attrs)
+    _active_report = report
+    try:
+        yield report
+        report.status = "success"
+    except BaseException:
+        report.status = "failed"
+        raise
+    finally:
+        _active_report = None
+        report.finished_at = datetime.datetime.now(datetime.timezone.utc)
+        if report_path is not None:
+            report.write_json(run_report_path(t_analysis, report_path, member_id))
+        if prometheus_textfile is not None:
+            report.write_prometheus_textfile(prometheus_textfile)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Inventory of all published output zarr stores, kept as a single JSON object
+(`inventory.json`) at the root of the S3 bucket, so that readers can find
+e.g. the latest forecast or all forecasts in a date range with a single
+request rather than listing the bucket or trying to open stores.
+
+Each entry describes one store: the analysis time, member, dataset id (part),
+URL, variables, dimension sizes, lead times (in hours), size in bytes and the
+time it was published. The writer updates the entry of a store each time it
+is published (see `write_zarr.write_output_zarrs`), including after each
+incremental write while streaming. Updates are a read-modify-write of the
+inventory: in S3 they are conditional writes which only succeed if the
+inventory hasn't changed since it was read (and are retried otherwise), so
+that writers in separate processes or hosts (e.g. the daemon and the
+streaming writer) don't lose each other's entries.
+"""
+import datetime
+import json
+import threading
+
+import fsspec
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+from .publish import read_publish_marker, update_object
+
+# name of the inventory object at the root of the bucket, see
+# `write_zarr.INVENTORY_URL`
+INVENTORY_KEY = "inventory.json"
+# the bucket can be read anonymously
+INVENTORY_READ_STORAGE_OPTIONS = dict(anon=True)
+
+# serialises the updates of the inventory by parts written concurrently in
+# this process (so they don't need to be retried)
+_update_lock = threading.Lock()
+
+
+def _format_time(t: datetime.datetime) -> str:
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _entry_key(entry: dict) -> tuple:
+    return (entry["analysis_time"], entry["member"], entry["dataset_id"])
+
+
+def inventory_entry(
+    url: str,
+    member: str,
+    t_analysis: datetime.datetime,
+    dataset_id: str,
+    store_url: str = None,
+    storage_options: dict = None,
+) -> dict:
+    """
+    Build the inventory entry of the published zarr store `url` (a local copy
+    or the store in the bucket), from its publish marker and time coordinate.
+
+    Parameters
+    ----------
+    url : str
+        Path or URL of the published store to describe.
+    member : str
+        The forecast member name, e.g. "control".
+    t_analysis : datetime.datetime
+        The analysis time of the forecast.
+    dataset_id : str
+        The dataset id, e.g. "single_levels".
+    store_url : str, optional
+        URL of the store in the bucket recorded in the entry, defaults to
+        `url`.
+    storage_options : dict, optional
+        fsspec storage options for the filesystem of `url`.
+    """
+    marker = read_publish_marker(url, storage_options=storage_options)
+    if marker is None:
+        raise FileNotFoundError(f"{url} hasn't been published")
+
+    lead_times = []
+    ds = xr.open_zarr(fsspec.get_mapper(url, **(storage_options or {})))
+    if "time" in ds.coords:
+        t_analysis_utc = np.datetime64(
+            _format_time(t_analysis).rstrip("Z"), "ns"
+        ).astype(ds["time"].dtype)
+        lead_times = [
+            round(float(dt / np.timedelta64(1, "h")), 3)
+            for dt in (ds["time"].values - t_analysis_utc)
+        ]
+
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    return dict(
+        analysis_time=_format_time(t_analysis),
+        member=member,
+        dataset_id=dataset_id,
+        url=store_url or url,
+        variables=marker["variables"],
+        dims=marker["dims"],
+        lead_times=lead_times,
+        nbytes=int(fs.du(root)),
+        published_at=marker["published_at"],
+    )
+
+
+def read_inventory(
+    url: str, storage_options: dict = INVENTORY_READ_STORAGE_OPTIONS
+) -> list[dict]:
+    """
+    Read the entries of the inventory at `url`, returning an empty list if
+    there is no inventory yet.
+    """
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    try:
+        return json.loads(fs.cat_file(path))["datasets"]
+    except FileNotFoundError:
+        return []
+
+
+def _inventory_bytes(entries: list[dict]) -> bytes:
+    inventory = dict(
+        updated_at=_format_time(datetime.datetime.now(datetime.timezone.utc)),
+        datasets=sorted(entries, key=_entry_key),
+    )
+    return json.dumps(inventory, separators=(",", ":")).encode()
+
+
+def write_inventory(entries: list[dict], url: str, storage_options: dict = None):
+    """
+    Write the inventory `entries` (sorted by analysis time, member and
+    dataset id) to `url`.
+    """
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    fs.pipe_file(path, _inventory_bytes(entries))
+
+
+def update_inventory(entry: dict, url: str, storage_options: dict = None):
+    """
+    Add `entry` to the inventory at `url`, replacing any earlier entry for
+    the same analysis time, member and dataset id. In S3 the update is a
+    conditional write, retried if another writer changed the inventory (see
+    `publish.update_object`).
+    """
+
+    def _with_entry(data: bytes | None) -> bytes:
+        entries = [] if data is None else json.loads(data)["datasets"]
+        return _inventory_bytes(
+            [e for e in entries if _entry_key(e) != _entry_key(entry)] + [entry]
+        )
+
+    with _update_lock:
+        update_object(url, _with_entry, storage_options=storage_options)
+    logger.info(
+        f"Updated inventory {url} with {entry['dataset_id']} "
+        f"({entry['member']}, {entry['analysis_time']})"
+    )
+
+
+def query_inventory(
+    entries: list[dict],
+    dataset_id: str = None,
+    member: str = None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    variables: list = None,
+    min_lead_time: float = None,
+) -> list[dict]:
+    """
+    Select the inventory `entries` matching all the given criteria, sorted by
+    analysis time.
+
+    Parameters
+    ----------
+    entries : list of dict
+        The inventory entries, see `read_inventory`.
+    dataset_id : str, optional
+        The dataset id, e.g. "single_levels".
+    member : str, optional
+        The member name, e.g. "control".
+    start, end : datetime.datetime, optional
+        Range of analysis times (inclusive).
+    variables : list of str, optional
+        Variables that the store must contain.
+    min_lead_time : float, optional
+        Lead time (in hours) the store must reach, e.g. to skip forecasts that
+        are still being streamed.
+    """
+    selected = []
+    for entry in entries:
+        if dataset_id is not None and entry["dataset_id"] != dataset_id:
+            continue
+        if member is not None and entry["member"] != member:
+            continue
+        if start is not None and entry["analysis_time"] < _format_time(start):
+            continue
+        if end is not None and entry["analysis_time"] > _format_time(end):
+            continue
+        if variables is not None and not set(variables) <= set(entry["variables"]):
+            continue
+        if min_lead_time is not None and (
+            not entry["lead_times"] or max(entry["lead_times"]) < min_lead_time
+        ):
+            continue
+        selected.append(entry)
+    return sorted(selected, key=_entry_key)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory writing of the output zarr stores (`--memory-limit`).
+
+Computing the whole task graph of a part at once can hold many decoded GRIB
+messages and rechunked chunks in memory at the same time. With a memory budget
+a new store is instead first created with only its metadata, and the data is
+then computed and written in batches along `time` (or `y` for the point
+stores, which hold the full time axis in each chunk) with the same region
+writes used to resume an interrupted write (see `resume.write_missing_regions`).
+The batches are sized so that the data in flight fits within the part of the
+budget left after reserving `PARENT_MEMORY_FRACTION` for this process (the
+interpreter, the task graphs of the parts and the upload buffers), which is
+also the part the dask workers share (see `worker_memory_limit`).
+
+While writing, the RSS of this process and its child processes (e.g. the
+workers of a `dask.distributed.LocalCluster`) is watched. If it goes over the
+budget the write fails with `MemoryBudgetExceeded`, which gives the peak RSS
+and the store and batch size being written. The budget is checked after each
+batch, whichever scheduler is used. With dask's local schedulers a batch is
+also stopped at the next task to finish, whereas tasks running on
+`dask.distributed` workers can't be interrupted this way (there each worker is
+held to its share of the budget by dask itself).
+"""
+import contextlib
+import os
+import threading
+
+import dask.utils
+import fsspec
+import xarray as xr
+from dask.callbacks import Callback
+from loguru import logger
+
+from .rechunk import rechunk_in_memory
+from .resume import is_resumable, write_missing_regions
+
+# fraction of the memory budget reserved for this process, the rest is shared
+# by the dask workers and bounds the data of the batches being written
+PARENT_MEMORY_FRACTION = 0.25
+# dimensions the writes are batched along, in order of preference. A dimension
+# is only used if the store has more than one chunk along it
+BATCH_DIMS = ["time", "y"]
+# fraction of the workers' part of the memory budget for the data of the batch
+# being written, the rest is left for the workers' interpreters and buffers
+BATCH_MEMORY_FRACTION = 0.5
+# copies of the data of a batch held while it is written: decoded from GRIB,
+# rechunked and encoded
+BATCH_COPIES = 3
+# interval at which the RSS is checked against the budget
+RSS_CHECK_INTERVAL = 0.2
+
+# number of stores being written at the same time, which share the memory
+# budget, set by `concurrent_writes`
+_n_concurrent_writes = 1
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def _children(pid: int) -> list[int]:
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as fh:
+                children.extend(int(c) for c in fh.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # the process has exited
+        return 0
+
+
+def process_tree_rss(pid: int = None) -> dict:
+    """
+    RSS (in bytes) of process `pid` (defaults to this process) and all its
+    descendants, keyed by process id (Linux only, empty elsewhere).
+    """
+    pids = [os.getpid() if pid is None else pid]
+    rss = {}
+    while pids:
+        pid = pids.pop()
+        rss[pid] = _rss(pid)
+        pids.extend(_children(pid))
+    return {pid: n for pid, n in rss.items() if n > 0}
+
+
+def worker_memory_limit(memory_limit: str, n_workers: int) -> int:
+    """
+    Memory limit (in bytes) of each of `n_workers` dask workers sharing the
+    `memory_limit` budget, after reserving `PARENT_MEMORY_FRACTION` of it for
+    this process.
+    """
+    workers_memory = dask.utils.parse_bytes(memory_limit) * (1 - PARENT_MEMORY_FRACTION)
+    return int(workers_memory // n_workers)
+
+
+@contextlib.contextmanager
+def concurrent_writes(n: int):
+    """
+    Context manager within which `n` stores are written at the same time
+    (e.g. with `--concurrent-parts`), so that the batches of each are sized
+    to fit `1/n` of the memory budget.
+    """
+    global _n_concurrent_writes
+    _n_concurrent_writes = n
+    try:
+        yield
+    finally:
+        _n_concurrent_writes = 1
+
+
+def batch_dim(ds: xr.Dataset, chunks: dict) -> str:
+    """
+    The dimension of `ds` to write it in batches along, the first of
+    `BATCH_DIMS` that `ds` has more than one chunk along.
+    """
+    for dim in BATCH_DIMS:
+        if dim in ds.dims and chunks[dim] < ds.sizes[dim]:
+            return dim
+    return BATCH_DIMS[0]
+
+
+def batch_size(ds: xr.Dataset, chunks: dict, dim: str, memory_limit: str) -> int:
+    """
+    The number of steps along `dim` (a multiple of the chunk size) written in
+    each batch, so that `BATCH_COPIES` copies of a batch fit within
+    `BATCH_MEMORY_FRACTION` of the part of `memory_limit` not reserved for
+    this process (shared between the stores written at the same time, see
+    `concurrent_writes`).
+
+    Raises `MemoryBudgetExceeded` if a single chunk along `dim` doesn't fit.
+    """
+    if dim not in ds.dims:
+        return 1
+    nbytes_step = (
+        sum(ds[v].nbytes for v in ds.data_vars if dim in ds[v].dims) / ds.sizes[dim]
+    )
+    available = (
+        dask.utils.parse_bytes(memory_limit)
+        * (1 - PARENT_MEMORY_FRACTION)
+        * BATCH_MEMORY_FRACTION
+        / _n_concurrent_writes
+    )
+    n_chunks = int(available // (BATCH_COPIES * nbytes_step * chunks[dim]))
+    if n_chunks < 1:
+        raise MemoryBudgetExceeded(
+            f"Writing one `{dim}` chunk ({chunks[dim]} steps) needs about "
+            f"{dask.utils.format_bytes(BATCH_COPIES * nbytes_step * chunks[dim])}, "
+            f"more than the {dask.utils.format_bytes(int(available))} of the "
+            f"{memory_limit} memory budget available for data. Increase "
+            "--memory-limit or reduce the output chunk size"
+        )
+    return min(n_chunks * chunks[dim], ds.sizes[dim])
+
+
+class _RssWatchdog(threading.Thread):
+    # checks the RSS of the process tree in the background, recording the
+    # peak and whether it went over the budget
+
+    def __init__(self, limit: int):
+        super().__init__(daemon=True)
+        self.limit = limit
+        self.peak = 0
+        self.peak_by_pid = {}
+        self.exceeded = False
+        self._stop_event = threading.Event()
+
+    def check(self):
+        rss = process_tree_rss()
+        total = sum(rss.values())
+        if total > self.peak:
+            self.peak, self.peak_by_pid = total, rss
+        if total > self.limit and not self.exceeded:
+            self.exceeded = True
+            # logged right away, in case the process is killed before the
+            # error is raised
+            logger.error(
+                f"RSS {dask.utils.format_bytes(total)} is over the memory budget "
+                f"of {dask.utils.format_bytes(self.limit)} (by process: "
+                + ", ".join(
+                    f"{pid}={dask.utils.format_bytes(n)}" for pid, n in rss.items()
+                )
+                + ")"
+            )
+
+    def run(self):
+        while not self._stop_event.wait(RSS_CHECK_INTERVAL):
+            self.check()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.check()
+
+
+class _BudgetCallback(Callback):
+    # stops a computation with dask's local schedulers as soon as the
+    # watchdog has found the RSS over the budget
+
+    def __init__(self, watchdog: _RssWatchdog, error: callable):
+        super().__init__()
+        self._watchdog = watchdog
+        self._error = error
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        if self._watchdog.exceeded:
+            raise self._error()
+
+
+@contextlib.contextmanager
+def memory_guard(memory_limit: str, description: str):
+    """
+    Context manager raising `MemoryBudgetExceeded` if the RSS of this process
+    and its children goes over `memory_limit` (e.g. "4GB") within it.
+    Computations with dask's local schedulers are stopped at the next task
+    to finish, `description` (e.g. the store being written) is included in
+    the error.
+
+    Yields a function which checks the RSS right away and raises if it has
+    been over the budget, to call between the steps of a computation (e.g.
+    the batches of a write) so that it is also stopped when the tasks run on
+    `dask.distributed` workers.
+    """
+    watchdog = _RssWatchdog(dask.utils.parse_bytes(memory_limit))
+
+    def _error():
+        return MemoryBudgetExceeded(
+            f"Peak RSS {dask.utils.format_bytes(watchdog.peak)} went over the "
+            f"memory budget of {memory_limit} while {description} (peak RSS by "
+            "process: "
+            + ", ".join(
+                f"{pid}={dask.utils.format_bytes(n)}"
+                for pid, n in watchdog.peak_by_pid.items()
+            )
+            + ")"
+        )
+
+    def _check():
+        watchdog.check()
+        if watchdog.exceeded:
+            raise _error()
+
+    watchdog.start()
+    try:
+        with _BudgetCallback(watchdog, _error):
+            yield _check
+    finally:
+        watchdog.stop()
+    if watchdog.exceeded:
+        raise _error()
+
+
+def write_bounded(
+    ds: xr.Dataset, target, chunks: dict, memory_limit: str, resume: bool = False
+) -> int:
+    """
+    Write `ds` with `chunks` to a new zarr store at `target` (a path or
+    `fsspec.FSMap`) in batches that fit within `memory_limit`, see the
+    module docstring. With `resume` an interrupted write to `target` is
+    continued rather than started again.
+
+    Returns
+    -------
+    int
+        The number of batches written.
+    """
+    store = target if isinstance(target, fsspec.FSMap) else fsspec.get_mapper(target)
+    dim = batch_dim(ds, chunks)
+    n_steps = batch_size(ds, chunks, dim=dim, memory_limit=memory_limit)
+
+    if not (resume and is_resumable(ds, store, chunks=chunks)):
+        store.clear()
+        # only the metadata and the coordinates held in memory are written
+        # here, the data variables are written batch by batch below
+        rechunk_in_memory(ds, chunks).to_zarr(
+            target, mode="w", compute=False, consolidated=True
+        )
+
+    logger.info(
+        f"Writing {store.root} in batches of {n_steps} `{dim}` steps "
+        f"(memory budget {memory_limit})"
+    )
+    with memory_guard(
+        memory_limit, description=f"writing {store.root} in batches of {n_steps}"
+    ) as check_budget:
+        return write_missing_regions(
+            ds,
+            store,
+            chunks=chunks,
+            dim=dim,
+            max_region_size=n_steps,
+            after_region=check_budget,
+        )
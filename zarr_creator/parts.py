@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Assembly of the output datasets for each part of `DATA_COLLECTION` from the
+datasets of each level type read from the gribscan refs.
+"""
+import datetime
+
+import numpy as np
+import xarray as xr
+
+from . import __version__
+from .config import DATA_COLLECTION
+from .transforms import derive_variables
+
+MEMBER_DIM = "member"
+
+
+def build_part(
+    part_details: list,
+    t_analysis: datetime.datetime,
+    read_level_type_data,
+    **read_kwargs,
+) -> xr.Dataset:
+    """
+    Build the dataset for a single part of the data collection.
+
+    Parameters
+    ----------
+    part_details : list
+        The level type entries of the part, see `config.DATA_COLLECTION`.
+    t_analysis : datetime.datetime
+        The analysis time of the forecast.
+    read_level_type_data : callable
+        Function used to read the dataset for a level type, e.g. a
+        `read_source.LevelTypeDataReader` instance.
+    **read_kwargs
+        Additional keyword arguments passed to `read_level_type_data`.
+    """
+    ds_part = xr.Dataset()
+    for level_details in part_details:
+        level_type = level_details["level_type"]
+        derived_variables = level_details.get("derived_variables", {})
+        variables = {**level_details.get("variables", {}), **derived_variables}
+        level_name_mapping = level_details.get("level_name_mapping", None)
+
+        ds_level_type = read_level_type_data(
+            t_analysis=t_analysis, level_type=level_type, **read_kwargs
+        )
+        # the derived variables are then selected and named like the GRIB
+        # variables
+        derived = derive_variables(ds_level_type, derived_variables)
+
+        for var_name, levels in variables.items():
+            if callable(levels):
+                da = levels(ds_level_type)
+                ds_part[var_name] = da
+                if "grid_mapping" in da.attrs:
+                    ds_part[da.attrs["grid_mapping"]] = ds_level_type[
+                        da.attrs["grid_mapping"]
+                    ]
+                continue
+
+            da = derived[var_name] if var_name in derived else ds_level_type[var_name]
+
+            if levels is None:
+                if level_name_mapping is None:
+                    new_name = var_name
+                else:
+                    new_name = level_name_mapping.format(var_name=var_name)
+                ds_part[new_name] = da
+            elif level_name_mapping is None:
+                # assuming we're just selecting levels and not changing the name
+                da = da.sel(level=levels)
+                ds_part[var_name] = da
+            else:
+                # mapping each level to a new variable name
+                for level in levels:
+                    da_level = da.sel(level=level)
+                    new_name = level_name_mapping.format(level=level, var_name=var_name)
+                    ds_part[new_name] = da_level
+
+            if "grid_mapping" in da.attrs:
+                ds_part[da.attrs["grid_mapping"]] = ds_level_type[
+                    da.attrs["grid_mapping"]
+                ]
+
+    # use "altitude" and "pressure" as dimension names instead of "level"
+    if "level" in ds_part.dims:
+        if level_type == "isobaricInhPa":
+            ds_part = ds_part.rename({"level": "pressure"})
+        elif level_type == "heightAboveGround":
+            ds_part = ds_part.rename({"level": "altitude"})
+        elif level_type == "heightAboveSea":
+            ds_part = ds_part.rename({"level": "altitude"})
+        else:
+            raise NotImplementedError(f"Level type {level_type} not implemented")
+
+    # check if any of the coordinates don't have any variables, if so drop them
+    for coord in ds_part.coords:
+        if all(coord not in ds_part[v].coords for v in list(ds_part.data_vars)):
+            ds_part = ds_part.drop_vars(coord)
+
+    return ds_part
+
+
+def build_parts(
+    t_analysis: datetime.datetime, read_level_type_data, **read_kwargs
+) -> dict:
+    """
+    Build the dataset of every part in `DATA_COLLECTION`, returning a dict
+    of datasets keyed by part id.
+    """
+    parts = {}
+    for part_id, part_details in DATA_COLLECTION.items():
+        parts[part_id] = build_part(
+            part_details=part_details,
+            t_analysis=t_analysis,
+            read_level_type_data=read_level_type_data,
+            **read_kwargs,
+        )
+    return parts
+
+
+def stack_members(parts: dict) -> xr.Dataset:
+    """
+    Stack the datasets of a part for several members (keyed by member name)
+    along a new `member` dimension. Only the variables with a `time`
+    dimension are stacked, the others (e.g. `lsm` and `orography`) are the
+    same for all members and are taken from the first member.
+    """
+    datasets = list(parts.values())
+    ds_first = datasets[0]
+    ds = xr.concat(
+        datasets,
+        dim=MEMBER_DIM,
+        data_vars=[v for v in ds_first.data_vars if "time" in ds_first[v].dims],
+        coords="minimal",
+        compat="override",
+        join="exact",
+        combine_attrs="override",
+    )
+    return ds.assign_coords({MEMBER_DIM: np.array(list(parts))})
+
+
+def add_provenance_attrs(ds_part: xr.Dataset):
+    """
+    Set the zarr-creator version, creation time and repository url as global
+    attributes on `ds_part`.
+    """
+    # set zarr-creator version
+    ds_part.attrs["zarr_creator_version"] = __version__
+    # set creation timestamp
+    ds_part.attrs["zarr_creation_time"] = datetime.datetime.now(
+        datetime.timezone.utc
+    ).isoformat()
+    # add link to repo
+    ds_part.attrs["zarr_creator_repo"] = (
+        "https://github.com/dmidk/nwp-forecast-zarr-creator"
+    )
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Secondary output stores laid out for point and time-series access. The map
+stores are chunked with one timestep per chunk, so reading the full forecast
+at a single location touches one chunk per timestep. The point stores hold the
+same data chunked along the full time (and level) axes with small x/y tiles
+(see `config.POINT_OUTPUT_CHUNKING`), so a location's full forecast is in a
+single chunk per variable.
+
+The point stores are created from the local copies of the map stores after
+these have been written, so the GRIB messages aren't read a second time.
+
+A station index sidecar (`stations.json`, next to the output stores) maps
+named sites to the grid indices (and point store tile) closest to them.
+"""
+import csv
+import datetime
+import json
+from pathlib import Path
+
+import fsspec
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+
+from .geometry import LATITUDE, LONGITUDE, grid_key
+from .write_zarr import output_url
+
+POINT_STORE_SUFFIX = "_points"
+STATION_INDEX_FILENAME = "stations.json"
+# mean Earth radius used for the distances to the nearest grid point
+EARTH_RADIUS_KM = 6371.0
+
+
+def point_dataset_id(part_id: str) -> str:
+    """
+    Dataset id of the point store of a part, e.g. "single_levels_points".
+    """
+    return f"{part_id}{POINT_STORE_SUFFIX}"
+
+
+def open_map_store(fp: Path) -> xr.Dataset:
+    """
+    Open the local copy of a map store to create its point store from, without
+    the encoding (e.g. chunks) of the map store.
+    """
+    return xr.open_zarr(fp).drop_encoding()
+
+
+def read_stations(fp: Path) -> list[dict]:
+    """
+    Read the stations to index from a CSV file with columns `name`, `lat`
+    and `lon` (in degrees).
+    """
+    with open(fp, newline="") as fh:
+        return [
+            dict(name=row["name"], lat=float(row["lat"]), lon=float(row["lon"]))
+            for row in csv.DictReader(fh)
+        ]
+
+
+def _unit_vectors(lat, lon) -> np.ndarray:
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)],
+        axis=-1,
+    )
+
+
+def build_station_index(
+    stations: list[dict], ds_geometry: xr.Dataset, tiles: dict = None
+) -> dict:
+    """
+    Find the grid point nearest to each station.
+
+    Parameters
+    ----------
+    stations : list of dict
+        The stations, each with a `name`, `lat` and `lon`.
+    ds_geometry : xarray.Dataset
+        The grid geometry (see `geometry.cached_grid_geometry`), with 2D
+        `lat` and `lon` coordinates on `(y, x)`.
+    tiles : dict, optional
+        The `y` and `x` chunk sizes of each point store (keyed by dataset
+        id), used to give the tile of each store that contains each station.
+
+    Returns
+    -------
+    dict
+        The station index, with the grid key (`grid`), tile sizes (`tiles`)
+        and for each station (`stations`) its `y` and `x` index, the
+        latitude and longitude of the grid point, the distance to it (in km)
+        and its tile in each point store.
+    """
+    lat = ds_geometry[LATITUDE].transpose("y", "x").values
+    lon = ds_geometry[LONGITUDE].transpose("y", "x").values
+    tree = cKDTree(_unit_vectors(lat, lon).reshape(-1, 3))
+
+    entries = []
+    if stations:
+        chord, i_flat = tree.query(
+            _unit_vectors([s["lat"] for s in stations], [s["lon"] for s in stations])
+        )
+        for station, d, i in zip(stations, chord, i_flat):
+            j_y, i_x = np.unravel_index(i, lat.shape)
+            entry = dict(
+                station,
+                y=int(j_y),
+                x=int(i_x),
+                grid_lat=float(lat[j_y, i_x]),
+                grid_lon=float(lon[j_y, i_x]),
+                distance_km=float(2 * EARTH_RADIUS_KM * np.arcsin(d / 2)),
+            )
+            if tiles:
+                entry["tiles"] = {
+                    dataset_id: dict(y=int(j_y) // tile["y"], x=int(i_x) // tile["x"])
+                    for dataset_id, tile in tiles.items()
+                }
+            entries.append(entry)
+
+    return dict(grid=grid_key(ds_geometry), tiles=tiles or {}, stations=entries)
+
+
+def station_index_url(member: str, t_analysis: datetime.datetime) -> str:
+    """
+    URL of the station index sidecar next to the output stores in the S3
+    bucket for a member and analysis time.
+    """
+    url_store = output_url(member=member, t_analysis=t_analysis, dataset_id="")
+    return f"{url_store.rsplit('/', 1)[0]}/{STATION_INDEX_FILENAME}"
+
+
+def write_station_index(station_index: dict, url: str, storage_options: dict = None):
+    """
+    Write the station index sidecar to `url` (a local path or S3 URL).
+    """
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    fs.makedirs(path.rsplit("/", 1)[0], exist_ok=True)
+    fs.pipe_file(path, json.dumps(station_index, indent=2).encode())
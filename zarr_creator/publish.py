@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Atomic publishing of the output zarr stores, so that readers never see a
+half-written or missing store.
+
+New stores are written to a staging directory next to the final local path,
+and moved into place with a rename once they are complete. On S3, where there
+is no rename, a published store is replaced in place (chunks first, then the
+metadata, then the removal of stale keys, see
+`zarr_creator.write_zarr.copy_zarr_store`) and a publish marker object
+(`_published.json`) is written to the root of each store after all other
+objects. Readers can poll for the marker with `read_publish_marker` rather
+than retrying failed opens.
+
+Objects shared by all writers (e.g. the inventory and the aggregates) are
+replaced with `update_object`, which uses conditional writes in S3 so that
+writers in separate processes or hosts don't lose each other's updates.
+"""
+import datetime
+import json
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import fsspec
+import fsspec.asyn
+import xarray as xr
+from loguru import logger
+
+PUBLISH_MARKER_KEY = "_published.json"
+# attempts at a conditional update of an object in S3 before giving up, when
+# it keeps being changed by other writers between reading and writing it
+UPDATE_OBJECT_ATTEMPTS = 10
+
+
+def staging_path(fp_target: Path, reuse: bool = False) -> Path:
+    """
+    Create an empty staging directory for writing the store that will be
+    published at `fp_target`. The staging directory is in the same parent
+    directory so that it can be moved into place with a rename.
+
+    With `reuse=True` the most recent staging directory left by an earlier
+    (interrupted) write is returned instead if there is one, so that the write
+    can be resumed. Any older staging directories are deleted.
+    """
+    fp_target = Path(fp_target)
+    fp_target.parent.mkdir(parents=True, exist_ok=True)
+    prefix = f".{fp_target.name}.staging-"
+
+    if reuse:
+        fps_existing = sorted(
+            fp_target.parent.glob(f"{prefix}*"), key=lambda fp: fp.stat().st_mtime
+        )
+        for fp in fps_existing[:-1]:
+            shutil.rmtree(fp)
+        if fps_existing:
+            logger.info(f"Reusing staging directory {fps_existing[-1]}")
+            return fps_existing[-1]
+
+    return Path(tempfile.mkdtemp(dir=fp_target.parent, prefix=prefix))
+
+
+def publish_local_store(fp_staging: Path, fp_target: Path):
+    """
+    Move the complete store in `fp_staging` to `fp_target`, replacing any
+    store already there. The previous store is first renamed out of the way and
+    then deleted, so that `fp_target` is only missing between the two renames.
+    """
+    fp_staging, fp_target = Path(fp_staging), Path(fp_target)
+    fp_previous = None
+    if fp_target.exists():
+        logger.warning(f"Local copy path {fp_target} already exists, overwriting")
+        fp_previous = fp_staging.with_name(
+            fp_staging.name.replace(".staging-", ".previous-")
+        )
+        fp_target.rename(fp_previous)
+    fp_staging.rename(fp_target)
+    if fp_previous is not None:
+        shutil.rmtree(fp_previous)
+    logger.info(f"Published {fp_target}")
+
+
+def publish_marker(url: str, storage_options: dict = None) -> dict:
+    """
+    Build the content of the publish marker for the (consolidated) zarr store
+    at `url`, recording when it was published and the size of each dimension
+    so that readers can tell how much of a forecast is available.
+    """
+    ds = xr.open_zarr(
+        fsspec.get_mapper(url, **(storage_options or {})), consolidated=True
+    )
+    return dict(
+        published_at=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        dims={d: int(n) for d, n in ds.sizes.items()},
+        variables=sorted(ds.data_vars),
+    )
+
+
+def write_publish_marker(url: str, marker: dict, storage_options: dict = None):
+    """
+    Write the publish `marker` to the zarr store at `url`.
+    """
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    fs.pipe_file(f"{root}/{PUBLISH_MARKER_KEY}", json.dumps(marker).encode())
+
+
+def remove_publish_marker(url: str, storage_options: dict = None):
+    """
+    Remove the publish marker from the zarr store at `url` (if it exists), so
+    that readers don't read the store while it is being replaced.
+    """
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    fp_marker = f"{root}/{PUBLISH_MARKER_KEY}"
+    if fs.exists(fp_marker):
+        fs.rm(fp_marker)
+
+
+def read_publish_marker(url: str, storage_options: dict = None) -> dict | None:
+    """
+    Read the publish marker of the zarr store at `url`, returning `None` if
+    the store hasn't been (completely) published yet.
+
+    Parameters
+    ----------
+    url : str
+        Path or URL of the zarr store, e.g.
+        `s3://harmonie-zarr/dini/control/2025-02-17T010000Z/single_levels.zarr`.
+    storage_options : dict, optional
+        fsspec storage options for the filesystem of `url`.
+
+    Returns
+    -------
+    dict or None
+        The publish marker, with the time the store was published
+        (`published_at`), the size of each dimension (`dims`) and the
+        variables in the store (`variables`).
+    """
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    try:
+        return json.loads(fs.cat_file(f"{root}/{PUBLISH_MARKER_KEY}"))
+    except FileNotFoundError:
+        return None
+
+
+def _read_versioned(fs, path: str) -> tuple[bytes | None, str | None]:
+    # the content of an object in S3 and its ETag, read in one request
+    # (`None` for both if the object doesn't exist yet)
+    async def _get_object():
+        bucket, key, _ = fs.split_path(path)
+        response = await fs._call_s3("get_object", Bucket=bucket, Key=key)
+        async with response["Body"] as body:
+            return await body.read(), response["ETag"]
+
+    try:
+        return fsspec.asyn.sync(fs.loop, _get_object)
+    except FileNotFoundError:
+        return None, None
+
+
+def _precondition_failed(err: OSError) -> bool:
+    # s3fs raises the `botocore` error of a failed conditional write as the
+    # cause of an `OSError`
+    response = getattr(err.__cause__, "response", None) or {}
+    return response.get("Error", {}).get("Code") in (
+        "PreconditionFailed",
+        "ConditionalRequestConflict",
+    )
+
+
+def update_object(
+    url: str, update: Callable[[bytes | None], bytes], storage_options: dict = None
+):
+    """
+    Replace the object at `url` with `update` applied to its content (`None`
+    if it doesn't exist yet).
+
+    In S3 the object is only written if it hasn't changed since it was read
+    (its ETag still matches, or it still doesn't exist), otherwise `update` is
+    applied again to the changed object, so that concurrent writers don't
+    lose each other's updates. On other filesystems the object is read and
+    written without such a check, so there must be a single writer.
+    """
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    if "s3" not in fs.protocol:
+        try:
+            data = fs.cat_file(path)
+        except FileNotFoundError:
+            data = None
+        fs.pipe_file(path, update(data))
+        return
+
+    for attempt in range(UPDATE_OBJECT_ATTEMPTS):
+        data, etag = _read_versioned(fs, path)
+        try:
+            if etag is None:
+                fs.pipe_file(path, update(data), mode="create")
+            else:
+                fs.pipe_file(path, update(data), IfMatch=etag)
+            return
+        except OSError as err:
+            if not _precondition_failed(err):
+                raise
+        # back off (with jitter) so that the writers don't keep colliding
+        logger.info(f"{url} changed since it was read, retrying the update")
+        time.sleep(random.uniform(0, 0.05 * 2**attempt))
+    raise RuntimeError(
+        f"Failed to update {url}, it was changed by other writers during each "
+        f"of {UPDATE_OBJECT_ATTEMPTS} attempts"
+    )
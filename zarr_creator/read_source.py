@@ -2,33 +2,163 @@
 # -*- coding: utf-8 -*-
 import datetime
 import os
+import shutil
+import threading
+import time
 from pathlib import Path
 
+import fsspec
 import isodate
 import xarray as xr
+import zarr
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.spec import AbstractBufferedFile
 from loguru import logger
 
-REFS_ROOT_PATH = os.getenv("REFS_ROOT_PATH")
-
-if REFS_ROOT_PATH is None:
-    raise ValueError(
-        "Environment variable REFS_ROOT_PATH must be set to the root path of "
-        "gribscan reference files (i.e. the .jsons files created by gribscan)"
-    )
-
-
-def read_level_type_data(t_analysis: datetime.datetime, level_type: str) -> xr.Dataset:
+# If set, the GRIB messages referenced by the refs are read through a fsspec
+# block cache in this directory, so that only the byte ranges of the GRIB
+# files which are actually used are copied to local scratch space (rather than
+# copying the complete GRIB files before indexing)
+GRIB_BLOCK_CACHE_PATH = os.getenv("GRIB_BLOCK_CACHE_PATH") or None
+
+# bytes of the GRIB messages read by this process, see `grib_bytes_read`
+_grib_bytes_read = 0
+_grib_bytes_read_lock = threading.Lock()
+
+
+def grib_bytes_read() -> int:
+    """
+    Total bytes of the GRIB messages read through the refs by this process,
+    i.e. by the datasets returned by `read_level_type_data` (when using
+    `dask.distributed` the messages are read in the worker processes).
+    """
+    return _grib_bytes_read
+
+
+class GribMessageStore(zarr.storage.FSStore):
+    """
+    Read-only zarr store of the refs in a fsspec reference filesystem, which
+    counts the bytes of the chunks read that are GRIB messages (i.e. refs to
+    byte ranges of the GRIB files rather than values inlined in the refs).
+    """
+
+    def __init__(self, fs: fsspec.AbstractFileSystem):
+        super().__init__("", fs=fs, mode="r")
+
+    def _count(self, key: str, value: bytes):
+        global _grib_bytes_read
+        if isinstance(self.fs.references.get(key), list):
+            with _grib_bytes_read_lock:
+                _grib_bytes_read += len(value)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._count(key, value)
+        return value
+
+    def getitems(self, keys, *, contexts):
+        items = super().getitems(keys, contexts=contexts)
+        for key, value in items.items():
+            self._count(key, value)
+        return items
+
+
+class _GribFile(AbstractBufferedFile):
+    """Local GRIB file which is read in byte ranges through its cache."""
+
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        with open(self.path, "rb") as fh:
+            fh.seek(start)
+            return fh.read(end - start)
+
+
+class GribFileSystem(LocalFileSystem):
+    """
+    Local filesystem of the GRIB files for the block cache. The files opened
+    by `LocalFileSystem` are read directly from their file handles, bypassing
+    the cache set on them by `blockcache`, so the files are opened as
+    buffered files instead, which read their byte ranges through the cache.
+    """
+
+    def _open(self, path, mode="rb", block_size="default", **kwargs):
+        if mode != "rb":
+            return super()._open(path, mode=mode, block_size=block_size, **kwargs)
+        return _GribFile(self, path, mode=mode, block_size=block_size, **kwargs)
+
+
+def clear_block_cache(block_cache_path: str = None):
+    """
+    Delete the GRIB block cache in `block_cache_path` (by default
+    `GRIB_BLOCK_CACHE_PATH`, nothing is done if that isn't set) once the
+    GRIB messages cached in it have been converted. The cached block cache
+    filesystems are dropped too, so that the next read starts a new cache.
+    """
+    if block_cache_path is None:
+        block_cache_path = GRIB_BLOCK_CACHE_PATH
+    if block_cache_path is None:
+        return
+    # the reference filesystems hold on to the block cache filesystems
+    fsspec.get_filesystem_class("reference").clear_instance_cache()
+    fsspec.get_filesystem_class("blockcache").clear_instance_cache()
+    shutil.rmtree(block_cache_path, ignore_errors=True)
+    logger.info(f"Deleted GRIB block cache in {block_cache_path}")
+
+
+def _to_utc(t_analysis: datetime.datetime) -> datetime.datetime:
     if t_analysis.tzinfo is None:
         t_analysis = t_analysis.replace(tzinfo=datetime.timezone.utc)
-    t_analysis_utc = t_analysis.astimezone(datetime.timezone.utc)
-
-    member_id = os.getenv("MEMBER_ID", "CONTROL__dmi")
-
-    t_str = t_analysis_utc.strftime("%Y-%m-%dT%H%MZ")
-    fp = Path(REFS_ROOT_PATH) / member_id / f"{t_str}.jsons" / f"{level_type}.json"
+    return t_analysis.astimezone(datetime.timezone.utc)
+
+
+def refs_path_for(t_analysis: datetime.datetime, member_id: str = None) -> Path:
+    """
+    Path of the directory containing the gribscan refs (one .json file per
+    level type) for a given analysis time and member, under the root path
+    set in the `REFS_ROOT_PATH` environment variable.
+    """
+    refs_root_path = os.getenv("REFS_ROOT_PATH")
+    if refs_root_path is None:
+        raise ValueError(
+            "Environment variable REFS_ROOT_PATH must be set to the root path of "
+            "gribscan reference files (i.e. the .jsons files created by gribscan)"
+        )
+    if member_id is None:
+        member_id = os.getenv("MEMBER_ID", "CONTROL__dmi")
+    t_str = _to_utc(t_analysis).strftime("%Y-%m-%dT%H%MZ")
+    return Path(refs_root_path) / member_id / f"{t_str}.jsons"
+
+
+def read_level_type_data(
+    t_analysis: datetime.datetime,
+    level_type: str,
+    member_id: str = None,
+    refs_path: Path = None,
+    block_cache_path: str = GRIB_BLOCK_CACHE_PATH,
+) -> xr.Dataset:
+    if refs_path is None:
+        refs_path = refs_path_for(t_analysis=t_analysis, member_id=member_id)
+    fp = Path(refs_path) / f"{level_type}.json"
+    if not fp.exists():
+        available = sorted(p.stem for p in Path(refs_path).glob("*.json"))
+        raise FileNotFoundError(
+            f"No refs for level type `{level_type}` in {refs_path} (refs exist "
+            f"for level types {available}), check that the GRIB files have been "
+            "indexed with this level type"
+        )
 
     logger.info(f"Reading {t_analysis} {level_type} data from {fp}")
-    ds = xr.open_zarr(f"reference::{str(fp)}")
+    if block_cache_path is None:
+        fs = fsspec.filesystem("reference", fo=str(fp))
+    else:
+        # the blocks are stored in sparse files, so the scratch space used is
+        # bounded by the GRIB messages read rather than the GRIB file sizes
+        fs = fsspec.filesystem(
+            "reference",
+            fo=str(fp),
+            remote_protocol="blockcache",
+            remote_options=dict(fs=GribFileSystem(), cache_storage=block_cache_path),
+        )
+    ds = xr.open_zarr(GribMessageStore(fs))
 
     # copy over cf standard-names where eccodes provides them
     for var_name in ds.data_vars:
@@ -79,6 +209,55 @@ def read_level_type_data(t_analysis: datetime.datetime, level_type: str) -> xr.D
     return ds
 
 
+class LevelTypeDataReader:
+    """
+    Memoizing wrapper around `read_level_type_data` so that the gribscan refs
+    for each (analysis time, level type, member) are only parsed once per
+    run, however many parts and config entries use them. The time spent
+    parsing refs is accumulated so that it can be reported at the end of
+    the run.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self.parse_time = 0.0
+        self.n_hits = 0
+
+    def __call__(
+        self,
+        t_analysis: datetime.datetime,
+        level_type: str,
+        member_id: str = None,
+        refs_path: Path = None,
+    ) -> xr.Dataset:
+        if member_id is None:
+            member_id = os.getenv("MEMBER_ID", "CONTROL__dmi")
+        key = (_to_utc(t_analysis), level_type, member_id, refs_path)
+
+        if key in self._datasets:
+            self.n_hits += 1
+        else:
+            t_start = time.perf_counter()
+            self._datasets[key] = read_level_type_data(
+                t_analysis=t_analysis,
+                level_type=level_type,
+                member_id=member_id,
+                refs_path=refs_path,
+                block_cache_path=GRIB_BLOCK_CACHE_PATH,
+            )
+            self.parse_time += time.perf_counter() - t_start
+
+        # return a shallow copy so that changes to attributes by the caller
+        # don't leak into later reads of the same level type
+        return self._datasets[key].copy()
+
+    def log_summary(self):
+        logger.info(
+            f"Parsed {len(self._datasets)} gribscan refs in {self.parse_time:.2f}s "
+            f"({self.n_hits} reads served from cache)"
+        )
+
+
 # based on
 # https://opendatadocs.dmi.govcloud.dk/Data/Forecast_Data_Weather_Model_HARMONIE_DINI_IG,
 # but modified to include USAGE section with BBOX that cartopy requires
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rechunking of the output datasets to the chunk shapes configured for each part
+in `config.OUTPUT_CHUNKING`.
+
+Two methods are available:
+
+- "memory": rechunk with dask directly in the graph that writes the output,
+  which is fast but needs the source chunks of every target chunk to be held
+  in memory at once
+- "rechunker": use the `rechunker` package, which goes via an intermediate
+  temporary zarr store and keeps memory usage bounded by `max_mem`
+"""
+import tempfile
+import warnings
+from pathlib import Path
+
+import dask.utils
+import xarray as xr
+import zarr
+from loguru import logger
+
+from .settings import RECHUNK_METHODS
+
+
+def resolve_chunks(ds: xr.Dataset, chunking: dict) -> dict:
+    """
+    Resolve a chunking specification into a chunk size for every dimension of
+    `ds`.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The dataset to be rechunked.
+    chunking : dict
+        Chunk size for each dimension. Integer values are used as the chunk
+        size directly, float values are taken as a fraction of the dimension
+        size (e.g. `0.5` to split a dimension into two chunks). Dimensions
+        not included (or set to `None`) are not split into chunks.
+
+    Returns
+    -------
+    dict
+        Chunk size (as integer) for each dimension in the dataset.
+    """
+    chunks = {}
+    for d in ds.dims:
+        dim_len = ds.sizes[d]
+        chunksize = chunking.get(d)
+        if chunksize is None:
+            chunksize = dim_len
+        elif isinstance(chunksize, float):
+            chunksize = max(1, int(round(dim_len * chunksize)))
+
+        if chunksize > dim_len:
+            warnings.warn(
+                f"Requested chunksize for dim `{d}` is larger than then dimension"
+                f" size ({chunksize} > {dim_len}). Reducing to dimension size."
+            )
+            chunksize = dim_len
+        chunks[d] = chunksize
+
+    return chunks
+
+
+def choose_rechunk_method(ds: xr.Dataset, method: str, max_mem: str) -> str:
+    """
+    Pick the rechunk method to use. With `method="auto"` the data is rechunked
+    in memory if the whole dataset fits within `max_mem`, otherwise
+    `rechunker` is used.
+    """
+    if method not in RECHUNK_METHODS:
+        raise NotImplementedError(f"Rechunk method {method} not implemented")
+
+    if method != "auto":
+        return method
+
+    if ds.nbytes <= dask.utils.parse_bytes(max_mem):
+        return "memory"
+    return "rechunker"
+
+
+def rechunk_in_memory(ds: xr.Dataset, chunks: dict) -> xr.Dataset:
+    """
+    Rechunk `ds` to `chunks` with dask, returning a lazy dataset which will
+    be written with these chunks.
+    """
+    ds = ds.chunk(chunks)
+    # remove any chunking encoding from the source so that xarray uses the
+    # dask chunks when writing
+    for var_name in ds.variables:
+        ds[var_name].encoding.pop("chunks", None)
+        ds[var_name].encoding.pop("preferred_chunks", None)
+    return ds
+
+
+def _variable_target_chunks(ds: xr.Dataset, chunks: dict) -> dict:
+    target_chunks = {}
+    for var_name in ds.variables:
+        dims = ds[var_name].dims
+        if len(dims) == 0:
+            target_chunks[var_name] = None
+        else:
+            target_chunks[var_name] = {d: chunks[d] for d in dims}
+    return target_chunks
+
+
+def _variable_target_options(ds: xr.Dataset) -> dict:
+    # rechunker applies the CF encoding (e.g. packing) set on each variable, but
+    # only uses the compressor and filters given in the target options
+    target_options = {}
+    for var_name in ds.variables:
+        encoding = ds[var_name].encoding
+        target_options[var_name] = {
+            k: encoding[k] for k in ["compressor", "filters"] if k in encoding
+        }
+    return target_options
+
+
+def rechunk_to_store(
+    ds: xr.Dataset,
+    chunks: dict,
+    target_store,
+    max_mem: str,
+    temp_path: str | Path = None,
+):
+    """
+    Rechunk `ds` to `chunks` with `rechunker` and write the result to
+    `target_store`, using an intermediate store in a temporary directory so
+    that at most `max_mem` is used by each task.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The dataset to rechunk and write.
+    chunks : dict
+        Target chunk size for each dimension (see `resolve_chunks`).
+    target_store : str or MutableMapping
+        The zarr store to write the rechunked dataset to.
+    max_mem : str
+        Maximum memory each task may use, e.g. "2GB".
+    temp_path : str or Path, optional
+        Directory in which the intermediate store is created. Defaults to the
+        system temporary directory.
+    """
+    # imported here as it is slow to import and only needed for large parts
+    import rechunker
+
+    target_chunks = _variable_target_chunks(ds, chunks)
+
+    with tempfile.TemporaryDirectory(dir=temp_path) as tempdir:
+        temp_store = str(Path(tempdir) / "intermediate.zarr")
+        logger.info(
+            f"Rechunking with rechunker (max_mem={max_mem}, temp_store={temp_store})"
+        )
+        plan = rechunker.rechunk(
+            ds,
+            target_chunks=target_chunks,
+            max_mem=max_mem,
+            target_store=target_store,
+            target_options=_variable_target_options(ds),
+            temp_store=temp_store,
+        )
+        plan.execute()
+
+    zarr.consolidate_metadata(target_store)
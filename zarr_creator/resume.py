@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resuming the write of an output zarr store that was interrupted, by finding
+which chunks of a partially written store are missing so that only the
+regions containing them are computed and written again.
+
+zarr writes each chunk as a single object (via a temporary file and a rename
+locally, or a single PUT on S3), so a chunk key that exists in the store is
+complete. A partially written store can be resumed if its metadata matches the
+dataset being written: the same variables, dimension sizes, coordinate values
+(e.g. the same forecast timesteps) and chunks.
+"""
+import itertools
+import math
+
+import fsspec
+import numpy as np
+import xarray as xr
+import zarr
+from fsspec.implementations.local import LocalFileSystem
+from loguru import logger
+
+from .rechunk import rechunk_in_memory
+
+# dimension along which the missing regions of a store are written
+RESUME_DIM = "time"
+# separator between the chunk indices in chunk keys (the zarr v2 default, which
+# xarray uses)
+CHUNK_KEY_SEPARATOR = "."
+
+
+def _open_partial_store(store: fsspec.FSMap) -> xr.Dataset | None:
+    try:
+        return xr.open_zarr(store, consolidated=False)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+
+def is_resumable(ds: xr.Dataset, store: fsspec.FSMap, chunks: dict) -> bool:
+    """
+    Check if the (possibly partially written) zarr `store` was created for
+    `ds` with `chunks`, so that writing can be resumed rather than starting
+    from scratch.
+    """
+    ds_existing = _open_partial_store(store)
+    if ds_existing is None:
+        return False
+
+    if set(ds_existing.data_vars) != set(ds.data_vars):
+        return False
+    if dict(ds_existing.sizes) != dict(ds.sizes):
+        return False
+    for dim in ds.indexes:
+        if not np.array_equal(ds_existing[dim].values, ds[dim].values):
+            return False
+    for var_name in ds.data_vars:
+        var_chunks = tuple(chunks[d] for d in ds[var_name].dims)
+        if tuple(ds_existing[var_name].encoding.get("chunks", ())) != var_chunks:
+            return False
+    return True
+
+
+def _chunk_keys(da: xr.DataArray, chunks: dict) -> list[tuple[int, ...]]:
+    n_chunks = [math.ceil(da.sizes[d] / chunks[d]) for d in da.dims]
+    return list(itertools.product(*[range(n) for n in n_chunks]))
+
+
+def missing_regions(
+    ds: xr.Dataset, store: fsspec.FSMap, chunks: dict, dim: str = RESUME_DIM
+) -> tuple[list[slice], list[str]]:
+    """
+    Find the parts of `ds` that are missing from the partially written zarr
+    `store` (which must be resumable, see `is_resumable`).
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The dataset being written.
+    store : fsspec.FSMap
+        The partially written zarr store.
+    chunks : dict
+        Chunk size for each dimension of `ds`.
+    dim : str, optional
+        The dimension along which missing regions are returned.
+
+    Returns
+    -------
+    list of slice
+        The regions along `dim` (aligned with the chunks) in which at least
+        one chunk of a variable with dimension `dim` is missing, with
+        neighbouring regions merged.
+    list of str
+        The variables (including non-index coordinates) without dimension
+        `dim` that have missing chunks.
+    """
+    existing_keys = set(store.keys())
+    missing_indices = set()
+    missing_vars = []
+
+    for var_name in ds.variables:
+        da = ds[var_name]
+        # index coordinates and scalars are written when the store is created
+        if var_name in ds.indexes or da.ndim == 0:
+            continue
+        missing = [
+            key
+            for key in _chunk_keys(da, chunks)
+            if f"{var_name}/{CHUNK_KEY_SEPARATOR.join(map(str, key))}"
+            not in existing_keys
+        ]
+        if not missing:
+            continue
+        if dim in da.dims:
+            i_dim = da.dims.index(dim)
+            missing_indices.update(key[i_dim] for key in missing)
+        else:
+            missing_vars.append(var_name)
+
+    regions = []
+    for i in sorted(missing_indices):
+        start, stop = i * chunks[dim], min((i + 1) * chunks[dim], ds.sizes[dim])
+        if regions and regions[-1].stop == start:
+            regions[-1] = slice(regions[-1].start, stop)
+        else:
+            regions.append(slice(start, stop))
+
+    n_chunks_dim = math.ceil(ds.sizes[dim] / chunks[dim]) if dim in ds.dims else 0
+    logger.info(
+        f"{len(missing_indices)} of {n_chunks_dim} `{dim}` chunks and "
+        f"{len(missing_vars)} variables without `{dim}` are missing from {store.root}"
+    )
+    return regions, missing_vars
+
+
+def _write_target(store: fsspec.FSMap):
+    # local stores are written by path, so that zarr writes each chunk to a
+    # temporary file and renames it into place
+    if isinstance(store.fs, LocalFileSystem):
+        return store.root
+    return store
+
+
+def _split_region(region: slice, max_size: int = None) -> list[slice]:
+    if max_size is None:
+        return [region]
+    return [
+        slice(start, min(start + max_size, region.stop))
+        for start in range(region.start, region.stop, max_size)
+    ]
+
+
+def write_missing_regions(
+    ds: xr.Dataset,
+    store: fsspec.FSMap,
+    chunks: dict,
+    dim: str = RESUME_DIM,
+    max_region_size: int = None,
+    after_region: callable = None,
+) -> int:
+    """
+    Compute and write only the regions of `ds` that are missing from the
+    partially written zarr `store` (which must be resumable, see
+    `is_resumable`), and consolidate the store's metadata.
+
+    With `max_region_size` (a multiple of the chunk size along `dim`) the
+    regions are written in pieces of at most this size, so that only one
+    piece is computed at a time. `after_region` (if given) is called after
+    each region is written, e.g. to check a memory budget.
+
+    Returns
+    -------
+    int
+        The number of regions written.
+    """
+    regions, missing_vars = missing_regions(ds, store, chunks=chunks, dim=dim)
+    regions = [
+        piece for region in regions for piece in _split_region(region, max_region_size)
+    ]
+    target = _write_target(store)
+
+    ds_dim = ds.drop_vars([v for v in ds.variables if dim not in ds[v].dims])
+    for region in regions:
+        logger.info(f"Writing missing region {dim}={region}")
+        ds_region = ds_dim.isel({dim: region})
+        ds_region = rechunk_in_memory(
+            ds_region, chunks={d: chunks[d] for d in ds_region.dims}
+        )
+        ds_region.to_zarr(target, region={dim: region})
+        if after_region is not None:
+            after_region()
+
+    if missing_vars:
+        # the variables without `dim` (e.g. `lsm`) are small, so they are
+        # written in full if any of their chunks are missing
+        logger.info(f"Writing missing variables {missing_vars}")
+        ds_static = ds[missing_vars]
+        ds_static = ds_static.drop_vars(
+            [v for v in ds_static.variables if ds_static[v].ndim == 0]
+        )
+        ds_static = rechunk_in_memory(
+            ds_static, chunks={d: chunks[d] for d in ds_static.dims}
+        )
+        ds_static.to_zarr(target, region={d: slice(None) for d in ds_static.dims})
+
+    zarr.consolidate_metadata(store)
+    return len(regions) + int(len(missing_vars) > 0)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dask scheduler shared by all parts written in a run, so that when parts are
+written concurrently they draw from one pool of workers rather than each
+starting its own.
+"""
+import contextlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import dask.utils
+from loguru import logger
+
+from .grib_definitions import set_local_eccodes_definitions_path
+from .memory import worker_memory_limit
+
+
+@contextlib.contextmanager
+def dask_scheduler(n_workers: int = None, memory_limit: str = None):
+    """
+    Context manager that sets up the dask scheduler used for computing and
+    writing the output zarrs.
+
+    Without a memory limit dask's threaded scheduler is used with a single
+    thread pool of `n_workers` threads. With a memory limit a
+    `dask.distributed.LocalCluster` is started with `n_workers` worker
+    processes which share the memory budget left after reserving part of it
+    for this process (see `memory.worker_memory_limit`), and workers
+    exceeding their share are paused/restarted by dask.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker threads (or processes with a memory limit), defaults
+        to the number of CPUs available.
+    memory_limit : str, optional
+        Total memory budget for all workers, e.g. "16GB".
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if memory_limit is None:
+        logger.info(f"Using dask threaded scheduler with {n_workers} threads")
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            with dask.config.set(scheduler="threads", pool=pool):
+                yield
+        return
+
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError as exc:
+        raise ImportError(
+            "dask.distributed is required to set a memory limit on the dask "
+            "workers. Install dependency group 'distributed'."
+        ) from exc
+
+    memory_limit_per_worker = worker_memory_limit(memory_limit, n_workers)
+    logger.info(
+        f"Starting dask LocalCluster with {n_workers} workers "
+        f"({dask.utils.format_bytes(memory_limit_per_worker)} memory limit each)"
+    )
+    with (
+        LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=1,
+            memory_limit=memory_limit_per_worker,
+        ) as cluster,
+        Client(cluster) as client,
+    ):
+        # the workers are separate processes and so the local eccodes
+        # definitions path must be set in each of them
+        client.run(set_local_eccodes_definitions_path)
+        yield
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Selection of the GRIB messages needed to create the output datasets defined in
+`config.DATA_COLLECTION`, so that messages for other variables, levels and
+level types (e.g. `hybrid` or `isothermal`) aren't indexed or included in the
+refs.
+"""
+import hashlib
+import json
+
+from .config import DATA_COLLECTION
+from .transforms import DERIVED_VARIABLES
+
+# suffix gribscan gives time-accumulated variables, the GRIB messages of these
+# have the same shortName as the non-accumulated variable
+ACCUMULATED_SUFFIX = "_accum"
+
+
+def _short_name(var_name: str) -> str:
+    if var_name.endswith(ACCUMULATED_SUFFIX):
+        return var_name[: -len(ACCUMULATED_SUFFIX)]
+    return var_name
+
+
+def _add_levels(selection: dict, level_type: str, short_name: str, levels):
+    by_short_name = selection.setdefault(level_type, {})
+    if levels is None or by_short_name.get(short_name, ()) is None:
+        # `None` means that all levels are needed
+        by_short_name[short_name] = None
+    else:
+        by_short_name[short_name] = by_short_name.get(short_name, set()) | set(levels)
+
+
+def required_messages(data_collection: dict = DATA_COLLECTION) -> dict:
+    """
+    Determine the GRIB messages needed for the data collection, as a dict
+    `{level_type: {short_name: levels}}`, where `levels` is a set of levels or
+    `None` if all levels of the variable are needed.
+    """
+    selection = {}
+    for part_details in data_collection.values():
+        for level_details in part_details:
+            level_type = level_details["level_type"]
+            for var_name, levels in level_details.get("variables", {}).items():
+                if callable(levels):
+                    continue
+                _add_levels(selection, level_type, _short_name(var_name), levels)
+
+            for var_name, levels in level_details.get("inputs", {}).items():
+                _add_levels(selection, level_type, _short_name(var_name), levels)
+
+            # derived variables need their inputs on the same levels
+            for name, levels in level_details.get("derived_variables", {}).items():
+                for var_name in DERIVED_VARIABLES[name]["inputs"]:
+                    _add_levels(selection, level_type, _short_name(var_name), levels)
+
+    return selection
+
+
+def is_required(selection: dict, level_type: str, short_name: str, level) -> bool:
+    """
+    Check whether the GRIB message with the given level type, short name and
+    level is in `selection` (as returned by `required_messages`).
+    """
+    by_short_name = selection.get(level_type, {})
+    if short_name not in by_short_name:
+        return False
+    levels = by_short_name[short_name]
+    return levels is None or level in levels
+
+
+def selection_key(selection: dict) -> str:
+    """
+    Short stable hash of `selection`, so that index files created with
+    different selections can be told apart.
+    """
+    normalised = {
+        level_type: {
+            short_name: None if levels is None else sorted(levels)
+            for short_name, levels in by_short_name.items()
+        }
+        for level_type, by_short_name in selection.items()
+    }
+    return hashlib.blake2b(
+        json.dumps(normalised, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
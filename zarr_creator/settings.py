@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Defaults of the command line options that are set by (or used by) modules
+with heavy dependencies. This module only uses the standard library, so that
+`python -m zarr_creator` can build its argument parser (and e.g. print
+`--help`) without importing xarray, dask, rechunker or eccodes, which are
+only imported once a conversion is run.
+"""
+import os
+
+# methods of rechunking the output datasets, see `rechunk.choose_rechunk_method`
+RECHUNK_METHODS = ["auto", "memory", "rechunker"]
+
+# directory the grid geometry of each grid is cached in, see `geometry`
+GRID_GEOMETRY_CACHE_PATH = os.getenv("GRID_GEOMETRY_CACHE_PATH", "/tmp/grid-geometry")
+# how the grid geometry is included in the output datasets
+GRID_GEOMETRY_MODES = ["copy", "link"]
+
+# where the run reports are written, see `instrumentation.run_report`
+RUN_REPORT_PATH = os.getenv("RUN_REPORT_PATH", "/tmp/zarr-creator-run-reports")
+PROMETHEUS_TEXTFILE = os.getenv("PROMETHEUS_TEXTFILE") or None
+
+# number of objects uploaded concurrently when uploading a zarr store to S3
+UPLOAD_CONCURRENCY = 64
+# objects larger than twice this size are uploaded as multipart uploads with
+# parts of this size
+UPLOAD_MULTIPART_CHUNKSIZE = "50MB"
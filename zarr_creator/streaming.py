@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming conversion of a single forecast. Rather than waiting for all forecast
+hours to arrive before indexing and converting the whole forecast, each
+forecast hour is indexed as soon as its `sf` and `pl` GRIB files exist and its
+time slice is appended to the output zarr of each part. This makes the early
+lead times available shortly after they arrive.
+
+The refs for each forecast hour are written to
+`{REFS_ROOT_PATH}/{MEMBER_ID}/{analysis_time}.hourly/{hour:03d}/` so that they
+don't interfere with the refs for the full forecast used by `run.sh`.
+
+Variables computed from neighbouring timesteps (e.g. the mean fluxes
+de-accumulated from `swavr_accum`) are computed from the previous and current
+forecast hour, which are read together.
+
+Usage:
+
+    python -m zarr_creator.streaming --t_analysis 2025-02-27T15:00:00Z
+"""
+import argparse
+import datetime
+import os
+import sys
+from pathlib import Path
+
+import isodate
+import xarray as xr
+from loguru import logger
+
+from .config import OUTPUT_CHUNKING
+from .grib_definitions import set_local_eccodes_definitions_path
+from .indexing import (
+    GRIB_FILE_TYPES,
+    build_refs,
+    grib_filepath,
+    index_files,
+    wait_for_files,
+)
+from .parts import add_provenance_attrs, build_parts
+from .read_source import LevelTypeDataReader, refs_path_for
+from .rechunk import resolve_chunks
+from .selection import required_messages
+from .write_zarr import local_copy_path_for, output_member_name, write_output_zarrs
+
+LOCAL_COPY_STORAGE_PATH = Path("/tmp/dini-recent")
+
+
+def read_consecutive_hours(read_level_type_data, refs_paths: list):
+    """
+    Wrap `read_level_type_data` to read each level type from the refs of
+    consecutive forecast hours in `refs_paths` and concatenate them along
+    time, so that variables computed from neighbouring timesteps can be
+    built for the last of these hours.
+    """
+
+    def _read(**kwargs) -> xr.Dataset:
+        datasets = [
+            read_level_type_data(refs_path=refs_path, **kwargs)
+            for refs_path in refs_paths
+        ]
+        # variables without time (e.g. `lsm`) are taken from the first hour
+        return xr.concat(
+            datasets,
+            dim="time",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+            combine_attrs="override",
+        )
+
+    return _read
+
+
+def time_encoding(t_analysis: datetime.datetime) -> dict:
+    """
+    Encoding of the time coordinate of the streamed zarr stores, set when
+    the first forecast hour is written. Otherwise xarray picks the units from
+    the single time written first (i.e. "days since ..."), which the times of
+    the hours appended later are then encoded in too.
+    """
+    if t_analysis.tzinfo is not None:
+        t_analysis = t_analysis.astimezone(datetime.timezone.utc)
+    return dict(
+        units=f"hours since {t_analysis:%Y-%m-%d %H:%M:%S}",
+        calendar="proleptic_gregorian",
+        dtype="int64",
+    )
+
+
+def stream_forecast(
+    t_analysis: datetime.datetime,
+    max_hour: int,
+    member_id: str = None,
+    poll_interval: float = 10.0,
+    timeout: float = 3 * 3600.0,
+    skip_s3_bucket_upload: bool = False,
+    local_copy_path: Path = None,
+):
+    """
+    Convert a forecast one forecast hour at a time as the GRIB files arrive,
+    writing the first hour to new zarr stores and appending each following
+    hour along the time dimension.
+
+    Parameters
+    ----------
+    t_analysis : datetime.datetime
+        Analysis time of the forecast.
+    max_hour : int
+        Maximum forecast hour to convert (inclusive).
+    member_id : str, optional
+        The member to convert (as in the GRIB filenames, e.g. "MBR001__dmi"),
+        defaults to the `MEMBER_ID` environment variable or "CONTROL__dmi".
+    poll_interval : float, optional
+        Seconds between checks for the GRIB files of the next forecast hour.
+    timeout : float, optional
+        Seconds to wait for the files of a forecast hour before failing.
+    skip_s3_bucket_upload : bool, optional
+        If True, only write the local copies of the zarr stores.
+    local_copy_path : Path, optional
+        Directory the local copies of the stores are written to, defaults to
+        the directory of the member in `LOCAL_COPY_STORAGE_PATH`.
+    """
+    if member_id is None:
+        member_id = os.getenv("MEMBER_ID", "CONTROL__dmi")
+    member = output_member_name(member_id)
+    if local_copy_path is None:
+        local_copy_path = local_copy_path_for(LOCAL_COPY_STORAGE_PATH, member)
+
+    hourly_refs_root = refs_path_for(
+        t_analysis=t_analysis, member_id=member_id
+    ).with_suffix(".hourly")
+    read_level_type_data = LevelTypeDataReader()
+
+    for hour in range(max_hour + 1):
+        grib_files = [
+            grib_filepath(
+                t_analysis=t_analysis,
+                hour=hour,
+                file_type=file_type,
+                member_id=member_id,
+            )
+            for file_type in GRIB_FILE_TYPES
+        ]
+        wait_for_files(grib_files, poll_interval=poll_interval, timeout=timeout)
+
+        logger.info(f"Indexing and building refs for forecast hour {hour:03d}")
+        refs_path = hourly_refs_root / f"{hour:03d}"
+        # refs are built for one file type at a time (as in
+        # `build_indexes_and_refs.sh`) so that the same level types are read
+        # from the same files as when converting the full forecast
+        for fp in grib_files:
+            build_refs(
+                index_paths=index_files(
+                    [fp], n_workers=1, selection=required_messages()
+                ),
+                refs_path=refs_path,
+                prefix=f"{fp.parent}/",
+            )
+
+        # the previous hour is read too (its refs are cached by the reader)
+        # and only the current hour is written
+        refs_paths = [hourly_refs_root / f"{h:03d}" for h in range(hour + 1)][-2:]
+        parts = build_parts(
+            t_analysis=t_analysis,
+            read_level_type_data=read_consecutive_hours(
+                read_level_type_data, refs_paths
+            ),
+            member_id=member_id,
+        )
+
+        for part_id, ds_part in parts.items():
+            ds_part = ds_part.isel(time=[-1])
+            if hour == 0:
+                ds_part.time.encoding.update(time_encoding(t_analysis))
+            add_provenance_attrs(ds_part)
+            write_output_zarrs(
+                ds=ds_part,
+                member=member,
+                dataset_id=part_id,
+                rechunk_to=resolve_chunks(ds_part, OUTPUT_CHUNKING[part_id]),
+                t_analysis=t_analysis,
+                skip_s3_bucket_upload=skip_s3_bucket_upload,
+                local_copy_path=local_copy_path,
+                rechunk_method="memory",
+                append_dim=None if hour == 0 else "time",
+            )
+        logger.info(f"Forecast hour {hour:03d} written")
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description="Convert a forecast to zarr one forecast hour at a time",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "--t_analysis",
+        type=isodate.parse_datetime,
+        required=True,
+        help="Analysis time as ISO8601 string",
+    )
+    argparser.add_argument(
+        "--max-hour",
+        type=int,
+        default=int(os.getenv("MAX_HOUR", 36)),
+        help="Maximum forecast hour to convert (inclusive)",
+    )
+    argparser.add_argument(
+        "--member-id",
+        default=os.getenv("MEMBER_ID", "CONTROL__dmi"),
+        help="Member to convert (as in the GRIB filenames, e.g. MBR001__dmi)",
+    )
+    argparser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between checks for new GRIB files",
+    )
+    argparser.add_argument(
+        "--timeout",
+        type=float,
+        default=3 * 3600.0,
+        help="Seconds to wait for the files of a forecast hour before failing",
+    )
+    argparser.add_argument(
+        "--skip-s3-bucket-upload",
+        action="store_true",
+        help="If provided, skip uploading zarr outputs to the S3 bucket.",
+    )
+    argparser.add_argument("--log-level", default="INFO", help="The log level to use")
+    args = argparser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+
+    set_local_eccodes_definitions_path()
+
+    stream_forecast(
+        t_analysis=args.t_analysis,
+        max_hour=args.max_hour,
+        member_id=args.member_id,
+        poll_interval=args.poll_interval,
+        timeout=args.timeout,
+        skip_s3_bucket_upload=args.skip_s3_bucket_upload,
+    )
+
+
+if __name__ == "__main__":
+    with logger.catch(reraise=True):
+        main()
@@ -1,3 +1,4 @@
+import numpy as np
 import xarray as xr
 
 
@@ -14,3 +15,189 @@ def derive_orography_from_geopotential(da: xr.DataArray) -> xr.DataArray:
     if "grid_mapping" in da.attrs:
         result.attrs["grid_mapping"] = da.attrs["grid_mapping"]
     return result
+
+
+# prefix of the long name gribscan/eccodes gives time-accumulated variables
+ACCUMULATED_LONG_NAME_PREFIX = "Accumulated "
+
+
+def deaccumulate(da: xr.DataArray) -> xr.DataArray:
+    """
+    Convert a variable accumulated since the start of the forecast (e.g.
+    `swavr_accum` in J m-2) to its mean rate (e.g. in W m-2) over each
+    output step, i.e. the interval from the previous timestep to each
+    timestep. The rate is undefined (NaN) at the first timestep.
+
+    Each timestep of the result is computed from only two adjacent
+    timesteps of `da`, so with `time=1` chunks the full time axis is never
+    loaded at once.
+    """
+    dt_seconds = da["time"].diff("time", label="upper") / np.timedelta64(1, "s")
+    # `diff` subtracts the chunks of neighbouring timesteps pairwise
+    rate = da.diff("time", label="upper") / dt_seconds
+    result = rate.reindex(time=da["time"]).assign_attrs(da.attrs)
+
+    result.attrs["units"] = f"{da.attrs.get('units', '')} s-1".strip()
+    if result.attrs["units"] == "J m-2 s-1":
+        result.attrs["units"] = "W m-2"
+    long_name = da.attrs.get("long_name", da.name)
+    if long_name.startswith(ACCUMULATED_LONG_NAME_PREFIX):
+        long_name = long_name[len(ACCUMULATED_LONG_NAME_PREFIX) :]
+    result.attrs["long_name"] = f"Mean {long_name[0].lower()}{long_name[1:]}"
+    result.attrs["cell_methods"] = "time: mean"
+    return result
+
+
+# Registry of variables derived element-wise from GRIB variables on the same
+# level type, keyed by output variable name. Each entry declares the GRIB
+# variables (`inputs`) passed (as numpy arrays, by keyword) to its `kernel`,
+# and the attributes set on the result. Derived variables are listed under
+# `derived_variables` in `config.DATA_COLLECTION`
+DERIVED_VARIABLES = {}
+
+
+def derived_variable(name: str, inputs: tuple, attrs: dict):
+    """
+    Decorator registering `kernel` in `DERIVED_VARIABLES` as the derived
+    variable `name`, computed from the GRIB variables `inputs`.
+    """
+
+    def _register(kernel):
+        DERIVED_VARIABLES[name] = dict(inputs=tuple(inputs), kernel=kernel, attrs=attrs)
+        return kernel
+
+    return _register
+
+
+@derived_variable(
+    "ws",
+    inputs=("u", "v"),
+    attrs={
+        "units": "m s-1",
+        "standard_name": "wind_speed",
+        "long_name": "Wind speed",
+    },
+)
+def wind_speed(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return np.hypot(u, v)
+
+
+@derived_variable(
+    "wdir",
+    inputs=("u", "v"),
+    attrs={
+        "units": "degree",
+        # DINI winds are relative to the model grid rather than true north, so
+        # the direction is too (and `wind_from_direction` doesn't apply)
+        "long_name": "Wind direction (direction wind is blowing from, clockwise "
+        "from the grid y-axis)",
+    },
+)
+def wind_direction(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return np.mod(180.0 + np.degrees(np.arctan2(u, v)), 360.0)
+
+
+# Magnus formula coefficients over water (Sonntag 1990), valid in [-45, 60]C
+MAGNUS_B = 17.62
+MAGNUS_C = 243.12
+ZERO_CELSIUS = 273.15
+# relative humidity (in percent) below which the dewpoint isn't resolved, so
+# that dry points don't give a dewpoint of -inf
+MIN_RELATIVE_HUMIDITY = 0.01
+
+
+@derived_variable(
+    "td",
+    inputs=("t", "r"),
+    attrs={
+        "units": "K",
+        "standard_name": "dew_point_temperature",
+        "long_name": "Dew point temperature",
+    },
+)
+def dewpoint_temperature(t: np.ndarray, r: np.ndarray) -> np.ndarray:
+    t_celsius = t - ZERO_CELSIUS
+    gamma = np.log(np.maximum(r, MIN_RELATIVE_HUMIDITY) / 100.0) + (
+        MAGNUS_B * t_celsius / (MAGNUS_C + t_celsius)
+    )
+    return MAGNUS_C * gamma / (MAGNUS_B - gamma) + ZERO_CELSIUS
+
+
+def _fused_kernel(*arrays, input_names: tuple, names: tuple):
+    # each input chunk is passed once and shared between all derived variables
+    inputs = dict(zip(input_names, arrays))
+    results = tuple(
+        DERIVED_VARIABLES[name]["kernel"](
+            **{v: inputs[v] for v in DERIVED_VARIABLES[name]["inputs"]}
+        ).astype(arrays[0].dtype, copy=False)
+        for name in names
+    )
+    return results if len(results) > 1 else results[0]
+
+
+def derive_variables(ds: xr.Dataset, derived_variables: dict) -> dict:
+    """
+    Compute the derived variables in `derived_variables` (a dict of
+    `{name: levels}`, with `name` a key in `DERIVED_VARIABLES` and `levels`
+    `None` for all levels) from the GRIB variables in `ds`.
+
+    Derived variables needing the same levels are computed together in a
+    single pass over each chunk of their inputs, so that inputs shared
+    between derived variables (e.g. `u` and `v` for wind speed and
+    direction) are only read once per chunk, and adding derived variables
+    doesn't add GRIB reads.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The dataset of a single level type, as read from the gribscan refs.
+    derived_variables : dict
+        The derived variables to compute and the levels to compute them on.
+
+    Returns
+    -------
+    dict
+        The derived variables as DataArrays keyed by name, with the
+        dimensions and levels of their inputs.
+    """
+    unknown = set(derived_variables) - set(DERIVED_VARIABLES)
+    if unknown:
+        raise KeyError(
+            f"Unknown derived variables {sorted(unknown)}, registered derived "
+            f"variables are {sorted(DERIVED_VARIABLES)}"
+        )
+
+    groups = {}
+    for name, levels in derived_variables.items():
+        key = None if levels is None else tuple(levels)
+        groups.setdefault(key, []).append(name)
+
+    derived = {}
+    for levels, names in groups.items():
+        input_names = tuple(
+            dict.fromkeys(
+                v for name in names for v in DERIVED_VARIABLES[name]["inputs"]
+            )
+        )
+        inputs = [
+            ds[v] if levels is None else ds[v].sel(level=list(levels))
+            for v in input_names
+        ]
+        results = xr.apply_ufunc(
+            _fused_kernel,
+            *inputs,
+            kwargs=dict(input_names=input_names, names=tuple(names)),
+            dask="parallelized",
+            output_core_dims=[[]] * len(names),
+            output_dtypes=[inputs[0].dtype] * len(names),
+            keep_attrs="drop",
+        )
+        if len(names) == 1:
+            results = (results,)
+        for name, da in zip(names, results):
+            da = da.rename(name).assign_attrs(DERIVED_VARIABLES[name]["attrs"])
+            if "grid_mapping" in inputs[0].attrs:
+                da.attrs["grid_mapping"] = inputs[0].attrs["grid_mapping"]
+            derived[name] = da
+
+    return derived
@@ -1,17 +1,95 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import datetime
+import os
 import shutil
-import warnings
+import time
 from pathlib import Path
 
+import dask.utils
 import fsspec
 import xarray as xr
 from loguru import logger
 
+from .encoding import apply_codec_profiles
+from .instrumentation import stage, store_stats
+from .inventory import INVENTORY_KEY, inventory_entry, update_inventory
+from .memory import memory_guard, write_bounded
+from .publish import (
+    PUBLISH_MARKER_KEY,
+    publish_local_store,
+    publish_marker,
+    read_publish_marker,
+    remove_publish_marker,
+    staging_path,
+    write_publish_marker,
+)
+from .rechunk import (
+    choose_rechunk_method,
+    rechunk_in_memory,
+    rechunk_to_store,
+    resolve_chunks,
+)
+from .resume import is_resumable, write_missing_regions
+from .settings import UPLOAD_CONCURRENCY, UPLOAD_MULTIPART_CHUNKSIZE
+
 BUCKET_NAME = "harmonie-zarr"
 BUCKET_REGION = "eu-central-1"
 OUTPUT_PREFIX_FORMAT = "dini/{member}/{t_analysis_formatted}/{dataset_id}.zarr"
+# inventory of all published stores, updated on each publish (see
+# `zarr_creator.inventory`)
+INVENTORY_URL = f"s3://{BUCKET_NAME}/{INVENTORY_KEY}"
+# can be set to use a local S3 stand-in (e.g. moto or MinIO) for testing
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+
+def s3_storage_options(concurrency: int = UPLOAD_CONCURRENCY) -> dict:
+    """
+    Storage options for the output S3 bucket, with the connection pool sized
+    for `concurrency` simultaneous requests. fsspec caches filesystem
+    instances by their arguments, so all uploads with the same options share
+    a single s3fs session and its connection pool.
+    """
+    client_kwargs = {"region_name": BUCKET_REGION}
+    if S3_ENDPOINT_URL is not None:
+        client_kwargs["endpoint_url"] = S3_ENDPOINT_URL
+    return dict(
+        client_kwargs=client_kwargs,
+        config_kwargs={"max_pool_connections": concurrency},
+    )
+
+
+def output_member_name(member_id: str) -> str:
+    """
+    Name of a member in the output paths, from the member identifier in the
+    GRIB filenames, e.g. "control" for "CONTROL__dmi".
+    """
+    return member_id.split("__")[0].lower()
+
+
+def local_copy_path_for(local_copy_root: Path, member: str) -> Path:
+    """
+    Directory of the local copies of the zarr stores of a member. The control
+    member's copies are directly in `local_copy_root`, and those of other
+    members (or of all members stacked together) in a subdirectory named
+    after the member.
+    """
+    if member == "control":
+        return Path(local_copy_root)
+    return Path(local_copy_root) / member
+
+
+def output_url(member: str, t_analysis: datetime.datetime, dataset_id: str) -> str:
+    """
+    URL of the output zarr store in the S3 bucket for a member, analysis time
+    and part, e.g.
+    "s3://harmonie-zarr/dini/control/2025-03-03T060000Z/single_levels.zarr"
+    """
+    t_analysis_formatted = t_analysis.isoformat().replace(":", "").replace("+0000", "Z")
+    prefix = OUTPUT_PREFIX_FORMAT.format(
+        member=member, t_analysis_formatted=t_analysis_formatted, dataset_id=dataset_id
+    )
+    return f"s3://{BUCKET_NAME}/{prefix}"
 
 
 def write_output_zarrs(
@@ -22,6 +100,15 @@ def write_output_zarrs(
     t_analysis: datetime.datetime,
     skip_s3_bucket_upload: bool = False,
     local_copy_path: str = None,
+    rechunk_method: str = "auto",
+    rechunk_max_mem: str = "2GB",
+    rechunk_temp_path: str = None,
+    region: dict = None,
+    append_dim: str = None,
+    upload_concurrency: int = UPLOAD_CONCURRENCY,
+    upload_multipart_chunksize: str = UPLOAD_MULTIPART_CHUNKSIZE,
+    resume: bool = False,
+    memory_limit: str = None,
 ):
     """
     Write a xarray dataset to zarr, always creating a local copy and optionally
@@ -34,10 +121,10 @@ def write_output_zarrs(
     dataset_id: str
         The dataset id, e.g. "single_levels" or "pressure_levels"
     rechunk_to : dict
-        A dictionary specifying the target chunk size for each dimension.
-        Only the dimensions that are present in the dataset will be used, and
-        the size limited to the size of the dimension (if the chunk size
-        provided is larger).
+        A dictionary specifying the target chunk size for each dimension,
+        see `rechunk.resolve_chunks` for details. Only the dimensions that are
+        present in the dataset will be used, and the size limited to the size
+        of the dimension (if the chunk size provided is larger).
     member : str
         The forecast member name, e.g. "control"
     t_analysis : datetime.datetime
@@ -47,60 +134,460 @@ def write_output_zarrs(
     local_copy_path : str, optional
         If provided, a local copy of the zarr dataset will also be saved to
         this path, but without the timestamp with the filename `{part_id}.zarr`.
+    rechunk_method : str, optional
+        How to rechunk the dataset, one of "auto", "memory" or "rechunker".
+        With "auto" the dataset is rechunked in memory if it is no larger than
+        `rechunk_max_mem`, otherwise `rechunker` is used.
+    rechunk_max_mem : str, optional
+        Memory limit used for choosing the rechunk method and for each
+        `rechunker` task, e.g. "2GB".
+    rechunk_temp_path : str, optional
+        Directory for the intermediate store used by `rechunker`, defaults to
+        the system temporary directory.
+    region : dict, optional
+        If provided, write `ds` into this region (e.g. `dict(time=slice(3, 4))`)
+        of already existing zarr stores instead of replacing them. Variables
+        that don't share a dimension with the region are not written.
+    append_dim : str, optional
+        If provided, append `ds` along this dimension (e.g. "time") to
+        already existing zarr stores instead of replacing them. Variables
+        without this dimension are not written.
+    upload_concurrency : int, optional
+        Number of objects uploaded to S3 concurrently.
+    upload_multipart_chunksize : str, optional
+        Part size for multipart uploads to S3, objects smaller than twice this
+        size are uploaded with a single request.
+    resume : bool, optional
+        If True, resume an earlier write of the same dataset that was
+        interrupted: a local copy that has already been published is not
+        written again, only the missing regions of a partially written store
+        are computed and written, and only files missing from the S3 bucket
+        are uploaded. Ignored when writing with `region` or `append_dim`.
+    memory_limit : str, optional
+        Memory budget for writing, e.g. "4GB". New stores are then written in
+        batches sized to fit the budget (with `rechunk_method="auto"` always
+        rechunking in memory), and writing fails with
+        `memory.MemoryBudgetExceeded` if the RSS goes over the budget, see
+        `memory.write_bounded`.
+
+    When writing with `region` or `append_dim` only the files of the local
+    copy that have been changed are uploaded to S3. After each upload the
+    entry of the store in the inventory at `INVENTORY_URL` is updated (see
+    `inventory.update_inventory`).
     """
-    for d in ds.dims:
-        dim_len = len(ds[d])
-        if d in rechunk_to and rechunk_to[d] > dim_len:
-            warnings.warn(
-                f"Requested chunksize for dim `{d}` is larger than then dimension"
-                f" size ({rechunk_to[d]} > {dim_len}). Reducing to dimension size."
-            )
-            rechunk_to[d] = dim_len
-
-    target_chunks = {}
-    for d in ds.dims:
-        target_chunks[d] = [rechunk_to.get(d, ds[d].size)]
-    for c in ds.coords:
-        # target_chunks[c] = {d: target_chunks[d] for d in ds[c].dims}
-        target_chunks[c] = {d: rechunk_to.get(d, ds[d].size) for d in ds[c].dims}
-    for v in ds.data_vars:
-        # target_chunks[v] = {d: target_chunks[d] for d in ds[v].dims}
-        target_chunks[v] = {d: rechunk_to.get(d, ds[d].size) for d in ds[v].dims}
-
-    # reset the encoding so that the zarr dataset that is written isn't written
-    # with an encoding that is reliant on the gribscan package's decoding
-    # functions
-    ds.encoding = {}
-    for var_name in ds.data_vars:
-        ds[var_name].encoding = {}
+    if region is not None and append_dim is not None:
+        raise ValueError("Only one of `region` and `append_dim` can be given")
+    incremental = region is not None or append_dim is not None
 
-    t_analysis_formatted = t_analysis.isoformat().replace(":", "").replace("+0000", "Z")
-    prefix = OUTPUT_PREFIX_FORMAT.format(
-        member=member, t_analysis_formatted=t_analysis_formatted, dataset_id=dataset_id
+    if incremental:
+        # only the variables that span the region/append dimension are written,
+        # the others (e.g. `lsm`) are already in the store
+        write_dims = set(region) if region is not None else {append_dim}
+        ds = ds.drop_vars(
+            [v for v in ds.variables if not write_dims.intersection(ds[v].dims)]
+        )
+
+    chunks = resolve_chunks(ds, rechunk_to)
+
+    # replace the encoding from the GRIB source with the compression, bit-rounding
+    # and packing set for each variable in `config.VARIABLE_CODEC_PROFILES`
+    ds = apply_codec_profiles(ds)
+
+    if incremental:
+        # incremental writes are a small slice of the full dataset and
+        # rechunker can only write complete new stores
+        method = "memory"
+    elif memory_limit is not None and rechunk_method == "auto":
+        # the batches of a bounded write are rechunked in memory one at a time
+        method = "memory"
+    else:
+        method = choose_rechunk_method(
+            ds, method=rechunk_method, max_mem=rechunk_max_mem
+        )
+    logger.info(f"Rechunking {dataset_id} to {chunks} (method: {method})")
+
+    write_kwargs = dict(
+        chunks=chunks,
+        method=method,
+        max_mem=rechunk_max_mem,
+        temp_path=rechunk_temp_path,
+        region=region,
+        append_dim=append_dim,
+        memory_limit=memory_limit,
     )
 
+    path_out = output_url(member=member, t_analysis=t_analysis, dataset_id=dataset_id)
+    storage_options = s3_storage_options(concurrency=upload_concurrency)
+
     fn_local = f"{dataset_id}.zarr"
     if local_copy_path is not None:
-        Path(local_copy_path).mkdir(parents=True, exist_ok=True)
         fp_local = Path(local_copy_path) / fn_local
-        if fp_local.exists():
-            logger.warning(f"Local copy path {fp_local} already exists, overwriting")
-            shutil.rmtree(fp_local)
 
-        logger.info(f"Writing local copy to {fp_local}")
-        ds.to_zarr(fp_local, mode="w")
+        # the dataset is computed (i.e. the GRIB messages are fetched, decoded
+        # and encoded) exactly once, when writing the local copy. The finished
+        # store is then uploaded as-is, rather than computing it a second time
+        # by calling `ds.to_zarr(...)` with the S3 target
+        t_write_start = time.time()
+        with stage("write_local", dataset=dataset_id, member=member) as record:
+            if incremental:
+                logger.info(f"Writing to local copy {fp_local}")
+                _write_rechunked(ds, target=str(fp_local), **write_kwargs)
+                write_publish_marker(str(fp_local), publish_marker(str(fp_local)))
+            elif (
+                resume
+                and read_publish_marker(str(fp_local)) is not None
+                and is_resumable(ds, fsspec.get_mapper(str(fp_local)), chunks=chunks)
+            ):
+                logger.info(f"Local copy {fp_local} has already been published")
+            else:
+                # new stores are written to a staging directory and moved into
+                # place once complete, so that readers never see a partial store
+                fp_staging = staging_path(fp_local, reuse=resume)
+                logger.info(f"Writing local copy to {fp_staging}")
+                try:
+                    _write_or_resume(
+                        ds, target=str(fp_staging), resume=resume, **write_kwargs
+                    )
+                except BaseException:
+                    if resume:
+                        logger.warning(f"Keeping {fp_staging} to resume writing later")
+                    else:
+                        shutil.rmtree(fp_staging, ignore_errors=True)
+                    raise
+                write_publish_marker(str(fp_staging), publish_marker(str(fp_staging)))
+                publish_local_store(fp_staging=fp_staging, fp_target=fp_local)
+                record.update(store_stats(fp_local))
 
-    if skip_s3_bucket_upload:
+        if skip_s3_bucket_upload:
+            logger.info("Skipping S3 upload (--skip-s3-bucket-upload enabled)")
+        else:
+            logger.info(f"Uploading {fp_local} to {path_out}")
+            with stage("upload", dataset=dataset_id, member=member) as record:
+                record.update(
+                    copy_zarr_store(
+                        src=str(fp_local),
+                        dst=path_out,
+                        dst_storage_options=storage_options,
+                        modified_since=t_write_start if incremental else None,
+                        concurrency=upload_concurrency,
+                        multipart_chunksize=upload_multipart_chunksize,
+                        skip_existing=resume and not incremental,
+                    )
+                )
+            _update_inventory(
+                str(fp_local),
+                member=member,
+                t_analysis=t_analysis,
+                dataset_id=dataset_id,
+                store_url=path_out,
+            )
+    elif skip_s3_bucket_upload:
         logger.info("Skipping S3 upload (--skip-s3-bucket-upload enabled)")
     else:
-        path_out = f"s3://{BUCKET_NAME}/{prefix}"
-        logger.info(f"Writing to {path_out}", flush=True)
-        target = fsspec.get_mapper(
+        with stage("write_s3", dataset=dataset_id, member=member):
+            if incremental:
+                logger.info(f"Writing to {path_out}")
+                remove_publish_marker(path_out, storage_options=storage_options)
+                target = fsspec.get_mapper(path_out, **storage_options)
+                _write_rechunked(ds, target=target, **write_kwargs)
+                write_publish_marker(
+                    path_out,
+                    publish_marker(path_out, storage_options=storage_options),
+                    storage_options=storage_options,
+                )
+            else:
+                # new stores are written to a staging prefix and then copied
+                # (server-side) over the published store, so that readers keep
+                # seeing the previous store until the new one is complete
+                path_staging = f"{path_out}.staging"
+                logger.info(f"Writing to {path_staging}")
+                target = fsspec.get_mapper(path_staging, **storage_options)
+                _write_or_resume(ds, target=target, resume=resume, **write_kwargs)
+                write_publish_marker(
+                    path_staging,
+                    publish_marker(path_staging, storage_options=storage_options),
+                    storage_options=storage_options,
+                )
+                logger.info(f"Copying {path_staging} to {path_out}")
+                copy_zarr_store(
+                    src=path_staging,
+                    dst=path_out,
+                    src_storage_options=storage_options,
+                    dst_storage_options=storage_options,
+                    concurrency=upload_concurrency,
+                )
+                target.clear()
+        _update_inventory(
             path_out,
-            client_kwargs={"region_name": BUCKET_REGION},
+            member=member,
+            t_analysis=t_analysis,
+            dataset_id=dataset_id,
+            storage_options=storage_options,
         )
-        ds.to_zarr(target, mode="w", compute=True, consolidated=True)
 
-    logger.info("done!", flush=True)
+    logger.info("done!")
 
     return
+
+
+def _update_inventory(url, storage_options=None, **entry_kwargs):
+    # the store has been published by the time the inventory is updated, so
+    # a failed update is logged rather than failing the write
+    try:
+        update_inventory(
+            inventory_entry(url, storage_options=storage_options, **entry_kwargs),
+            url=INVENTORY_URL,
+            storage_options=s3_storage_options(),
+        )
+    except Exception:
+        logger.exception(f"Failed to update the inventory {INVENTORY_URL}")
+
+
+def _write_or_resume(ds, target, resume, **write_kwargs):
+    # write a new store to `target`, or with `resume` only write the regions
+    # missing from a store left at `target` by an interrupted write
+    if write_kwargs["memory_limit"] is not None and write_kwargs["method"] == "memory":
+        write_bounded(
+            ds,
+            target=target,
+            chunks=write_kwargs["chunks"],
+            memory_limit=write_kwargs["memory_limit"],
+            resume=resume,
+        )
+        return
+
+    store = target if isinstance(target, fsspec.FSMap) else fsspec.get_mapper(target)
+    if resume and is_resumable(ds, store, chunks=write_kwargs["chunks"]):
+        logger.info(f"Resuming interrupted write to {store.root}")
+        write_missing_regions(ds, store, chunks=write_kwargs["chunks"])
+    else:
+        store.clear()
+        _write_rechunked(ds, target=target, **write_kwargs)
+
+
+def _write_rechunked(
+    ds,
+    target,
+    chunks,
+    method,
+    max_mem,
+    temp_path,
+    region=None,
+    append_dim=None,
+    memory_limit=None,
+):
+    if memory_limit is not None:
+        with memory_guard(
+            memory_limit, description=f"writing {getattr(target, 'root', target)}"
+        ):
+            _write_rechunked(
+                ds,
+                target,
+                chunks=chunks,
+                method=method,
+                max_mem=max_mem,
+                temp_path=temp_path,
+                region=region,
+                append_dim=append_dim,
+            )
+        return
+
+    if region is not None:
+        # the chunks of the region must line up with the chunks in the store
+        chunks = {d: chunks[d] for d in ds.dims if d not in region}
+        rechunk_in_memory(ds, chunks).to_zarr(target, region=region, consolidated=True)
+    elif append_dim is not None:
+        rechunk_in_memory(ds, chunks).to_zarr(
+            target, append_dim=append_dim, consolidated=True
+        )
+    elif method == "memory":
+        rechunk_in_memory(ds, chunks).to_zarr(target, mode="w", consolidated=True)
+    else:
+        rechunk_to_store(
+            ds,
+            chunks=chunks,
+            target_store=target,
+            max_mem=max_mem,
+            temp_path=temp_path,
+        )
+
+
+def copy_zarr_store(
+    src: str,
+    dst: str,
+    dst_storage_options: dict = None,
+    modified_since: float = None,
+    concurrency: int = UPLOAD_CONCURRENCY,
+    multipart_chunksize: str = UPLOAD_MULTIPART_CHUNKSIZE,
+    skip_existing: bool = False,
+    src_storage_options: dict = None,
+) -> dict:
+    """
+    Copy an already written zarr store from `src` to `dst` without decoding
+    or re-encoding any of the chunks, replacing anything already at `dst`
+    (unless `modified_since` is given).
+
+    The store at `dst` is replaced in place and stays readable throughout:
+    the chunks are copied over the existing keys first, then the metadata, and
+    only then are the keys that aren't in `src` deleted. The publish marker of
+    the store (see `zarr_creator.publish`) is copied last, so that readers
+    polling for it keep seeing the previous store until the new one is
+    complete.
+
+    Parameters
+    ----------
+    src : str
+        Path or fsspec url of the zarr store to copy.
+    dst : str
+        Path or fsspec url to copy the zarr store to, e.g.
+        "s3://harmonie-zarr/dini/control/2025-03-03T060000Z/single_levels.zarr"
+    dst_storage_options : dict, optional
+        Storage options passed to fsspec when opening the target filesystem.
+    modified_since : float, optional
+        If provided, only copy files in `src` modified at or after this unix
+        timestamp and keep everything else already at `dst`. Used to upload
+        only the chunks and metadata changed by an incremental write.
+    concurrency : int, optional
+        Number of files copied concurrently when the target filesystem
+        supports it (e.g. S3).
+    multipart_chunksize : str, optional
+        Part size used for multipart uploads of large files to S3.
+    skip_existing : bool, optional
+        If True, skip copying chunks that already exist at `dst` with the same
+        size and array metadata, e.g. to resume an interrupted upload.
+        Metadata files are always copied.
+    src_storage_options : dict, optional
+        Storage options passed to fsspec when opening the source filesystem.
+        When `src` and `dst` are on the same S3 filesystem the files are
+        copied server-side.
+
+    Returns
+    -------
+    dict
+        The number of bytes (`bytes_written`) and chunks (`chunks_written`)
+        copied.
+    """
+    fs_src, root_src = fsspec.core.url_to_fs(src, **(src_storage_options or {}))
+    fs_dst, root_dst = fsspec.core.url_to_fs(dst, **(dst_storage_options or {}))
+    root_src = root_src.rstrip("/")
+    root_dst = root_dst.rstrip("/")
+
+    fp_marker_src = f"{root_src}/{PUBLISH_MARKER_KEY}"
+    fp_marker_dst = f"{root_dst}/{PUBLISH_MARKER_KEY}"
+
+    # mirror the key layout of the source store, all files are read as raw
+    # bytes so the encoded chunks are transferred unchanged
+    src_files_all = fs_src.find(root_src)
+    src_files = src_files_all
+    if modified_since is not None:
+        src_files = [
+            fp for fp in src_files if fs_src.modified(fp).timestamp() >= modified_since
+        ]
+    if skip_existing:
+        src_files = _files_missing_from_target(fs_src, root_src, fs_dst, root_dst)
+    copy_marker = fp_marker_src in src_files
+    src_files = [fp for fp in src_files if fp != fp_marker_src]
+
+    def _dst_path(fp):
+        return f"{root_dst}/{fp[len(root_src) :].lstrip('/')}"
+
+    # the chunks are copied before the metadata that references them, so that
+    # the store at `dst` is never described by metadata whose chunks are
+    # missing
+    is_metadata = [fp.rsplit("/", 1)[-1].startswith(".") for fp in src_files]
+    chunk_files = [fp for fp, meta in zip(src_files, is_metadata) if not meta]
+    metadata_files = [fp for fp, meta in zip(src_files, is_metadata) if meta]
+
+    t_start = time.perf_counter()
+    for fps in (chunk_files, metadata_files):
+        _copy_files(
+            fs_src,
+            fs_dst,
+            fps,
+            [_dst_path(fp) for fp in fps],
+            concurrency=concurrency,
+            multipart_chunksize=multipart_chunksize,
+        )
+
+    if modified_since is None:
+        # the keys of a replaced store that aren't in the new one (e.g. chunks
+        # beyond the new shape) are only deleted once nothing references them
+        keep = {_dst_path(fp) for fp in src_files_all} | {fp_marker_dst}
+        stale_files = [fp for fp in fs_dst.find(root_dst) if fp.rstrip("/") not in keep]
+        if stale_files:
+            logger.info(f"Deleting {len(stale_files)} stale files from {dst}")
+            fs_dst.rm(stale_files)
+
+    if copy_marker:
+        fs_dst.pipe_file(fp_marker_dst, fs_src.cat_file(fp_marker_src))
+
+    logger.info(
+        f"Copied {len(src_files)} files to {dst} in "
+        f"{time.perf_counter() - t_start:.1f}s"
+    )
+    return dict(
+        bytes_written=sum(fs_src.size(fp) for fp in src_files),
+        chunks_written=sum(
+            not fp.rsplit("/", 1)[-1].startswith((".", "_")) for fp in src_files
+        ),
+    )
+
+
+def _copy_files(fs_src, fs_dst, src_files, dst_files, concurrency, multipart_chunksize):
+    if not src_files:
+        return
+    if fs_dst.async_impl and fs_src is fs_dst:
+        # e.g. from a staging prefix in the same bucket, copied server-side
+        fs_dst.copy(src_files, dst_files, batch_size=concurrency)
+    elif fs_dst.async_impl and fs_src.protocol in ("file", ("file", "local")):
+        # upload the files concurrently (in batches of `concurrency`) in one
+        # call, rather than waiting for each request to finish before
+        # starting the next
+        fs_dst.put(
+            src_files,
+            dst_files,
+            batch_size=concurrency,
+            chunksize=dask.utils.parse_bytes(multipart_chunksize),
+        )
+    else:
+        for fp_src, fp_dst in zip(src_files, dst_files):
+            fs_dst.pipe_file(fp_dst, fs_src.cat_file(fp_src))
+
+
+def _files_missing_from_target(fs_src, root_src, fs_dst, root_dst):
+    # the files of the store at `root_src` which aren't already at `root_dst`.
+    # Chunks are only taken to already exist if the array metadata (shape,
+    # chunks, dtype and codecs) at `root_dst` is the same as in `root_src`
+    src_sizes = {
+        fp[len(root_src) :].lstrip("/"): info["size"]
+        for fp, info in fs_src.find(root_src, detail=True).items()
+    }
+    dst_sizes = {}
+    if fs_dst.exists(root_dst):
+        dst_sizes = {
+            fp[len(root_dst) :].lstrip("/"): info["size"]
+            for fp, info in fs_dst.find(root_dst, detail=True).items()
+        }
+
+    same_array_metadata = set()
+    for key in src_sizes:
+        if key.endswith("/.zarray") and key in dst_sizes:
+            if fs_src.cat_file(f"{root_src}/{key}") == fs_dst.cat_file(
+                f"{root_dst}/{key}"
+            ):
+                same_array_metadata.add(key.rsplit("/", 1)[0])
+
+    missing = []
+    for key, size in src_sizes.items():
+        var_name, _, filename = key.rpartition("/")
+        if (
+            filename.startswith(".")
+            or var_name not in same_array_metadata
+            or dst_sizes.get(key) != size
+        ):
+            missing.append(f"{root_src}/{key}")
+    logger.info(
+        f"{len(src_sizes) - len(missing)} of {len(src_sizes)} files already exist "
+        f"at {root_dst}"
+    )
+    return missing